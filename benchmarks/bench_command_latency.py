@@ -0,0 +1,103 @@
+'''
+bench_command_latency.py, command round-trip latency of main.py over a pseudo-terminal pair
+
+Copyright: Zeust the Unoobian <2noob2banoob@gmail.com>, 2014
+
+This file is part of DigitalLockin.
+
+DigitalLockin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+DigitalLockin is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with DigitalLockin.  If not, see <http://www.gnu.org/licenses/>.
+
+Starts main.py with simulated lock-ins on one end of a pty pair and measures the time
+from writing a command on the other end until the complete response has been read
+Only works on systems with pseudo-terminals (i.e. not on Windows)
+
+Usage: python bench_command_latency.py [repetitions]
+'''
+
+import os
+import select
+import subprocess
+import sys
+import time
+import tty
+import numpy
+
+MAIN_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main.py')
+STARTUP_TIMEOUT = 30.
+RESPONSE_TIMEOUT = 5.
+COMMANDS = ['*IDN?', 'GET F', 'SET T 0.1', 'GET RPHI']
+
+def _readline(fd, timeout=RESPONSE_TIMEOUT):
+	'''Read one line from file descriptor <fd>, returns None on timeout'''
+	line = b''
+	t_timeout = time.time() + timeout
+	while not line.endswith(b'\n'):
+		remaining = t_timeout - time.time()
+		if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+			return None
+		line += os.read(fd, 1)
+	return line.decode('utf-8')
+
+def _drain(fd, quiet=0.2):
+	'''Discard everything that arrives on file descriptor <fd> until it has been quiet for <quiet> seconds'''
+	while select.select([fd], [], [], quiet)[0]:
+		os.read(fd, 4096)
+
+def roundtrip(fd, command):
+	'''Send <command> and read the first line of the response, returns (response, seconds)'''
+	t = time.time()
+	os.write(fd, (command + '\n').encode('utf-8'))
+	response = _readline(fd)
+	return (response, time.time() - t)
+
+def main(repetitions=200):
+	(master, slave) = os.openpty()
+	# No echo or line editing, also not before the server configures the port
+	tty.setraw(slave)
+	devnull = open(os.devnull, 'w')
+	server = subprocess.Popen([sys.executable, MAIN_PY, os.ttyname(slave), '--simulated'], stdout=devnull, stderr=devnull, cwd=os.path.dirname(MAIN_PY))
+	try:
+		# Wait for the server to open the port
+		t_timeout = time.time() + STARTUP_TIMEOUT
+		while roundtrip(master, '*IDN?')[0] is None:
+			if time.time() > t_timeout or server.poll() is not None:
+				raise RuntimeError('main.py did not respond')
+		_drain(master)
+		if roundtrip(master, 'SELECT 1')[0].strip() != 'OK':
+			raise RuntimeError('Could not create a simulated lock-in')
+		roundtrip(master, 'START')
+		print('{:<12s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('command', 'median ms', 'p90 ms', 'p99 ms', 'max ms'))
+		for command in COMMANDS:
+			latencies = []
+			for i in range(repetitions):
+				(response, dt) = roundtrip(master, command)
+				if response is None:
+					raise RuntimeError('No response to {:s}'.format(command))
+				latencies.append(dt * 1e3)
+			print('{:<12s} {:10.3f} {:10.3f} {:10.3f} {:10.3f}'.format(command, numpy.median(latencies), numpy.percentile(latencies, 90), numpy.percentile(latencies, 99), max(latencies)))
+		roundtrip(master, 'STOP')
+		os.write(master, b'CLOSE ALL\n')
+		server.wait()
+	finally:
+		if server.poll() is None:
+			server.kill()
+		os.close(master)
+		os.close(slave)
+		devnull.close()
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		main(int(sys.argv[1]))
+	else:
+		main()
@@ -0,0 +1,70 @@
+'''
+bench_fmt_array.py, speed and reply size of the text formatter of main.py
+
+Copyright: Zeust the Unoobian <2noob2banoob@gmail.com>, 2014
+
+This file is part of DigitalLockin.
+
+DigitalLockin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+DigitalLockin is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with DigitalLockin.  If not, see <http://www.gnu.org/licenses/>.
+
+Compares _fmt_array_for_com of main.py with the formatter it replaced (row by row with
+str() of every value) on arrays shaped like the replies to GET RPHIBUFFER, RPHI and XY
+
+The RPHIBUFFER reply is that of a buffer of the default length (R_PHI_BUFFER_LEN_DEFAULT of main.py)
+
+Usage: python bench_fmt_array.py
+'''
+
+import numpy
+
+from bench_suite import time_per_call
+from main import _fmt_array_for_com, R_PHI_BUFFER_LEN_DEFAULT, CHANNELS_MAX
+
+PRECISIONS = [None, 8, 6, 4]
+
+def _fmt_array_for_com_old(x):
+	'''The formatter before SET PRECISION was added, recurses per row and concatenates strings'''
+	x = numpy.array(x)
+	if x.ndim > 1:
+		y = ''
+		for i in range(len(x)):
+			y = '{:s}{:s}'.format(y, _fmt_array_for_com_old(x[i]))
+		return 'OK {:d} lines\n{:s}'.format(len(x), y)
+	else:
+		if len(x) == 0:
+			return 'EMPTY'
+		else:
+			return ', '.join([str(z) for z in x]) + '\n'
+
+def test_arrays():
+	'''Arrays shaped like full RPHIBUFFER, RPHI and XY replies of a lock-in with CHANNELS_MAX measurement channels'''
+	return [
+		('RPHIBUFFER', numpy.random.randn(R_PHI_BUFFER_LEN_DEFAULT, 2 + 2 * CHANNELS_MAX)),
+		('RPHI', numpy.random.randn(1 + 2 * CHANNELS_MAX)),
+		('XY', numpy.random.randn(2 * CHANNELS_MAX)),
+	]
+
+def main():
+	fmt = _fmt_array_for_com
+	print('{:<12s} {:<10s} {:>12s} {:>10s} {:>9s}'.format('reply', 'precision', 'us per call', 'bytes', 'speedup'))
+	for (name, x) in test_arrays():
+		t_old = time_per_call(lambda: _fmt_array_for_com_old(x))
+		print('{:<12s} {:<10s} {:12.1f} {:10d} {:>9s}'.format(name, 'old', t_old * 1e6, len(_fmt_array_for_com_old(x)), ''))
+		for precision in PRECISIONS:
+			t = time_per_call(lambda: fmt(x, precision))
+			label = 'full' if precision is None else str(precision)
+			print('{:<12s} {:<10s} {:12.1f} {:10d} {:8.1f}x'.format(name, label, t * 1e6, len(fmt(x, precision)), t_old / t))
+
+if __name__ == '__main__':
+	main()
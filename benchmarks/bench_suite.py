@@ -0,0 +1,258 @@
+'''
+bench_suite.py, benchmarks of the signal processing, protocol and acquisition code without NI hardware
+
+Copyright: Zeust the Unoobian <2noob2banoob@gmail.com>, 2014
+
+This file is part of DigitalLockin.
+
+DigitalLockin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+DigitalLockin is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with DigitalLockin.  If not, see <http://www.gnu.org/licenses/>.
+
+Times the code which has to keep up with the instruments, for every combination of sample frequency,
+number of measurement channels, chunk length and number of lock-ins (see SWEEP and QUICK_SWEEP):
+	process_data          : one record of <chunk> samples per lock-in
+	process_data_moreinfo : one record of <chunk> samples per lock-in
+	continuous_retrieve   : continuous_retrieve_and_filter of a chunk of <chunk> samples per lock-in,
+	                        from a stub hardware interface which returns a pregenerated chunk
+	fmt_array             : _fmt_array_for_com of an R/PHI buffer of <chunk> lines per lock-in
+	command_loop          : command_loop of a batch of one command per lock-in, the R/PHI buffers
+	                        holding <chunk> results (main.py with simulated lock-ins and no COM port)
+Parameters which do not affect a benchmark (such as the sample frequency for fmt_array) are not swept for it
+The results are written to a JSON file, and compared with an earlier results file if one is given
+
+Usage: python bench_suite.py [--quick] [--output <file>] [--compare <earlier file>] [--only <benchmark>[,...]]
+'''
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import timeit
+import numpy
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import digitallockin as dlm
+import digitallockinsimhwinterface as simhwi
+
+# Values of the parameters, every benchmark runs all combinations of the parameters which affect it
+SWEEP = {'Fs': [51200, 204800], 'channels': [1, 2, 3], 'chunk': [1024, 8192, 65536], 'lockins': [1, 4]}
+QUICK_SWEEP = {'Fs': [204800], 'channels': [1, 3], 'chunk': [1024, 16384], 'lockins': [1, 2]}
+OUTPUT_RATE = 100. # Output rate of the continuous lock-ins [Hz]
+TIME_CONSTANT = 0.1 # Filter time constant of the continuous lock-ins [s]
+PRECISIONS = [None, 6] # Precisions of fmt_array
+MIN_SECONDS = 0.2 # Each measurement repeats the benchmark until it has taken at least this long
+REPEAT = 3 # Number of measurements of which the best is reported
+SLOWER_THRESHOLD = 1.2 # Results which take this much longer than in the compared file are marked as slower
+RESULT_KEYS = ['benchmark', 'case', 'Fs', 'channels', 'chunk', 'lockins']
+
+class _StubHardwareInterface(simhwi.SimulatedHardwareInterface):
+	'''
+	SimulatedHardwareInterface which returns the same pregenerated chunk of <chunk> samples on every retrieval
+	and never waits, so the benchmarks time the lock-in and not the simulation
+	'''
+
+	def __init__(self, chunk, **kwargs):
+		simhwi.SimulatedHardwareInterface.__init__(self, realtime=False, **kwargs)
+		self._chunk = chunk
+		self._block = None
+
+	def start_measurement(self, vmin=-10, vmax=10, config='PSEUDODIFF', bufsize=204800):
+		simhwi.SimulatedHardwareInterface.start_measurement(self, vmin, vmax, config, bufsize)
+		self._block = self._generate(0, self._chunk)
+
+	def retrieve_samples(self, nsamples=1, timeout=1.0, assumebuffered=False):
+		return self._block if nsamples == -1 else self._block[:, :nsamples]
+
+def _stub_lockin(Fs, channels, chunk):
+	'''A measuring DigitalLockin on a _StubHardwareInterface with <channels> measurement channels'''
+	meas_ch = ['ai{:d}'.format(i + 1) for i in range(channels)]
+	li = dlm.DigitalLockin(Fs=Fs, meas_ch=meas_ch, simulated=True)
+	li.close_hardware()
+	li._hw = _StubHardwareInterface(chunk, Fs=Fs, meas_ch=meas_ch, Fsignal=li.get_f())
+	li.set_flt_time_constant(TIME_CONSTANT)
+	li.set_output_rate(OUTPUT_RATE)
+	li.start_measurement()
+	return li
+
+def time_per_call(f):
+	'''Best time in seconds of REPEAT measurements of one call of <f>, each measurement averaging over at least MIN_SECONDS'''
+	t = time.time()
+	f()
+	number = max(1, int(MIN_SECONDS / max(time.time() - t, 1e-6)))
+	return min(timeit.repeat(f, number=number, repeat=REPEAT)) / number
+
+def _grid(sweep, names):
+	'''All combinations of the values of parameters <names> in <sweep>, as dictionaries'''
+	return [dict(zip(names, values)) for values in itertools.product(*[sweep[name] for name in names])]
+
+def bench_process_data(sweep):
+	results = []
+	for p in _grid(sweep, ['Fs', 'channels', 'chunk', 'lockins']):
+		lockins = [_stub_lockin(p['Fs'], p['channels'], p['chunk']) for i in range(p['lockins'])]
+		for li in lockins:
+			li.retrieve_samples(p['chunk'])
+		for (case, process) in [('process_data', lambda li: li.process_data()), ('process_data_moreinfo', lambda li: li.process_data_moreinfo())]:
+			t = time_per_call(lambda: [process(li) for li in lockins])
+			results.append(dict(p, benchmark=case, case='', seconds=t, samples_per_second=p['chunk'] * p['lockins'] / t))
+		for li in lockins:
+			li.close()
+	return results
+
+def bench_continuous_retrieve(sweep):
+	results = []
+	for p in _grid(sweep, ['Fs', 'channels', 'chunk', 'lockins']):
+		lockins = [_stub_lockin(p['Fs'], p['channels'], p['chunk']) for i in range(p['lockins'])]
+		t = time_per_call(lambda: [li.continuous_retrieve_and_filter() for li in lockins])
+		results.append(dict(p, benchmark='continuous_retrieve', case='rate {:g}'.format(OUTPUT_RATE), seconds=t, samples_per_second=p['chunk'] * p['lockins'] / t))
+		for li in lockins:
+			li.close()
+	return results
+
+def load_main(argv=None):
+	'''
+	Import main.py and set it up like its command line would, with arguments <argv> added to
+	--simulated and without COM port, TCP port or Unix socket. Returns the module
+	'''
+	import serial
+	import main as instrument
+
+	class _NullPort:
+		'''Serial port which never receives anything and discards what is written'''
+		def __init__(self, *args, **kwargs):
+			pass
+		def readline(self):
+			time.sleep(0.1)
+			return ''
+		def write(self, data):
+			pass
+		def close(self):
+			pass
+
+	serial_class = serial.Serial
+	serial.Serial = _NullPort
+	try:
+		instrument.initialize(['BENCHMARK', '--simulated'] + (argv or []))
+	finally:
+		serial.Serial = serial_class
+	logging.root.setLevel(logging.WARNING)
+	return instrument
+
+def bench_fmt_array(sweep, instrument):
+	results = []
+	fmt = instrument._fmt_array_for_com
+	for p in _grid(sweep, ['channels', 'chunk', 'lockins']):
+		buffers = [numpy.random.randn(p['chunk'], 2 + 2 * p['channels']) for i in range(p['lockins'])]
+		for precision in PRECISIONS:
+			t = time_per_call(lambda: [fmt(x, precision) for x in buffers])
+			case = 'precision {:s}'.format('full' if precision is None else str(precision))
+			results.append(dict(p, benchmark='fmt_array', case=case, Fs=None, seconds=t, lines_per_second=p['chunk'] * p['lockins'] / t))
+	return results
+
+def bench_command_loop(sweep, instrument):
+	results = []
+	conn = instrument.connections[0]
+	for p in _grid(sweep, ['channels', 'chunk', 'lockins']):
+		while len(instrument.sessions) < p['lockins']:
+			instrument.command_loop('SELECT {:d}\n'.format(len(instrument.sessions) + 1), conn)
+		ids = sorted(instrument.sessions.keys())[:p['lockins']]
+		for sid in ids:
+			session = instrument.sessions[sid]
+			session.set_buffer_length(p['chunk'])
+			for i in range(p['chunk']):
+				session.store_result(i * 0.01, 1., numpy.ones(p['channels']), numpy.zeros(p['channels']))
+			session.li.set_channels(meas_ch=['ai{:d}'.format(i + 1) for i in range(p['channels'])])
+		for (case, command) in [('GET F', 'GET {:d}:F'), ('GET R', 'GET {:d}:R'), ('GET RPHIBUFFER', 'GET {:d}:RPHIBUFFER')]:
+			line = ';'.join([command.format(sid) for sid in ids]) + '\n'
+			def run():
+				conn.cursors.clear()
+				instrument.command_loop(line, conn)
+			run()
+			if conn.waiting():
+				raise RuntimeError('command_loop benchmark: {:s} did not finish'.format(line.strip()))
+			t = time_per_call(run)
+			results.append(dict(p, benchmark='command_loop', case=case, Fs=None, seconds=t))
+	return results
+
+def close_main(instrument):
+	instrument.interrupt_received = True
+	for session in instrument.sessions.values():
+		session.li.close()
+
+BENCHMARKS = ['process_data', 'continuous_retrieve', 'fmt_array', 'command_loop']
+
+def run(sweep, only=None):
+	'''Run the benchmarks in <only> (default: all of BENCHMARKS) for the parameters in <sweep>, returns a list of results'''
+	only = only or BENCHMARKS
+	results = []
+	if 'process_data' in only:
+		results += bench_process_data(sweep)
+	if 'continuous_retrieve' in only:
+		results += bench_continuous_retrieve(sweep)
+	if 'fmt_array' in only or 'command_loop' in only:
+		instrument = load_main()
+		try:
+			if 'fmt_array' in only:
+				results += bench_fmt_array(sweep, instrument)
+			if 'command_loop' in only:
+				results += bench_command_loop(sweep, instrument)
+		finally:
+			close_main(instrument)
+	return results
+
+def _key(result):
+	return tuple([result.get(k) for k in RESULT_KEYS])
+
+def print_results(results, earlier=None):
+	'''Print a table of <results>, with the ratio to the matching results in <earlier> if given'''
+	earlier = dict([(_key(r), r) for r in (earlier or [])])
+	print('{:<22s} {:<16s} {:>7s} {:>3s} {:>6s} {:>3s} {:>12s} {:>8s}'.format('benchmark', 'case', 'Fs', 'ch', 'chunk', 'li', 'us per call', 'vs old'))
+	for r in results:
+		ratio = ''
+		if _key(r) in earlier:
+			ratio = '{:7.2f}x'.format(r['seconds'] / earlier[_key(r)]['seconds'])
+			if r['seconds'] > SLOWER_THRESHOLD * earlier[_key(r)]['seconds']:
+				ratio += ' SLOWER'
+		print('{:<22s} {:<16s} {:>7s} {:3d} {:6d} {:3d} {:12.1f} {:>8s}'.format(r['benchmark'], r['case'], '' if r['Fs'] is None else str(r['Fs']), r['channels'], r['chunk'], r['lockins'], r['seconds'] * 1e6, ratio))
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmarks of the digital lock-in without NI hardware')
+	parser.add_argument('--quick', action='store_true', help='sweep fewer parameter values (QUICK_SWEEP instead of SWEEP)')
+	parser.add_argument('--output', default='bench_results.json', help='JSON file to write the results to')
+	parser.add_argument('--compare', default=None, help='JSON file of earlier results to compare with')
+	parser.add_argument('--only', default=None, help='comma-separated benchmarks to run, out of ' + ','.join(BENCHMARKS))
+	args = parser.parse_args()
+	only = None if args.only is None else args.only.split(',')
+	for name in only or []:
+		if name not in BENCHMARKS:
+			raise RuntimeError('Unknown benchmark {:s}, choose from {:s}'.format(name, ','.join(BENCHMARKS)))
+	earlier = None
+	if args.compare is not None:
+		with open(args.compare) as f:
+			earlier = json.load(f)['results']
+	sweep = QUICK_SWEEP if args.quick else SWEEP
+	results = run(sweep, only)
+	print_results(results, earlier)
+	info = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'numpy': numpy.__version__,
+		'platform': platform.platform(), 'processor': platform.processor(), 'sweep': sweep,
+		'output_rate': OUTPUT_RATE, 'time_constant': TIME_CONSTANT}
+	with open(args.output, 'w') as f:
+		json.dump({'info': info, 'results': results}, f, indent=1, sort_keys=True)
+	print('Results written to {:s}'.format(args.output))
+
+if __name__ == '__main__':
+	main()
@@ -22,10 +22,17 @@ along with DigitalLockin.  If not, see <http://www.gnu.org/licenses/>.
 import matplotlib.pyplot as plt
 import numpy
 import sys
-import random
+import collections
+import fractions
+import functools
 import logging
+import threading
 import time #for benchmark
 
+import digitallockinsimhwinterface as simhwi
+import digitallockinrecorder as recorder
+import digitallockinreplayhwinterface as replayhwi
+
 try:
 	import digitallockinhwinterface as hwi
 	CAN_MEASURE = True
@@ -33,57 +40,357 @@ try:
 	logging.info('Loaded hardware interface module.')
 except Exception:
 	CAN_MEASURE = False
-	MAX_SAMPLE_FREQUENCY = 200000
+	MAX_SAMPLE_FREQUENCY = simhwi.MAX_SAMPLE_FREQUENCY_MEAS_SIM
 	logging.exception('Could not load hardware interface. You can perform simulated lock-in sequences on virtual noise sources but not actual measurements on physical devices. Details:')
 
+# Largest natural logarithm of the sample weights used by _first_order_section
+# Bounds the block length such that the weights stay far away from floating point overflow
+_BLOCK_WEIGHT_LN_MAX = 300.
+
+# Largest oscillator period in samples for which the lock-in uses exact oscillator tables
+_OSC_TABLE_PERIOD_MAX = 1 << 18
+
+# Number of oscillator and filter weight tables the continuous lock-in keeps in memory
+_DEMODULATOR_CACHE_ENTRIES = 8
+
+# Number of samples process_data demodulates at once
+# Small enough for the raw data block and the oscillator block to stay in the processor cache
+_PROCESS_BLOCK_LEN = 4096
+
+# Number of filter transition matrices each set of oscillator and filter weight tables keeps in memory
+_TRANSITION_CACHE_ENTRIES = 64
+
+# Default interval in seconds between two retrievals of the acquisition thread (see DigitalLockin.start_acquisition_thread)
+ACQUISITION_INTERVAL_DEFAULT = 0.01
+
+# Maximum number of decimated filter outputs the continuous lock-in keeps until they are retrieved
+OUTPUT_BUFFER_LEN_MAX = 100000
+
 # Simple Euler integration
 # A sample of the output is the sum of all input samples up to the same sample number
 # Uses a unit timestep instead of taking the timestep as a parameter so the result is not properly scaled
+# Integrates along the last axis, so a channels x samples array is integrated per channel in one go
 def _integrate(x):
-	if x[0].size != 1:
-		y=numpy.zeros([len(x),len(x[0])])
-		for i in range(len(x)):
-			y[i][:] = _integrate(x[i][:])
+	return numpy.cumsum(numpy.asarray(x, dtype=float), axis=-1)
+
+# First-order recursive filter y[n] = pole * y[n-1] + gain * x[n] along the last axis of x
+# yinit is the output before the first sample, either a scalar or one value per channel
+# The pole may be complex, in which case the output is complex as well
+# Instead of looping over samples, the recursion is unrolled as
+#   y[n] = pole^n * (pole * yinit + gain * sum_{k<=n} pole^-k * x[k])
+# which is a cumulative sum of weighted samples. The samples are processed in blocks
+# which are short enough that the weights pole^-k cannot overflow, so this is
+# numerically stable for any record length
+def _first_order_section(x, pole, gain, yinit=0.):
+	x = numpy.asarray(x)
+	n = x.shape[-1]
+	dtype = numpy.result_type(x.dtype, numpy.asarray(pole).dtype, numpy.asarray(gain).dtype, numpy.asarray(yinit).dtype, float)
+	pole = dtype.type(pole)
+	y = numpy.empty(x.shape, dtype)
+	if pole == 0:
+		y[...] = gain * x
+		return y
+	mlnpole = abs(numpy.log(abs(pole)))
+	if mlnpole > 0:
+		blocklen = max(1, min(n, int(_BLOCK_WEIGHT_LN_MAX / mlnpole)))
 	else:
-		y = numpy.zeros(x.size)
-		y[0] = x[0]
-		for i in xrange(1,x.size):
-			y[i] = y[i-1] + x[i]
+		blocklen = max(1, n)
+	k = numpy.arange(blocklen)
+	powers = pole ** k
+	invpowers = (1 / pole) ** k
+	yprev = numpy.zeros(x.shape[:-1], dtype) + yinit
+	for start in range(0, n, blocklen):
+		stop = min(start + blocklen, n)
+		wsum = numpy.cumsum(x[..., start:stop] * invpowers[:stop-start], axis=-1)
+		y[..., start:stop] = powers[:stop-start] * (pole * yprev[..., numpy.newaxis] + gain * wsum)
+		yprev = y[..., stop-1]
+	return y
+
+# Cascade of first-order filters with unity DC gain, one for each element of poles
+# The poles are applied in list order and may be complex, as long as the complex poles
+# come in complex conjugate pairs when the input is real (the output is then real as well)
+# This way arbitrary filter orders and complex pole pairs are supported
+def _cascade_filter(x, poles):
+	x = numpy.asarray(x)
+	if numpy.iscomplexobj(poles) and not numpy.iscomplexobj(x):
+		if not numpy.allclose(numpy.sort_complex(poles), numpy.sort_complex(numpy.conj(poles))):
+			raise RuntimeError('Complex filter poles must come in complex conjugate pairs to filter a real signal')
+		realoutput = True
+	else:
+		realoutput = False
+	y = x
+	for p in poles:
+		y = _first_order_section(y, p, 1 - p)
+	if realoutput:
+		y = y.real.copy()
 	return y
 
 # Filtering function
 # Every filter is realised as a cascade of first-order alpha filters
-# The initial value of each filter is the average of its input
+# The initial value of each filter is zero
 # The alpha values of subsequent first-order filters are supplied as a list
 # For a first-order filter you can also supply just the element rather than a one-dimensional list
-# The alpha-cascade implementation has some limitations, because it does not support complex poles
+# All channels of a channels x samples array are filtered at once
+# Use _cascade_filter directly for filters with complex poles
 def _filter(x, alpha=numpy.pi/200000):
-	if isinstance(x[0], list) or isinstance(x[0], numpy.ndarray):
-		y = numpy.zeros([len(x), len(x[0])])
-		for i in range(len(x)):
-			y[i][:] = _filter(x[i][:], alpha)
-		return y
 	if not isinstance(alpha, list):
 		alpha = [alpha]
 	if len(alpha) == 0:
 		return x
-	#yinit = numpy.average(x)
-	yinit = 0
-	a = alpha[-1]
-	am = 1 - a
-	y = numpy.zeros(len(x))
-	y[0] = am * yinit + a * x[0]
-	for i in xrange(1, len(x)):
-		y[i] = am * y[i-1] + a * x[i]
-	return _filter(y, alpha[:-1])
-
-#Generate a zero-mean noise signal with specified standard deviation and number of samples
-def _gaussiannoise(sigma, numsamples):
-	y = numpy.zeros(numsamples)
-	for i in xrange(numsamples):
-		y[i] = random.gauss(0, sigma)
-	y -= numpy.average(y)
-	return y
+	return _cascade_filter(x, [1 - a for a in reversed(alpha)])
+
+# Normalise synchronous detection results of the harmonics in <harmonics> (the first one being the fundamental)
+# sini and cosi are [reference frequencies x] harmonics x channels arrays, the first channel being the reference channel
+# Amplitudes are normalised to the reference amplitude at the fundamental frequency
+# The phase of harmonic h is relative to h times the reference phase at the fundamental frequency
+# Every reference frequency is normalised to its own fundamental
+# Returns the reference amplitude (not scaled) and [reference frequencies x] harmonics x measurement channels arrays of amplitudes and phases
+def _normalise_harmonics(sini, cosi, harmonics):
+	amplitudes = numpy.sqrt(sini**2 + cosi**2)
+	phases = numpy.arctan2(cosi, sini)
+	normamplitudes = amplitudes[..., 1:] / amplitudes[..., :1, :1]
+	normphases = phases[..., 1:] - numpy.array(harmonics, dtype=float)[:, numpy.newaxis] * phases[..., :1, :1]
+	normphases = numpy.mod(normphases + numpy.pi, 2 * numpy.pi) - numpy.pi
+	return (amplitudes[..., 0, 0], normamplitudes, normphases)
+
+# Lock-in analysis of process_data_moreinfo on a channels x samples array <rawdata>, the first channel being the reference channel
+# Returns a dictionary of all intermediate and end results, keyed by the name of the DigitalLockin member without underscore
+# This is a module-level function so it can also run in another process (see digitallockinanalysis)
+def analyse_moreinfo(rawdata, F, Fs, fltord=0, RC=1/numpy.pi, poles=None):
+	r = {}
+	r['t'] = numpy.arange(len(rawdata[0]))*1./Fs
+	tsin = numpy.sin(2*numpy.pi*F*r['t'])
+	tcos = numpy.cos(2*numpy.pi*F*r['t'])
+	r['sinx'] = tsin * rawdata
+	r['cosx'] = tcos * rawdata
+	if poles is not None:
+		r['sinf'] = _cascade_filter(r['sinx'], poles)
+		r['cosf'] = _cascade_filter(r['cosx'], poles)
+	elif fltord == 0:
+		r['sinf'] = r['sinx']
+		r['cosf'] = r['cosx']
+	else:
+		alpha = 1 / (RC * Fs)
+		r['sinf'] = _filter(r['sinx'], [alpha]*fltord)
+		r['cosf'] = _filter(r['cosx'], [alpha]*fltord)
+	r['sini'] = _integrate(r['sinf'])
+	r['cosi'] = _integrate(r['cosf'])
+	r['amplitudes'] = numpy.sqrt(r['sini']**2 + r['cosi']**2)
+	r['phases'] = numpy.arctan2(r['cosi'], r['sini'])
+	r['normamplitudes_all'] = r['amplitudes'][1:] / r['amplitudes'][0]
+	r['normphases_all'] = numpy.mod(r['phases'][1:] - r['phases'][0] + numpy.pi, 2*numpy.pi) - numpy.pi
+	sampsperperiod = max(1, int(round(Fs / F)))
+	r['t_smp'] = r['t'][sampsperperiod-1::sampsperperiod]
+	r['normamplitudes_smp'] = r['normamplitudes_all'][:, sampsperperiod-1::sampsperperiod]
+	r['normphases_smp'] = r['normphases_all'][:, sampsperperiod-1::sampsperperiod]
+	r['normamplitudes'] = r['normamplitudes_all'][:, -1].copy()
+	r['normphases'] = r['normphases_all'][:, -1].copy()
+	r['gen_meas_amplitude'] = 2 * r['amplitudes'][0][-1] / float(len(r['t']))
+	return r
+
+# Least common multiple of the positive integers in <values>
+def _lcm(values):
+	result = 1
+	for v in values:
+		# Fraction reduces by the greatest common divisor
+		result *= fractions.Fraction(result, v).denominator
+	return result
+
+# Decorator for DigitalLockin methods which access the filter state or the hardware interface
+# Holds the lock of the object while the method runs, so they can be called from any thread
+def _locked(method):
+	@functools.wraps(method)
+	def locked_method(self, *args, **kwargs):
+		with self._lock:
+			return method(self, *args, **kwargs)
+	return locked_method
+
+class _SampleStore:
+	'''
+	Growable channels x samples array for raw data which is retrieved in chunks
+	Storage is allocated once (or doubled when it runs out) and reused after clear(),
+	so appending a chunk only copies that chunk instead of the whole record
+	'''
+
+	def __init__(self):
+		self._buf = numpy.zeros([0, 0])
+		self._n = 0
+
+	def __len__(self):
+		return self._n
+
+	def reserve(self, channels, capacity):
+		'''Make sure there is room for <capacity> samples of <channels> channels, discards stored samples if the number of channels changes'''
+		if self._buf.shape[0] != channels:
+			self._buf = numpy.zeros([channels, capacity])
+			self._n = 0
+		elif self._buf.shape[1] < capacity:
+			self._grow(capacity)
+
+	def _grow(self, capacity):
+		buf = numpy.zeros([self._buf.shape[0], capacity])
+		buf[:, :self._n] = self._buf[:, :self._n]
+		self._buf = buf
+
+	def clear(self):
+		'''Forget all stored samples but keep the allocated memory'''
+		self._n = 0
+
+	def append(self, data):
+		'''Append a channels x samples array, doubling the capacity if it does not fit'''
+		data = numpy.asarray(data)
+		if self._buf.shape[0] != data.shape[0]:
+			if self._n > 0:
+				raise RuntimeError('Cannot append data with {:d} channels to stored data with {:d} channels'.format(data.shape[0], self._buf.shape[0]))
+			self.reserve(data.shape[0], data.shape[1])
+		if self._n + data.shape[1] > self._buf.shape[1]:
+			self._grow(max(2 * self._buf.shape[1], self._n + data.shape[1]))
+		self._buf[:, self._n:self._n + data.shape[1]] = data
+		self._n += data.shape[1]
+
+	def view(self):
+		'''Get the stored samples as a channels x samples view, which is only valid until the next clear() or append()'''
+		return self._buf[:, :self._n]
+
+class _OscillatorTables:
+	'''
+	Reference oscillator tables for synchronous detection in chunks of at most <blocklen> samples
+	The oscillator tables have one row for each harmonic in <harmonics> of each reference
+	frequency in <freqs>, ordered by reference frequency and then by harmonic
+
+	If Fref/Fs is a fraction for every reference frequency and the least common multiple of
+	their denominators (i.e. the common oscillator period in samples) is at most
+	_OSC_TABLE_PERIOD_MAX, the tables contain the exact oscillator values for more than
+	a full period plus a chunk, so the oscillator of any chunk is a slice of the tables at an
+	integer sample index modulo the period. Otherwise the tables contain the oscillator for a
+	chunk starting at phase zero, which is rotated to the phase at the start of the chunk
+	'''
+
+	def __init__(self, freqs, Fs, harmonics, blocklen):
+		ratios = [fractions.Fraction(F) / fractions.Fraction(Fs) for F in freqs]
+		period = _lcm([ratio.denominator for ratio in ratios])
+		# Harmonic number and reference frequency index of every oscillator row
+		self._harmonics = numpy.tile(numpy.array(harmonics, dtype=numpy.int64), len(freqs))[:, numpy.newaxis]
+		self._refidx = numpy.repeat(numpy.arange(len(freqs)), len(harmonics))
+		if period <= _OSC_TABLE_PERIOD_MAX:
+			self.period = period
+			steps = numpy.array([ratio.numerator * (period // ratio.denominator) for ratio in ratios], dtype=numpy.int64)
+			phaseidx = (self._harmonics * steps[self._refidx, numpy.newaxis] * numpy.arange(self.period + blocklen, dtype=numpy.int64)) % self.period
+			phase = 2 * numpy.pi / self.period * phaseidx
+		else:
+			self.period = None
+			self.phasestep = 2 * numpy.pi * numpy.array(freqs, dtype=float) / Fs
+			phase = self.phasestep[self._refidx, numpy.newaxis] * self._harmonics * numpy.arange(blocklen)
+		self.sin = numpy.sin(phase)
+		self.cos = numpy.cos(phase)
+
+	def oscillator(self, phase, nsamples):
+		'''
+		Get sine and cosine for a chunk of <nsamples> samples starting at <phase>, and the phase after the chunk
+		For an exact oscillator period <phase> is an integer sample index, otherwise it is
+		the phase of the fundamental of every reference frequency in radians
+		The sine and cosine are (reference frequencies * harmonics) x samples arrays
+		'''
+		if self.period is not None:
+			return (self.sin[:, phase:phase+nsamples], self.cos[:, phase:phase+nsamples], (phase + nsamples) % self.period)
+		else:
+			phase = numpy.zeros(len(self.phasestep)) + phase
+			rowphase = self._harmonics * phase[self._refidx, numpy.newaxis]
+			sinphi = numpy.sin(rowphase)
+			cosphi = numpy.cos(rowphase)
+			sinosc = cosphi * self.sin[:, :nsamples] + sinphi * self.cos[:, :nsamples]
+			cososc = cosphi * self.cos[:, :nsamples] - sinphi * self.sin[:, :nsamples]
+			# This phase may drift over time due to rounding errors
+			# But that'll only affect the detected common mode phase which is arbitrary and rejected anyway
+			return (sinosc, cososc, numpy.mod(phase + self.phasestep * nsamples, 2 * numpy.pi))
+
+class _DemodulatorTables(_OscillatorTables):
+	'''
+	Reference oscillator and filter weight tables for continuous_retrieve_and_filter
+	All tables are valid for chunks of at most <blocklen> samples
+	The oscillator tables are those of _OscillatorTables
+
+	The filter weight table contains, for every filter stage, the contribution of a sample to
+	the output of that stage at the end of the chunk. The table is stored in reverse order, so
+	the weights for a chunk of length n are the last n rows
+	For a cascade of identical alpha filters with pole p = 1 - alpha and gain alpha, the weight
+	of a sample r samples before the end of the chunk at the output of stage k is
+		alpha^k * binomial(r+k-1, k-1) * p^r
+	which is calculated in the logarithmic domain, so it neither overflows nor loses precision
+	for long chunks. Weights that underflow are negligible anyway
+	'''
+
+	def __init__(self, freqs, Fs, tau, order, harmonics, blocklen):
+		_OscillatorTables.__init__(self, freqs, Fs, harmonics, blocklen)
+		if tau * Fs <= 1:
+			raise RuntimeError('Filter time constant {:g} s is not longer than one sample'.format(tau))
+		self.order = order
+		# ln(p) and ln(alpha)
+		self._lnpole = numpy.log(1 - 1. / tau / Fs)
+		self._lngain = - numpy.log(tau * Fs)
+		r = numpy.arange(blocklen - 1, -1, -1)
+		lnweights = numpy.empty([blocklen, order])
+		lnweights[:, 0] = r * self._lnpole + self._lngain
+		for k in range(1, order):
+			# Multiply by alpha and by binomial(r+k, k) / binomial(r+k-1, k-1) = (r+k) / k
+			lnweights[:, k] = lnweights[:, k-1] + self._lngain + numpy.log((r + k) / float(k))
+		self.weights = numpy.exp(lnweights)
+		self._transitions = {}
+
+	def transition(self, nsamples):
+		'''
+		Get the matrix which maps the filter stage outputs before a chunk of <nsamples> samples to
+		their contribution to the filter stage outputs after the chunk
+		Stage j contributes alpha^(k-j) * binomial(n+k-j-1, k-j) * p^n to stage k >= j
+		'''
+		try:
+			return self._transitions[nsamples]
+		except KeyError:
+			pass
+		transition = numpy.zeros([self.order, self.order])
+		if nsamples == 0:
+			return numpy.identity(self.order)
+		lnbinom = 0.
+		for d in range(self.order):
+			if d > 0:
+				lnbinom += numpy.log((nsamples - 1. + d) / d)
+			value = numpy.exp(d * self._lngain + lnbinom + nsamples * self._lnpole)
+			for j in range(self.order - d):
+				transition[j+d, j] = value
+		if len(self._transitions) < _TRANSITION_CACHE_ENTRIES:
+			self._transitions[nsamples] = transition
+		return transition
+
+class _DemodulatorCache:
+	'''
+	Least-recently-used cache of _DemodulatorTables, keyed by reference frequencies, sample frequency,
+	filter time constant, filter order, harmonics and chunk length
+	Without a filter time constant the cache holds _OscillatorTables instead
+	Chunk lengths are rounded up to a power of two, so chunks of similar length share tables
+	'''
+
+	def __init__(self, maxentries=_DEMODULATOR_CACHE_ENTRIES):
+		self._maxentries = maxentries
+		self._entries = collections.OrderedDict()
+
+	def get(self, freqs, Fs, tau, order, harmonics, nsamples):
+		'''Get the tables for chunks of <nsamples> samples, calculating them if they are not cached, <tau> None for only the oscillator'''
+		blocklen = 1 << int(max(nsamples - 1, 0)).bit_length()
+		key = (tuple(freqs), Fs, tau, order, tuple(harmonics), blocklen)
+		try:
+			tables = self._entries.pop(key)
+		except KeyError:
+			if tau is None:
+				tables = _OscillatorTables(freqs, Fs, harmonics, blocklen)
+			else:
+				tables = _DemodulatorTables(freqs, Fs, tau, order, harmonics, blocklen)
+			while len(self._entries) >= self._maxentries:
+				self._entries.popitem(last=False)
+		self._entries[key] = tables
+		return tables
+
+	def clear(self):
+		self._entries.clear()
 
 class DigitalLockin:
 	'''
@@ -92,16 +399,23 @@ class DigitalLockin:
 	Can initialise hardware, run measurements, process data and make some plots
 
 	This class is also capable of running a simulated measurement with Gaussian noise
-	In this case it always generates a sine wave of amplitude 1
-	The amplitude argument to the constructor is then interpreted as the noise sigma
-	It also generates only one output channel regardless of the number of specified channels
+	In this case it uses a SimulatedHardwareInterface which starts with a sine wave of amplitude 1
+	The amplitude argument to the constructor is then interpreted as the noise sigma, set(A=...) sets the amplitude
+	The simulated hardware produces samples in real time, so continuous mode works in simulation too
+	With a ReplayHardwareInterface (see the replay argument) it runs on a recording made with
+	start_recording instead, through the same processing as live data. It then retunes wherever the
+	frequency of the recording changes and resets the filter at gaps of the recording
+
+	Methods which access the filter state or the hardware interface hold a lock of the object, so
+	the continuous lock-in can be driven by its own acquisition thread (see start_acquisition_thread)
+	while other threads change settings and read results
 	'''
 
 	################################################
 	##### Initialization and closing functions #####
 	################################################
 	
-	def __init__(self, gen_dev='PXI5412_12', meas_dev='PXI4462_3', gen_ch='0', gen_meas_ch='ai0', meas_ch='ai1', Fs=MAX_SAMPLE_FREQUENCY, Fsignal=MAX_SAMPLE_FREQUENCY*101./20201, gen_amplitude=1, gen_output_impedance=50, simulated=False):
+	def __init__(self, gen_dev='PXI5412_12', meas_dev='PXI4462_3', gen_ch='0', gen_meas_ch='ai0', meas_ch='ai1', Fs=MAX_SAMPLE_FREQUENCY, Fsignal=MAX_SAMPLE_FREQUENCY*101./20201, gen_amplitude=1, gen_output_impedance=50, simulated=False, replay=None, replay_speed=1.):
 		'''
 		The constructor
 
@@ -124,7 +438,6 @@ class DigitalLockin:
 					'ai1'            (Single channel, value notation)
 					['ai1']          (Single channel, list notation)
 					['ai1', 'ai2']   (Multiple channels)
-				This argument is ignored in simulation mode
 			Fs                   : float   [Default: 204800]
 				Sample frequency of the signal analyser in Hz
 			Fsignal              : float   [Default: 1000]
@@ -137,30 +450,47 @@ class DigitalLockin:
 				This argument is ignored in simulation mode
 			simulated            : boolean [Default: False]
 				True for simulation mode, False for measurement mode
+			replay               : string  [Default: None]
+				Path of a recording (see start_recording) to replay instead of measuring
+				The sample frequency, signal frequency, amplitude and channels are then those of the recording
+				and all other arguments are ignored, set_channels selects from the recorded channels
+			replay_speed         : float   [Default: 1]
+				Speed at which the recording is replayed relative to real time, 0 for as fast as possible
 		'''
 		self._simulated = simulated
 		self._is_measuring = False
+		self._lock = threading.RLock()
+		self._acquisition_thread = None
+		self._acquisition_stop = threading.Event()
 		self.gen_dev_str = gen_dev # Not gonna make a getter and setter for a variable which isn't internally used
 		self.meas_dev_str = meas_dev # Not gonna make a getter and setter for a variable which isn't internally used
+		self._demodulator_cache = _DemodulatorCache()
+		self._flt_order = 2
+		self._harmonics = [1]
+		self._extra_frequencies = []
+		self._output_rate = 0.
+		self._output_decimation = 0
+		self._output_buffer = collections.deque(maxlen=OUTPUT_BUFFER_LEN_MAX)
+		self._samples_processed = 0
+		self._samples_since_output = 0
+		self._recorder = None
 		self.free_data()
 		self.set_flt_time_constant()
-		if simulated:
-			self._simulation_noise_amplitude = gen_amplitude
-			self._hw = None
-			self._fs = Fs
-			self._f = Fsignal
+		self._replay = replay is not None
+		if replay is not None:
+			self._hw = replayhwi.ReplayHardwareInterface(replay, speed=replay_speed)
+			self._extra_frequencies = self._hw.get_external_frequencies()
+		elif simulated:
+			self._hw = simhwi.SimulatedHardwareInterface(gen_dev=gen_dev, meas_dev=meas_dev, gen_ch=gen_ch, meas_ch=meas_ch, Fs=Fs, Fsignal=Fsignal, gen_amplitude=1, noise_amplitude=gen_amplitude)
 		elif CAN_MEASURE:
 			self._hw = hwi.MeasurementHardwareInterface(gen_dev=gen_dev, meas_dev=meas_dev, gen_ch=gen_ch, meas_ch=meas_ch, Fs=Fs, Fsignal=Fsignal, gen_amplitude=gen_amplitude, gen_output_impedance=gen_output_impedance)
-			self._simulation_noise_amplitude = None
-			self._fs = self._hw.get_meas_sample_frequency()
-			self._f = self._hw.get_gen_signal_frequency()
-			self._x1 = numpy.zeros(len(self._hw.get_measurement_channels()) + 1)
-			self._y1 = numpy.zeros(len(self._hw.get_measurement_channels()) + 1)
-			self._x2 = numpy.zeros(len(self._hw.get_measurement_channels()) + 1)
-			self._y2 = numpy.zeros(len(self._hw.get_measurement_channels()) + 1)
 		else:
 			raise RuntimeError('Cannot load hardware interface module so cannot initialise in measurement mode')
+		self._fs = self._hw.get_meas_sample_frequency()
+		self._f = self._hw.get_gen_signal_frequency()
+		self._check_flt_state()
 
+	@_locked
 	def close_hardware(self):
 		'''Close hardware tasks and sessions and release their handles'''
 		if self._hw is not None:
@@ -172,6 +502,7 @@ class DigitalLockin:
 		! This cannot be undone !
 		'''
 		self._rawdata = None
+		self._samplestore = _SampleStore()
 
 	def free_intermediate_calc_results(self):
 		'''Erase intermediate data processing results and free the memory it used'''
@@ -192,6 +523,9 @@ class DigitalLockin:
 		self.free_intermediate_calc_results()
 		self._normamplitudes = None
 		self._normphases = None
+		self._harmonic_amplitudes = None
+		self._harmonic_phases = None
+		self._ref_meas_amplitudes = None
 		self._gen_meas_amplitude = None
 
 	def free_data(self):
@@ -201,11 +535,10 @@ class DigitalLockin:
 		'''
 		self.free_rawdata()
 		self.free_calcdata()
-		self._x1 = 0.
-		self._y1 = 0.
-		self._x2 = 0.
-		self._y2 = 0.
+		self._flt_x = None
+		self._flt_y = None
 		self._phi = 0.
+		self._phase_idx = 0
 
 	def close(self):
 		'''
@@ -213,6 +546,9 @@ class DigitalLockin:
 		This includes used memory as well as hardware tasks and sessions
 		! This cannot be undone !
 		'''
+		self.stop_acquisition_thread()
+		if self._recorder is not None:
+			self.stop_recording()
 		self.close_hardware()
 		self.free_data()
 
@@ -220,43 +556,74 @@ class DigitalLockin:
 	##### Universal setter #####
 	############################
 	
+	@_locked
 	def set(self, F=None, A=None, Fs=None):
 		'''Universal setter for signal frequency <F>, sample frequency <Fs> and signal amplitude <A>'''
 		if F is not None:
-			if self._simulated:
-				self._f = F
-			else:
-				try:
-					self._hw.set_gen_signal_frequency(F)
-				except RuntimeWarning as w:
-					logging.warning(str(w))
-				self._f = self._hw.get_gen_signal_frequency()
+			try:
+				self._hw.set_gen_signal_frequency(F)
+			except RuntimeWarning as w:
+				logging.warning(str(w))
+			self._f = self._hw.get_gen_signal_frequency()
 		if A is not None:
-			if not self._simulated:
-				try:
-					self._hw.set_gen_signal_amplitude(A)
-				except RuntimeWarning as w:
-					logging.warning(str(w))
+			try:
+				self._hw.set_gen_signal_amplitude(A)
+			except RuntimeWarning as w:
+				logging.warning(str(w))
 		if Fs is not None:
-			if self._simulated:
-				self._fs = Fs
-			else:
-				self._hw.set_meas_sample_frequency(Fs)
-				self._fs = self._hw.get_meas_sample_frequency()
+			if self._recorder is not None:
+				raise RuntimeError('Cannot change the sample frequency while recording')
+			self._hw.set_meas_sample_frequency(Fs)
+			self._fs = self._hw.get_meas_sample_frequency()
+			self._update_output_decimation()
 	
+	@_locked
 	def set_channels(self, meas_ch=None, gen_meas_ch=None, gen_ch=None):
 		'''Set measurement channels <meas_ch>, generated signal measurement channel <gen_meas_ch> and/or generator channel <gen_ch>'''
+		if self._recorder is not None and (meas_ch is not None or gen_meas_ch is not None):
+			raise RuntimeError('Cannot change the measurement channels while recording')
 		if meas_ch is not None:
 			self._hw.set_meas_channels(meas_ch)
-			self._x1 = numpy.zeros(len(self._hw.get_measurement_channels()) + 1)
-			self._y1 = numpy.zeros(len(self._hw.get_measurement_channels()) + 1)
-			self._x2= numpy.zeros(len(self._hw.get_measurement_channels()) + 1)
-			self._y2 = numpy.zeros(len(self._hw.get_measurement_channels()) + 1)
+			self._check_flt_state()
 		if gen_meas_ch is not None:
 			self._hw.set_gen_meas_channel(gen_meas_ch)
 		if gen_ch is not None:
 			self._hw.set_gen_channel(gen_ch)
-	
+
+	@_locked
+	def retune(self, F):
+		'''
+		Set the signal frequency to <F>, also while measuring in continuous mode
+		Samples which were measured before retuning are still filtered at the old frequency,
+		then the generator is retuned without stopping the measurement and the filter is reset
+		The filter output needs a few time constants to settle after this
+		'''
+		if self._is_measuring:
+			self.continuous_retrieve_and_filter()
+			self._hw.retune_gen_signal_frequency(F)
+		else:
+			self._hw.set_gen_signal_frequency(F)
+		self._f = self._hw.get_gen_signal_frequency()
+		self._reset_filter()
+
+	def _reset_filter(self):
+		'''Start the continuous filter and reference oscillator over'''
+		self._flt_x = None
+		self._phi = 0.
+		self._phase_idx = 0
+		self._check_flt_state()
+
+	def _follow_replay(self):
+		'''
+		Follow the recording which is replayed: when its signal frequency changes, retune to it,
+		and when it has a gap, reset the filter (see ReplayHardwareInterface.take_discontinuity)
+		'''
+		F = self._hw.get_gen_signal_frequency()
+		discontinuity = self._hw.take_discontinuity()
+		if F != self._f or discontinuity:
+			self._f = F
+			self._reset_filter()
+
 	###################
 	##### Getters #####
 	###################
@@ -271,10 +638,7 @@ class DigitalLockin:
 
 	def get_gen_amplitude(self):
 		'''Get generated signal amplitude'''
-		if self._simulated:
-			return 1
-		else:
-			return self._hw.get_gen_signal_amplitude()
+		return self._hw.get_gen_signal_amplitude()
 	
 	def get_num_meas_ch(self):
 		'''Get number of measurement channels (excluding the one for the generated signal)'''
@@ -286,56 +650,56 @@ class DigitalLockin:
 	
 	def run_measurement(self, periods):
 		'''
-		In measurement mode:
-			Start the signal generators,
-			run a measurement for <periods> signal periods and save the raw data,
-			then stop the signal generators again
-		In simulation mode:
-			Save a perfect sine as input signal
-			Add gaussian noise to that sine and save it as output signal
+		Start the signal generators,
+		run a measurement for <periods> signal periods and save the raw data,
+		then stop the signal generators again
+		In simulation mode the input signal is a perfect sine and the output signals have gaussian noise added
 		'''
-		if self._simulated:
-			num_samples = int(round(periods * self._fs / self._f))
-			t = numpy.array(range(num_samples)) * 1. / self._fs
-			sig_in = numpy.sin(2 * numpy.pi * self._f * t)
-			sig_out = sig_in + _gaussiannoise(self._simulation_noise_amplitude, num_samples)
-			self._rawdata = numpy.array([sig_in, sig_out])
-		else:
-			self._hw.start_generation()
-			self._rawdata = self._hw.measure_periods(periods)
-			self._hw.stop_generation()
+		self._hw.start_generation()
+		self._rawdata = self._hw.measure_periods(periods)
+		self._hw.stop_generation()
 
+	@_locked
 	def start_measurement(self, bufsize=409600):
 		'''
 		Start the waveform generators and inform the signal analysers to collect samples
 		Do not retrieve any measured samples to the pc yet
-		In simulation mode this sets a boolean to allow acquiring samples
 		'''
 		if self._is_measuring:
 			raise RuntimeWarning('Already measuring')
 		else:
 			self._is_measuring = True
-			if not self._simulated:
-				self._hw.start_generation()
-				self._hw.start_measurement(bufsize=bufsize)
+			self._samples_processed = 0
+			self._samples_since_output = 0
+			self._output_buffer.clear()
+			self._hw.start_generation()
+			self._hw.start_measurement(bufsize=bufsize)
+			if self._replay:
+				self._follow_replay()
 
+	@_locked
 	def retrieve_samples(self, samples, append=False):
-		'''Retrieve <samples> samples if the device is currently measuring'''
+		'''
+		Retrieve <samples> samples if the device is currently measuring
+		The samples are stored in preallocated memory, which is reused when <append> is False
+		'''
 		if self._is_measuring:
-			if self._simulated:
-				t = numpy.array(range(samples)) / float(self._fs)
-				sig_in = numpy.sin(2 * numpy.pi * self._f * t)
-				sig_out = sig_in + _gaussiannoise(self._simulation_noise_amplitude, samples)
-				rawdata = numpy.array([sig_in, sig_out])
-			else:
-				rawdata = self._hw.retrieve_samples(samples)
-			if append:
-				self._rawdata = numpy.append(self._rawdata, rawdata, 1)
-			else:
-				self._rawdata = rawdata
+			if self._replay:
+				self._follow_replay()
+			rawdata = self._hw.retrieve_samples(samples)
+			if self._recorder is not None:
+				self._recorder.append(rawdata, self._f)
+			if not append:
+				self._samplestore.clear()
+			self._samplestore.append(rawdata)
+			self._rawdata = self._samplestore.view()
 		else:
 			raise RuntimeWarning('Tried to retrieve %d samples from non-measuring device', samples)
 
+	def reserve_rawdata_seconds(self, seconds):
+		'''Preallocate memory for retrieving <seconds> seconds worth of samples in multiple chunks with append=True'''
+		self._samplestore.reserve(len(self._hw.get_measurement_channels()) + 1, int(numpy.ceil((seconds + 1. / self._f) * self._fs)))
+
 	def retrieve_periods(self, periods, append=False):
 		'''Retrieve <periods> signal periods worth of samples if the device is currently measuring'''
 		self.retrieve_samples(int(round(float(self._fs) / self._f * periods)), append)
@@ -348,12 +712,12 @@ class DigitalLockin:
 		self.retrieve_periods(round(self._f * seconds), append)
 		return round(round(self._f * seconds) * self._fs / self._f) / self._fs
 
+	@_locked
 	def stop_measurement(self):
 		'''Stop the collection of samples and the waveform generators'''
 		if self._is_measuring:
-			if not self._simulated:
-				self._hw.end_measurement()
-				self._hw.stop_generation()
+			self._hw.end_measurement()
+			self._hw.stop_generation()
 			self._is_measuring = False
 		else:
 			raise RuntimeWarning('Tried stopping device from measuring but it already wasn\'t')
@@ -361,12 +725,38 @@ class DigitalLockin:
 	def is_measuring(self):
 		return self._is_measuring
 	
+	@_locked
+	def start_recording(self, path):
+		'''
+		Record every block of raw data which is retrieved from now on to .npy file <path>,
+		with a metadata sidecar next to it (see digitallockinrecorder.RawDataRecorder)
+		The blocks are written by a separate thread, so recording does not slow down acquisition
+		'''
+		if self._recorder is not None:
+			raise RuntimeWarning('Already recording to {:s}'.format(self._recorder.get_path()))
+		channels = [self._hw.get_generated_signal_measurement_channel()] + list(self._hw.get_measurement_channels())
+		metadata = {'F': self._f, 'amplitude': self.get_gen_amplitude(), 'harmonics': self.get_harmonics(),
+				'extra_frequencies': self.get_extra_frequencies(), 'simulated': self._simulated, 'meas_dev': self.meas_dev_str}
+		self._recorder = recorder.RawDataRecorder(path, self._fs, channels, metadata)
+	
+	@_locked
+	def stop_recording(self):
+		'''Stop recording raw data, returns the number of recorded samples'''
+		if self._recorder is None:
+			raise RuntimeWarning('Tried to stop recording but was not recording')
+		(rec, self._recorder) = (self._recorder, None)
+		return rec.stop()
+	
+	def is_recording(self):
+		return self._recorder is not None
+	
+	@_locked
 	def num_measured_samples_in_instrument_buffer(self):
 		'''
 		Find out how many samples are left in the instrument's sample buffer.
-		Returns None on failure and 0 during simulation or when not measuring.
+		Returns None on failure and 0 when not measuring.
 		'''
-		if self._is_measuring and not self._simulated:
+		if self._is_measuring:
 			return self._hw.measured_samples_in_instrument_buffer()
 		else:
 			return 0
@@ -375,14 +765,17 @@ class DigitalLockin:
 	##### Measure and filter function for continuous lock-in #####
 	##############################################################
 	
+	@_locked
 	def continuous_retrieve_and_filter(self):
 		'''
 		Retrieve all samples in instrument buffer if the device is currently measuring
-		Apply synchronous detection (i.e. multiply with a sine and cosine)
-		Filter the result with a second-order filter (two cascaded normalising alpha filters)
-		Higher-order filters may be implementable in the future, but it is not
-		trivial because the optimized numpy implementation requires that the samples
-		be processed in bulk and only the last sample of the filter output is calculated
+		Apply synchronous detection (i.e. multiply with a sine and cosine) at every harmonic (see set_harmonics)
+		of every reference frequency (see set_extra_frequencies)
+		Filter the result with an N-th order filter (N cascaded normalising alpha filters, see set_flt_order)
+		The samples are processed in bulk and only the last sample of each filter stage
+		output is calculated, which is the filter state for the next call:
+			state = transition * state + synchronously detected samples * weights
+		The oscillator, weights and transition matrix are taken from a cache (see _DemodulatorTables)
 		
 		Each normalising alpha filter works like:
 		
@@ -394,96 +787,333 @@ class DigitalLockin:
 		                              \----| alpha |<---/
 		                                   \-------/
 		'''
-		if self._is_measuring and not self._simulated:
-			# Calculate -ln(alpha) and -ln(1-alpha)
-			mlnalpha = - numpy.log(1 - 1. / self._flt_tau / self._fs)
-			mlnialpha = numpy.log(self._flt_tau * self._fs)
-			
+		if self._is_measuring:
 			# Acquire samples
 			rawdata = self._hw.retrieve_samples(-1, .1, True)
-			channels = rawdata.shape[0]
 			samples = rawdata.shape[1]
+			if self._recorder is not None:
+				self._recorder.append(rawdata, self._f)
 			
-			# Calculate phases for synchronous detection
-			multfac = 2 * numpy.pi * self._f / self._fs
-			phi = numpy.arange(self._phi, self._phi + multfac * (samples-0.5), multfac)
-			# The following phase expression may drift over time due to rounding errors
-			# But that'll only affect the detected common mode phase which is arbitrary and rejected anyway
-			self._phi = numpy.mod(self._phi + 2 * numpy.pi * self._f / self._fs * samples, 2 * numpy.pi)
+			# Get oscillator and filter weights for synchronous detection from the cache
+			tables = self._demodulator_cache.get(self.get_frequencies(), self._fs, self._flt_tau, self._flt_order, self._harmonics, samples)
+			if tables.period is not None:
+				(sinosc, cososc, self._phase_idx) = tables.oscillator(self._phase_idx % tables.period, samples)
+			else:
+				(sinosc, cososc, self._phi) = tables.oscillator(self._phi, samples)
 			
-			# Calculate multiplication factors for filters
-			# Sample to output of first filter
-			flt1weight = numpy.exp(numpy.arange(-(samples-1) * mlnalpha - mlnialpha, mlnalpha/2 - mlnialpha, mlnalpha))
-			# initvalmulfac1*Sample to output of second filter
-			flt2weightr = numpy.repeat((numpy.exp(-mlnialpha) * numpy.arange(samples, 0.5, -1)).reshape([1,samples]), channels, axis=0)
-			# Initial value to output of the same alpha filter
-			initvalmulfac1 = numpy.exp(- mlnalpha * samples)
-			# Initial value to output of next alpha filter
-			initvalmulfac2 = samples * numpy.exp(- mlnalpha * samples - mlnialpha)
+			# Perform synchronous detection for all reference frequencies and harmonics at once
+			# Rows are ordered by reference frequency, then by harmonic and then by channel
+			self._check_flt_state()
+			rows = sinosc.shape[0] * rawdata.shape[0]
+			detsin = (sinosc[:, numpy.newaxis, :] * rawdata).reshape([rows, samples])
+			detcos = (cososc[:, numpy.newaxis, :] * rawdata).reshape([rows, samples])
 			
-			# Perform synchronous detection and filtering
-			f1sin = rawdata * numpy.repeat((numpy.sin(phi) * flt1weight).reshape([1,samples]), channels, axis=0)
-			f1cos = rawdata * numpy.repeat((numpy.cos(phi) * flt1weight).reshape([1,samples]), channels, axis=0)
-			f2sin = f1sin * flt2weightr
-			f2cos = f1cos * flt2weightr
-			self._x2 = initvalmulfac1 * self._x2 + initvalmulfac2 * self._x1 + f2sin.sum(axis=1)
-			self._y2 = initvalmulfac1 * self._y2 + initvalmulfac2 * self._y1 + f2cos.sum(axis=1)
-			self._x1 = initvalmulfac1 * self._x1 + f1sin.sum(axis=1)
-			self._y1 = initvalmulfac1 * self._y1 + f1cos.sum(axis=1)
-		elif self._is_measuring:
-			raise RuntimeError('Continuous running mode not supported for simulation')
+			# Perform filtering
+			if self._output_decimation:
+				self._continuous_filter_decimated(detsin, detcos, tables)
+			else:
+				self._continuous_filter(detsin, detcos, tables)
+			self._samples_processed += samples
+			if self._replay:
+				self._follow_replay()
 		else:
 			raise RuntimeWarning('Tried to retrieve samples from non-measuring device')
 	
+	def start_acquisition_thread(self, interval=ACQUISITION_INTERVAL_DEFAULT):
+		'''
+		Start a thread which calls continuous_retrieve_and_filter every <interval> seconds while measuring
+		Filter outputs at the output rate (see set_output_rate) are then collected with continuous_pop_output
+		'''
+		if self._acquisition_thread is not None:
+			raise RuntimeWarning('Acquisition thread is already running')
+		self._acquisition_stop.clear()
+		self._acquisition_thread = threading.Thread(target=self._acquisition_loop, args=(interval,), name='DigitalLockin acquisition ({:s})'.format(self.meas_dev_str))
+		self._acquisition_thread.daemon = True
+		self._acquisition_thread.start()
+	
+	def stop_acquisition_thread(self):
+		'''Stop the acquisition thread if it is running and wait for it to finish'''
+		if self._acquisition_thread is not None:
+			self._acquisition_stop.set()
+			self._acquisition_thread.join()
+			self._acquisition_thread = None
+	
+	def hold(self):
+		'''
+		Keep the acquisition thread from changing the results until release() is called,
+		so that several getters return results of the same moment
+		Must be released by the same thread, and before stop_acquisition_thread() or close()
+		'''
+		self._lock.acquire()
+	
+	def release(self):
+		'''Let the acquisition thread continue after hold()'''
+		self._lock.release()
+	
+	def _acquisition_loop(self, interval):
+		'''Main function of the acquisition thread'''
+		while not self._acquisition_stop.is_set():
+			try:
+				with self._lock:
+					if self._is_measuring:
+						self.continuous_retrieve_and_filter()
+			except Exception:
+				logging.exception('Acquisition thread of {:s} failed to retrieve and filter samples:'.format(self.meas_dev_str))
+			self._acquisition_stop.wait(interval)
+	
+	def _continuous_filter(self, detsin, detcos, tables):
+		'''Update the filter state with synchronously detected samples <detsin> and <detcos>'''
+		samples = detsin.shape[1]
+		weights = tables.weights[len(tables.weights)-samples:]
+		transition = tables.transition(samples)
+		self._flt_x = numpy.dot(transition, self._flt_x) + numpy.dot(detsin, weights).T
+		self._flt_y = numpy.dot(transition, self._flt_y) + numpy.dot(detcos, weights).T
+	
+	def _continuous_filter_decimated(self, detsin, detcos, tables):
+		'''
+		Update the filter state with synchronously detected samples <detsin> and <detcos>
+		Also store the filter output every <self._output_decimation> samples in the output buffer
+		The chunk is split at the output samples, all whole decimation intervals are filtered in one matrix product
+		'''
+		decim = self._output_decimation
+		samples = detsin.shape[1]
+		first = decim - self._samples_since_output
+		self._samples_since_output = (self._samples_since_output + samples) % decim
+		if first > samples:
+			self._continuous_filter(detsin, detcos, tables)
+			return
+		self._continuous_filter(detsin[:, :first], detcos[:, :first], tables)
+		self._store_output(self._samples_processed + first)
+		# Whole decimation intervals
+		intervals = (samples - first) // decim
+		end = first + intervals * decim
+		if intervals:
+			weights = tables.weights[len(tables.weights)-decim:]
+			transition = tables.transition(decim)
+			channels = detsin.shape[0]
+			fsin = numpy.dot(detsin[:, first:end].reshape([channels, intervals, decim]), weights)
+			fcos = numpy.dot(detcos[:, first:end].reshape([channels, intervals, decim]), weights)
+			for i in range(intervals):
+				self._flt_x = numpy.dot(transition, self._flt_x) + fsin[:, i, :].T
+				self._flt_y = numpy.dot(transition, self._flt_y) + fcos[:, i, :].T
+				self._store_output(self._samples_processed + first + (i+1) * decim)
+		# Remainder
+		self._continuous_filter(detsin[:, end:], detcos[:, end:], tables)
+	
+	def _store_output(self, sample):
+		'''Store the output of the last filter stage, with the time of sample number <sample> since the start of the measurement'''
+		self._output_buffer.append((float(sample) / self._fs, self._flt_x[-1].copy(), self._flt_y[-1].copy()))
+	
+	@_locked
+	def set_output_rate(self, rate):
+		'''
+		Set the rate in Hz at which the continuous lock-in stores its filter output, 0 to disable
+		The rate is rounded to an integer division of the sample frequency, also when that changes
+		'''
+		self._output_rate = float(rate)
+		self._update_output_decimation()
+	
+	def _update_output_decimation(self):
+		'''Round the requested output rate to an integer division of the current sample frequency'''
+		if self._output_rate > 0:
+			self._output_decimation = max(1, int(round(self._fs / self._output_rate)))
+		else:
+			self._output_decimation = 0
+		self._samples_since_output = 0
+	
+	def get_output_rate(self):
+		'''Get the rate in Hz at which the continuous lock-in stores its filter output, 0 if disabled'''
+		if self._output_decimation:
+			return float(self._fs) / self._output_decimation
+		else:
+			return 0.
+	
+	@_locked
+	def continuous_pop_output(self):
+		'''
+		Get and remove all stored filter outputs of the continuous lock-in (see set_output_rate)
+		Returns (t, ref_amplitude, r, phi) where each row of r and phi corresponds to one element of t
+		t is the time in seconds since the start of the measurement
+		r and phi are normalised to the reference channel like in process_data
+		'''
+		outputs = [self._output_buffer.popleft() for i in range(len(self._output_buffer))]
+		channels = len(self._hw.get_measurement_channels())
+		if len(outputs) == 0:
+			return (numpy.zeros(0), numpy.zeros(0), numpy.zeros([0, channels]), numpy.zeros([0, channels]))
+		t = numpy.array([o[0] for o in outputs])
+		x = numpy.array([o[1][:channels+1] for o in outputs])
+		y = numpy.array([o[2][:channels+1] for o in outputs])
+		amplitudes = numpy.sqrt(x**2 + y**2)
+		phases = numpy.arctan2(y, x)
+		r = amplitudes[:, 1:] / amplitudes[:, :1]
+		phi = numpy.mod(phases[:, 1:] - phases[:, :1] + numpy.pi, 2 * numpy.pi) - numpy.pi
+		return (t, 2 * amplitudes[:, 0], r, phi)
+	
+	@_locked
 	def continuous_get_r_phi(self):
-		#r = numpy.sqrt(numpy.append(self._x1, self._x2 / (2*self._flt_tau * self._fs)**2)**2 + numpy.append(self._y1, self._y2 / (2*self._flt_tau * self._fs)**2)**2)
-		r = numpy.sqrt(numpy.append(self._x1, self._x2)**2 + numpy.append(self._y1, self._y2)**2)
-		#r = numpy.sqrt(self._x2**2 + self._y2**2)
+		'''
+		Get amplitudes and phases of the first-order and the final filter output at the signal frequency
+		Both are normalised to the reference channel at the same filter output
+		'''
+		self._check_flt_state()
+		channels = len(self._hw.get_measurement_channels()) + 1
+		(x1, y1, x2, y2) = (self._flt_x[0, :channels], self._flt_y[0, :channels], self._flt_x[-1, :channels], self._flt_y[-1, :channels])
+		r = numpy.sqrt(numpy.append(x1, x2)**2 + numpy.append(y1, y2)**2)
 		#r[1:] /= r[0]
 		r[1:int(len(r)/2)] /= r[0]
 		r[int(len(r)/2)+1:] /= r[int(len(r)/2)]
 		#r[0] /= self._flt_tau * self._fs / 2
 		r[0::int(len(r)/2)] *= 2
-		#phi = numpy.arctan2(self._y2, self._x2)
-		phi = numpy.arctan2(numpy.append(self._y1, self._y2), numpy.append(self._x1, self._x2))
+		phi = numpy.arctan2(numpy.append(y1, y2), numpy.append(x1, x2))
 		phi = numpy.mod(phi[1:] - phi[0] + numpy.pi, 2 * numpy.pi) - numpy.pi
 		phi[int(len(r)/2):] -= phi[int(len(r)/2) - 1]
 		return (r, phi)
 	
+	@_locked
 	def set_flt_alpha(self, alpha=0.9):
 		self._flt_tau = 1. / self._fs / (1 -alpha)
 	
+	@_locked
 	def set_flt_time_constant(self, tau=0.1):
 		self._flt_tau = tau
 	
+	@_locked
+	def set_flt_order(self, order=2):
+		'''Set the number of cascaded alpha filters of the continuous lock-in (6 dB/octave rolloff each), this resets the filter'''
+		if order < 1:
+			raise RuntimeError('Filter order must be at least 1, tried {:d}'.format(order))
+		self._flt_order = order
+		self._reset_filter()
+	
+	def get_flt_order(self):
+		'''Get the number of cascaded alpha filters of the continuous lock-in'''
+		return self._flt_order
+	
+	@_locked
+	def set_harmonics(self, harmonics=[1]):
+		'''
+		Set the harmonics of the signal frequency at which to demodulate, for example [1, 2, 3]
+		The fundamental is always demodulated because it is needed for normalisation, this resets the continuous lock-in filter
+		'''
+		harmonics = [int(h) for h in harmonics]
+		if min(harmonics) < 1:
+			raise RuntimeError('Harmonics must be positive integers, tried {:s}'.format(str(harmonics)))
+		self._harmonics = [1] + sorted(set(harmonics) - set([1]))
+		self.free_calcdata()
+		self._check_flt_state()
+	
+	def get_harmonics(self):
+		'''Get the harmonics of the signal frequency at which is demodulated'''
+		return list(self._harmonics)
+	
+	@_locked
+	def set_extra_frequencies(self, freqs=[]):
+		'''
+		Set reference frequencies at which to demodulate in addition to the signal frequency, for example [1300., 1700.]
+		The reference channel must carry a sine wave at each of these frequencies, for example from
+		other generators whose outputs are summed externally or from additional generator channels
+		All reference frequencies are demodulated from the same samples in one matrix product, and each
+		of them is normalised to its own component on the reference channel, so this measures
+		several transfers at once on one signal analyser
+		In simulation mode the simulated hardware adds these frequencies to the generated signal
+		This resets the continuous lock-in filter
+		'''
+		freqs = [float(f) for f in freqs]
+		if len(freqs) > 0 and min(freqs) <= 0:
+			raise RuntimeError('Reference frequencies must be positive, tried {:s}'.format(str(freqs)))
+		self._extra_frequencies = freqs
+		if self._simulated:
+			self._hw.set_external_frequencies(freqs)
+		self._phi = 0.
+		self.free_calcdata()
+		self._check_flt_state()
+	
+	def get_extra_frequencies(self):
+		'''Get the reference frequencies at which is demodulated in addition to the signal frequency'''
+		return list(self._extra_frequencies)
+	
+	def get_frequencies(self):
+		'''Get all reference frequencies at which is demodulated, the first one being the signal frequency'''
+		return [self._f] + self._extra_frequencies
+	
+	@_locked
+	def get_harmonic_results(self, harmonic=1, ref=1):
+		'''
+		Get the reference amplitude and the normalised amplitudes and phases at harmonic <harmonic>
+		of reference frequency number <ref> (the signal frequency being number 1, see set_extra_frequencies)
+		Phases are relative to <harmonic> times the reference phase
+		Uses the final filter output of the continuous lock-in if it is running, the last process_data() results otherwise
+		'''
+		try:
+			h = self._harmonics.index(harmonic)
+		except ValueError:
+			raise RuntimeError('Not demodulating at harmonic {:d}, harmonics are {:s}'.format(harmonic, str(self._harmonics)))
+		if ref < 1 or ref > len(self._extra_frequencies) + 1:
+			raise RuntimeError('Reference frequency {:d} does not exist, there are {:d}'.format(ref, len(self._extra_frequencies) + 1))
+		if self._is_measuring and self._samples_processed > 0:
+			self._check_flt_state()
+			shape = [len(self._extra_frequencies) + 1, len(self._harmonics), len(self._hw.get_measurement_channels()) + 1]
+			(refamp, r, phi) = _normalise_harmonics(self._flt_x[-1].reshape(shape), self._flt_y[-1].reshape(shape), self._harmonics)
+			return (2 * refamp[ref-1], r[ref-1, h], phi[ref-1, h])
+		elif self._harmonic_amplitudes is not None:
+			return (self._ref_meas_amplitudes[ref-1], self._harmonic_amplitudes[ref-1, h], self._harmonic_phases[ref-1, h])
+		else:
+			raise RuntimeWarning('No results!')
+	
+	def _check_flt_state(self):
+		'''Reset the continuous lock-in filter state if it does not match the filter order, the number of channels and the demodulation frequencies'''
+		shape = (self._flt_order, (len(self._extra_frequencies) + 1) * len(self._harmonics) * (len(self._hw.get_measurement_channels()) + 1))
+		if self._flt_x is None or self._flt_x.shape != shape:
+			self._flt_x = numpy.zeros(shape)
+			self._flt_y = numpy.zeros(shape)
+	
 	#####################################
 	##### Data processing functions #####
 	#####################################
 	
+	@_locked
 	def process_data(self):
-		'''Perform lock-in analysis and save results in memory'''
+		'''
+		Perform lock-in analysis and save results in memory
+		All harmonics (see set_harmonics) of all reference frequencies (see set_extra_frequencies) are demodulated
+		in one matrix product per block of _PROCESS_BLOCK_LEN samples, results other than those at the signal
+		frequency are available through get_harmonic_results()
+		The sums of the samples times the oscillator (i.e. one DFT bin per demodulation frequency) are accumulated
+		block by block, so apart from the raw data the memory use does not depend on the record length
+		'''
 		try:
 			if self._rawdata is None:
 				raise RuntimeError()
 		except Exception:
 			logging.error('No raw data found')
 			return
-		phi = 2*numpy.pi*self._f * numpy.array(range(len(self._rawdata[0]))) / float(self._fs)
-		sini = (numpy.sin(phi) * self._rawdata).sum(axis=1)
-		cosi = (numpy.cos(phi) * self._rawdata).sum(axis=1)
-		amplitudes = numpy.sqrt(sini**2 + cosi**2)
-		phases = numpy.arctan2(cosi, sini)
-		self._normamplitudes = amplitudes[1:] / amplitudes[0]
-		normphases = phases[1:] - phases[0]
-		self._normphases = numpy.mod(normphases + numpy.pi, 2 * numpy.pi) - numpy.pi
-		self._gen_meas_amplitude = 2 * amplitudes[0] / float(len(phi))
+		freqs = self.get_frequencies()
+		samples = len(self._rawdata[0])
+		shape = [len(freqs), len(self._harmonics), len(self._rawdata)]
+		tables = self._demodulator_cache.get(freqs, self._fs, None, None, self._harmonics, min(samples, _PROCESS_BLOCK_LEN))
+		sini = numpy.zeros([shape[0] * shape[1], shape[2]])
+		cosi = numpy.zeros([shape[0] * shape[1], shape[2]])
+		phase = 0
+		for start in range(0, samples, _PROCESS_BLOCK_LEN):
+			block = self._rawdata[:, start:start+_PROCESS_BLOCK_LEN]
+			(sinosc, cososc, phase) = tables.oscillator(phase, block.shape[1])
+			sini += numpy.dot(sinosc, block.T)
+			cosi += numpy.dot(cososc, block.T)
+		(ref, self._harmonic_amplitudes, self._harmonic_phases) = _normalise_harmonics(sini.reshape(shape), cosi.reshape(shape), self._harmonics)
+		self._normamplitudes = self._harmonic_amplitudes[0, 0]
+		self._normphases = self._harmonic_phases[0, 0]
+		self._ref_meas_amplitudes = 2 * ref / float(samples)
+		self._gen_meas_amplitude = self._ref_meas_amplitudes[0]
 		return (self._gen_meas_amplitude, self._normamplitudes, self._normphases)
 
-	def process_data_moreinfo(self, fltord=0, RC=1/numpy.pi):
+	def process_data_moreinfo(self, fltord=0, RC=1/numpy.pi, poles=None):
 		'''
 		Perform lock-in analysis and save results in memory
 		Saves lots of intermediate calculated values
 		Also has the option to apply a cascade of <fltord> identical RC-filters with RC-time <RC> before integration
+		Alternatively an arbitrary filter can be applied by specifying its discrete-time <poles>
+		Complex poles are allowed but must come in complex conjugate pairs
+		If <poles> is specified, <fltord> and <RC> are ignored
 		'''
 		try:
 			if self._rawdata is None:
@@ -491,40 +1121,26 @@ class DigitalLockin:
 		except Exception:
 			logging.error('No raw data found')
 			return
-		self._t = numpy.array(range(len(self._rawdata[0])))*1./self._fs
-		tsin = numpy.sin(2*numpy.pi*self._f*self._t)
-		tcos = numpy.cos(2*numpy.pi*self._f*self._t)
-		self._sinx = tsin * self._rawdata
-		self._cosx = tcos * self._rawdata
-		if fltord == 0:
-			self._sinf = self._sinx
-			self._cosf = self._cosx
-		else:
-			alpha = 1 / (RC * self._fs)
-			self._sinf = _filter(self._sinx, [alpha]*fltord)
-			self._cosf = _filter(self._cosx, [alpha]*fltord)
-		self._sini = _integrate(self._sinf)
-		self._cosi = _integrate(self._cosf)
-		self._amplitudes = numpy.sqrt(self._sini**2 + self._cosi**2)
-		self._phases = numpy.arctan2(self._cosi, self._sini)
-		self._normamplitudes_all = self._amplitudes[1:][:] / self._amplitudes[0][:]
-		self._normphases_all = numpy.mod(self._phases[1:][:] - self._phases[0][:] + numpy.pi, 2*numpy.pi) - numpy.pi
-		sampsperperiod = self._fs / self._f
-		self._t_smp = self._t[sampsperperiod-1::sampsperperiod]
-		self._normamplitudes_smp = [[]]*len(self._normamplitudes_all)
-		self._normphases_smp = [[]]*len(self._normphases_all)
-		self._normamplitudes = numpy.zeros(len(self._normamplitudes_all))
-		self._normphases = numpy.zeros(len(self._normphases_all))
-		for i in range(len(self._normamplitudes)):
-			self._normamplitudes_smp[i] = self._normamplitudes_all[i][sampsperperiod-1::sampsperperiod]
-			self._normphases_smp[i] = self._normphases_all[i][sampsperperiod-1::sampsperperiod]
-			self._normamplitudes[i] = self._normamplitudes_all[i][-1]
-			self._normphases[i] = self._normphases_all[i][-1]
-		self._normamplitudes_smp = numpy.array(self._normamplitudes_smp)
-		self._normphases_smp = numpy.array(self._normphases_smp)
-		self._gen_meas_amplitude = 2 * self._amplitudes[0][-1] / float(len(self._t))
+		self._store_moreinfo_results(analyse_moreinfo(self._rawdata, self._f, self._fs, fltord, RC, poles))
 		return (self._gen_meas_amplitude, self._normamplitudes, self._normphases)
 
+	def process_data_moreinfo_async(self, executor, fltord=0, RC=1/numpy.pi, poles=None):
+		'''
+		Like process_data_moreinfo, but run the analysis in a worker process of <executor> (a digitallockinanalysis.AnalysisExecutor)
+		Returns an AnalysisJob, its results are stored in this object when the executor collects them
+		Only the results needed by plot_results and printmainresults are stored, the other intermediate results are None
+		'''
+		if self._rawdata is None:
+			logging.error('No raw data found')
+			return
+		self.free_intermediate_calc_results()
+		return executor.submit_moreinfo(self._rawdata, self._f, self._fs, fltord, RC, poles, callback=self._store_moreinfo_results)
+
+	def _store_moreinfo_results(self, results):
+		'''Store a dictionary of results of analyse_moreinfo in the corresponding members'''
+		for (name, value) in results.items():
+			setattr(self, '_' + name, value)
+
 	#############################
 	##### Display functions #####
 	#############################
@@ -0,0 +1,202 @@
+'''
+digitallockinanalysis.py, offline lock-in analysis in worker processes for digital lockin applications
+
+Copyright: Zeust the Unoobian <2noob2banoob@gmail.com>, 2014
+
+This file is part of DigitalLockin.
+
+DigitalLockin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+DigitalLockin is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with DigitalLockin.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import numpy
+import logging
+import collections
+import multiprocessing
+import multiprocessing.sharedctypes
+import time
+import traceback
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+import digitallockin as dlm
+
+#Constants
+_POLL_INTERVAL = 0.01
+# Results of analyse_moreinfo which are as long as the record but are not sent back to the parent process
+_MOREINFO_DISCARDED = ['t', 'sinx', 'cosx', 'sinf', 'cosf', 'sini', 'cosi', 'amplitudes', 'phases']
+# Results of analyse_moreinfo which are as long as the record and are returned through shared memory
+_MOREINFO_SHARED = ['normamplitudes_all', 'normphases_all']
+
+def _shared_array(shape):
+	'''Allocate a float64 array of shape <shape> in shared memory, returns the shared memory object'''
+	return multiprocessing.sharedctypes.RawArray('d', int(numpy.prod(shape)))
+
+def _shared_view(buf, shape):
+	'''Get a numpy array of shape <shape> which uses shared memory object <buf> without copying'''
+	return numpy.frombuffer(buf, dtype=numpy.float64).reshape(shape)
+
+def _moreinfo_worker(jobid, rawbuf, outbuf, shape, F, Fs, fltord, RC, poles, resultqueue):
+	'''
+	Main function of a worker process, runs analyse_moreinfo on the raw data in shared memory <rawbuf>
+	The full-length normalised amplitudes and phases are written to shared memory <outbuf>,
+	the other end results are small and are sent back through <resultqueue>
+	'''
+	try:
+		results = dlm.analyse_moreinfo(_shared_view(rawbuf, shape), F, Fs, fltord, RC, poles)
+		out = _shared_view(outbuf, [len(_MOREINFO_SHARED), shape[0] - 1, shape[1]])
+		for (i, name) in enumerate(_MOREINFO_SHARED):
+			out[i] = results.pop(name)
+		for name in _MOREINFO_DISCARDED:
+			del results[name]
+		resultqueue.put((jobid, results, None))
+	except Exception:
+		resultqueue.put((jobid, None, traceback.format_exc()))
+
+class AnalysisJob:
+	'''
+	Handle to an analysis which is queued or running in an AnalysisExecutor
+	The results are collected by AnalysisExecutor.poll(), which also calls the callback of the job
+	'''
+
+	def __init__(self, executor, jobid, callback):
+		self._executor = executor
+		self._jobid = jobid
+		self._callback = callback
+		self._done = False
+		self._results = None
+		self._error = None
+
+	def _finish(self, results, error):
+		self._results = results
+		self._error = error
+		self._done = True
+		if error is None and self._callback is not None:
+			self._callback(results)
+
+	def ready(self):
+		'''Check whether the analysis has finished, collecting results of the executor first'''
+		if not self._done:
+			self._executor.poll()
+		return self._done
+
+	def get(self, timeout=None):
+		'''
+		Wait for the analysis to finish and get its results
+		Raises RuntimeWarning if it did not finish within <timeout> seconds and RuntimeError if it failed
+		'''
+		if not self._executor.wait([self], timeout):
+			raise RuntimeWarning('Analysis job {:d} did not finish within {:g} seconds'.format(self._jobid, timeout))
+		if self._error is not None:
+			raise RuntimeError('Analysis job {:d} failed:\n{:s}'.format(self._jobid, self._error))
+		return self._results
+
+class AnalysisExecutor:
+	'''
+	Runs lock-in analyses (see digitallockin.analyse_moreinfo) in worker processes, so they
+	do not block the process which talks to the instruments and all cores can be used
+
+	The raw data of each job is copied once into shared memory which the worker process
+	inherits, so the channels x samples array is never pickled. The full-length normalised
+	amplitudes and phases are returned through shared memory as well, the parent gets numpy
+	arrays which use that memory directly. The other results are small and are sent back
+	through a queue. At most <processes> jobs run at the same time, the others are queued
+
+	Results are collected by poll(), which never blocks and should be called regularly
+	(AnalysisJob.ready(), AnalysisJob.get() and wait() call it too)
+	An executor and its jobs must be used from one thread
+	'''
+
+	def __init__(self, processes=None):
+		if processes is None:
+			processes = multiprocessing.cpu_count()
+		self._processes = processes
+		self._resultqueue = multiprocessing.Queue()
+		self._pending = collections.deque()
+		self._running = {}
+		self._nextid = 0
+
+	def submit_moreinfo(self, rawdata, F, Fs, fltord=0, RC=1/numpy.pi, poles=None, callback=None):
+		'''
+		Queue analyse_moreinfo on channels x samples array <rawdata>, returns an AnalysisJob
+		The results are a dictionary like that of analyse_moreinfo without the intermediate results
+		<callback> is called with the results when they are collected
+		'''
+		rawdata = numpy.asarray(rawdata, dtype=numpy.float64)
+		if rawdata.ndim != 2 or rawdata.shape[0] < 2:
+			raise RuntimeError('Raw data must be a channels x samples array with a reference channel and at least one measurement channel')
+		rawbuf = _shared_array(rawdata.shape)
+		_shared_view(rawbuf, rawdata.shape)[:] = rawdata
+		outbuf = _shared_array([len(_MOREINFO_SHARED), rawdata.shape[0] - 1, rawdata.shape[1]])
+		job = AnalysisJob(self, self._nextid, callback)
+		self._nextid += 1
+		self._pending.append((job, rawbuf, outbuf, (job._jobid, rawbuf, outbuf, rawdata.shape, F, Fs, fltord, RC, poles, self._resultqueue)))
+		self.poll()
+		return job
+
+	def map_moreinfo(self, records, F, Fs, fltord=0, RC=1/numpy.pi, poles=None):
+		'''Queue analyse_moreinfo on every channels x samples array in <records>, returns a list of AnalysisJobs'''
+		return [self.submit_moreinfo(rawdata, F, Fs, fltord, RC, poles) for rawdata in records]
+
+	def poll(self):
+		'''Collect the results of finished jobs and start queued jobs if processes are available, does not block'''
+		while True:
+			try:
+				(jobid, results, error) = self._resultqueue.get_nowait()
+			except queue.Empty:
+				break
+			(job, rawbuf, outbuf, shape, process) = self._running.pop(jobid)
+			process.join()
+			if results is not None:
+				out = _shared_view(outbuf, [len(_MOREINFO_SHARED), shape[0] - 1, shape[1]])
+				for (i, name) in enumerate(_MOREINFO_SHARED):
+					results[name] = out[i]
+			job._finish(results, error)
+		for (jobid, (job, rawbuf, outbuf, shape, process)) in list(self._running.items()):
+			if not process.is_alive() and process.exitcode != 0:
+				del self._running[jobid]
+				job._finish(None, 'Worker process exited with code {:s}'.format(str(process.exitcode)))
+		while self._pending and len(self._running) < self._processes:
+			(job, rawbuf, outbuf, args) = self._pending.popleft()
+			process = multiprocessing.Process(target=_moreinfo_worker, args=args)
+			process.daemon = True
+			process.start()
+			# The shared memory is freed when the last reference goes, and Process.start() drops its
+			# arguments, so the running jobs keep <rawbuf> until the worker is done with it
+			self._running[job._jobid] = (job, rawbuf, outbuf, args[3], process)
+
+	def wait(self, jobs=None, timeout=None):
+		'''Wait until all <jobs> (default: all submitted jobs) have finished, returns False if <timeout> seconds passed first'''
+		t_timeout = None if timeout is None else time.time() + timeout
+		while True:
+			self.poll()
+			if jobs is None:
+				if not self._pending and not self._running:
+					return True
+			elif all([job._done for job in jobs]):
+				return True
+			if t_timeout is not None and time.time() > t_timeout:
+				return False
+			time.sleep(_POLL_INTERVAL)
+
+	def shutdown(self):
+		'''Terminate all running jobs and forget the queued ones'''
+		for (job, rawbuf, outbuf, shape, process) in self._running.values():
+			process.terminate()
+			process.join()
+			job._finish(None, 'Executor was shut down')
+		self._running.clear()
+		while self._pending:
+			self._pending.popleft()[0]._finish(None, 'Executor was shut down')
@@ -291,6 +291,19 @@ class MeasurementHardwareInterface:
 				raise RuntimeWarning('set_gen_signal_frequency: Cannot change frequency while running, will change after restart')
 				self._gen_parameters_need_reconfigure = True
 	
+	def retune_gen_signal_frequency(self, f):
+		'''
+		Set the generated signal frequency, also while the signal generator is generating
+		A running generator is stopped, reconfigured and started again, while the signal analyser keeps measuring
+		This saves restarting the whole measurement, but the generated signal is interrupted briefly
+		'''
+		if not self._gen_output_enabled:
+			self.set_gen_signal_frequency(f)
+		else:
+			self.stop_generation()
+			self.set_gen_signal_frequency(f)
+			self.start_generation()
+	
 	def set_gen_signal_amplitude(self, a):
 		'''
 		Set the generated signal amplitude
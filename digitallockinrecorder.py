@@ -0,0 +1,216 @@
+'''
+digitallockinrecorder.py, recording of raw measurement data to memory-mapped files for digital lockin applications
+
+Copyright: Zeust the Unoobian <2noob2banoob@gmail.com>, 2014
+
+This file is part of DigitalLockin.
+
+DigitalLockin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+DigitalLockin is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with DigitalLockin.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+import numpy
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+#Constants
+# Length of the .npy header of a recording, fixed so the header can be rewritten in place with the final shape
+_NPY_HEADER_LEN = 128
+_NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# Seconds of samples for which the file is preallocated when a recording starts, the file doubles in size when it is full
+RECORD_PREALLOCATE_SECONDS = 10.
+# Maximum number of blocks waiting for the writer thread, further blocks are dropped (and counted) so acquisition never waits
+RECORD_QUEUE_BLOCKS_MAX = 1000
+# Interval in seconds at which the header and metadata sidecar are brought up to date while recording
+RECORD_SYNC_INTERVAL = 1.
+
+def metadata_path(path):
+	'''Path of the metadata sidecar of the recording in <path>: the same name with extension .json'''
+	return os.path.splitext(path)[0] + '.json'
+
+def _npy_header(channels, samples):
+	'''
+	.npy header of a float64 channels x samples array in Fortran order, padded to _NPY_HEADER_LEN bytes
+	Fortran order stores all channels of one sample together, so appending samples appends to the file
+	'''
+	header = "{{'descr': '<f8', 'fortran_order': True, 'shape': ({:d}, {:d}), }}".format(channels, samples)
+	header = header.ljust(_NPY_HEADER_LEN - len(_NPY_MAGIC) - 2 - 1) + '\n'
+	return _NPY_MAGIC + numpy.array([len(header)], dtype='<u2').tobytes() + header.encode('latin1')
+
+def load_recording(path):
+	'''
+	Open the recording in <path> without reading it into memory
+	Returns (rawdata, metadata): a memory-mapped channels x samples array and the dictionary of the metadata sidecar
+	'''
+	with open(metadata_path(path)) as f:
+		metadata = json.load(f)
+	return (numpy.load(path, mmap_mode='r'), metadata)
+
+class RawDataRecorder:
+	'''
+	Appends blocks of raw data (channels x samples arrays, as retrieved from the hardware interface)
+	to a .npy file which numpy.load can open, for example with mmap_mode='r' (see load_recording)
+
+	The file is preallocated and memory-mapped, and grows by doubling when it is full
+	Blocks are written by a writer thread: append() only puts the block in a queue, so the thread
+	which acquires the samples is never stalled by the disk. If the writer falls more than
+	RECORD_QUEUE_BLOCKS_MAX blocks behind, blocks are dropped and counted instead
+	Blocks must not be modified after they are appended
+
+	The metadata sidecar (see metadata_path) holds the sample frequency, channel names, amplitude
+	and in 'chunks' the boundaries of the blocks: for every block [first sample, time at which it
+	was retrieved, signal frequency at that time, dropped samples]. Dropped samples is 0 for a
+	written block; a block which was dropped (or could not be written) is a gap marker with its
+	number of samples, at the sample where it would have started
+	The header and sidecar are written when the recording starts and brought up to date every
+	RECORD_SYNC_INTERVAL and whenever the file grows, so after a crash the file holds the samples
+	written until the last update. Entry 'complete' of the sidecar is set by stop()
+	'''
+
+	def __init__(self, path, Fs, channels, metadata=None):
+		'''
+		Start recording to <path> at sample frequency <Fs>, <path> and its metadata sidecar must not exist yet
+		<channels> are the channel names, the generated signal measurement channel first
+		<metadata> is a dictionary of extra entries for the metadata sidecar
+		'''
+		self._path = path
+		self._channels = len(channels)
+		self._metadata = dict(metadata or {})
+		self._metadata.update({'Fs': Fs, 'channels': list(channels), 'dtype': '<f8', 't_start': time.time(), 'complete': False})
+		self._chunks = []
+		self._gaps = [] # [time, F, samples] of the blocks dropped since the last block which was queued
+		self._samples = 0
+		self._dropped_blocks = 0
+		self._dropped_samples = 0
+		self._queue = queue.Queue(RECORD_QUEUE_BLOCKS_MAX)
+		self._capacity = max(1, int(RECORD_PREALLOCATE_SECONDS * Fs))
+		if os.path.exists(metadata_path(path)):
+			raise RuntimeError('Recording {:s} already exists'.format(path))
+		try:
+			fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+		except OSError as e:
+			raise RuntimeError('Cannot create recording {:s}: {:s}'.format(path, str(e)))
+		with os.fdopen(fd, 'wb') as f:
+			f.write(_npy_header(self._channels, self._samples))
+			f.truncate(_NPY_HEADER_LEN + self._capacity * self._channels * 8)
+		self._map = self._open_map()
+		self._write_metadata()
+		self._synced = time.time()
+		self._writer = threading.Thread(target=self._writer_loop, name='Raw data recorder ({:s})'.format(os.path.basename(path)))
+		self._writer.daemon = True
+		self._writer.start()
+
+	def _open_map(self):
+		return numpy.memmap(self._path, dtype='<f8', mode='r+', offset=_NPY_HEADER_LEN, shape=(self._channels, self._capacity), order='F')
+
+	def append(self, rawdata, F):
+		'''Queue channels x samples array <rawdata> for writing, <F> is the signal frequency at which it was measured'''
+		if rawdata.shape[0] != self._channels:
+			raise RuntimeError('Recording has {:d} channels, cannot append a block of {:d} channels'.format(self._channels, rawdata.shape[0]))
+		if rawdata.shape[1] == 0:
+			return
+		try:
+			self._queue.put_nowait((self._gaps, rawdata, time.time(), F))
+		except queue.Full:
+			self._gaps.append([time.time(), F, rawdata.shape[1]])
+			logging.warning('Recorder of {:s} cannot keep up, dropped a block of {:d} samples'.format(self._path, rawdata.shape[1]))
+			return
+		self._gaps = []
+
+	def _writer_loop(self):
+		'''
+		Main function of the writer thread, writes queued blocks until it gets a block None
+		Every queued block comes with the blocks dropped before it, and the chunks and gap markers are
+		recorded at the samples actually written
+		'''
+		while True:
+			(gaps, rawdata, t, F) = self._queue.get()
+			for (gap_t, gap_F, gap_samples) in gaps:
+				self._gap(gap_t, gap_F, gap_samples)
+			if rawdata is None:
+				break
+			samples = rawdata.shape[1]
+			try:
+				if self._samples + samples > self._capacity:
+					self._grow(self._samples + samples)
+				self._map[:, self._samples:self._samples+samples] = rawdata
+			except Exception:
+				logging.exception('Recorder of {:s} failed to write a block:'.format(self._path))
+				self._gap(t, F, samples)
+				continue
+			self._chunks.append([self._samples, t, F, 0])
+			self._samples += samples
+			if time.time() - self._synced >= RECORD_SYNC_INTERVAL:
+				self._sync()
+
+	def _gap(self, t, F, samples):
+		'''Record a gap marker for a block of <samples> samples which was not written'''
+		self._chunks.append([self._samples, t, F, samples])
+		self._dropped_blocks += 1
+		self._dropped_samples += samples
+
+	def _write_header(self):
+		'''Write the .npy header with the number of samples written so far'''
+		with open(self._path, 'r+b') as f:
+			f.write(_npy_header(self._channels, self._samples))
+
+	def _write_metadata(self):
+		'''Write the metadata sidecar with the state of the recording so far'''
+		self._metadata.update({'samples': self._samples, 'chunks': list(self._chunks),
+				'dropped_blocks': self._dropped_blocks, 'dropped_samples': self._dropped_samples})
+		with open(metadata_path(self._path), 'w') as f:
+			json.dump(self._metadata, f)
+
+	def _sync(self):
+		'''Flush the written samples to the file, then update the header and sidecar to include them'''
+		self._map.flush()
+		self._write_header()
+		self._write_metadata()
+		self._synced = time.time()
+
+	def _grow(self, samples):
+		'''Enlarge the file to hold at least <samples> samples'''
+		self._sync()
+		del self._map
+		self._capacity = max(samples, 2 * self._capacity)
+		with open(self._path, 'r+b') as f:
+			f.truncate(_NPY_HEADER_LEN + self._capacity * self._channels * 8)
+		self._map = self._open_map()
+
+	def stop(self):
+		'''
+		Write the remaining blocks, shrink the file to the recorded samples and write the metadata sidecar
+		Returns the number of recorded samples
+		'''
+		self._queue.put((self._gaps, None, None, None))
+		self._gaps = []
+		self._writer.join()
+		self._map.flush()
+		del self._map
+		with open(self._path, 'r+b') as f:
+			f.write(_npy_header(self._channels, self._samples))
+			f.truncate(_NPY_HEADER_LEN + self._samples * self._channels * 8)
+		self._metadata.update({'t_stop': time.time(), 'complete': True})
+		self._write_metadata()
+		logging.info('Recorded {:d} samples to {:s}'.format(self._samples, self._path))
+		return self._samples
+
+	def get_path(self):
+		return self._path
@@ -0,0 +1,368 @@
+'''
+digitallockinreplayhwinterface.py, replay of recorded raw data as hardware interface for digital lockin applications
+
+Copyright: Zeust the Unoobian <2noob2banoob@gmail.com>, 2014
+
+This file is part of DigitalLockin.
+
+DigitalLockin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+DigitalLockin is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with DigitalLockin.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import numpy
+import bisect
+import logging
+import time
+
+import digitallockinrecorder as recorder
+
+#Constants
+_RETRIEVE_POLL_INTERVAL = 0.001
+
+
+class ReplayHardwareInterface:
+	'''
+	Drop-in replacement for MeasurementHardwareInterface which serves the samples of a recording
+	made with RECORD START (see digitallockinrecorder), so a lock-in can be run again on recorded
+	data with other settings, for example another time constant, filter order or set of harmonics
+	The recording is memory-mapped, so recordings which do not fit in memory can be replayed
+
+	After start_measurement() the samples become available at <speed> times the recorded sample
+	frequency, like the instrument buffer of a signal analyser which fills up in real time:
+	speed 1 replays in real time, speed 10 ten times as fast and speed 0 as fast as the samples
+	are retrieved (at most a buffer size at a time). The measurement channels can be any of the
+	recorded ones, the generated signal is always the first recorded channel
+	The sample frequency and signal frequency are those of the recording and cannot be changed
+	If the signal frequency changed during the recording (e.g. in a sweep), get_gen_signal_frequency()
+	follows it: it is the frequency of the next sample to be retrieved. Retrieving all available samples
+	stops at every such change and at every gap of the recording (blocks which were dropped), and
+	take_discontinuity() tells whether a gap or a buffer overflow was passed, so the lock-in can retune
+	or reset its filter between the blocks (see DigitalLockin)
+	When all samples have been served, no further samples become available
+	'''
+
+	###################################
+	##### Constructor and similar #####
+	###################################
+
+	def __init__(self, path, speed=1., meas_ch=None):
+		'''
+		Constructor
+			path    : string
+				Path of the recording (the .npy file, the metadata sidecar is found next to it)
+			speed   : float [Default: 1]
+				Replay speed relative to real time, 0 for as fast as possible
+			meas_ch : list of string [Default: None]
+				Recorded channels to use as measurement channels, None for all of them
+		'''
+		(self._rawdata, self._metadata) = recorder.load_recording(path)
+		self._path = path
+		self._recorded_ch = list(self._metadata['channels'])
+		if speed < 0:
+			raise RuntimeError('Replay speed must be positive or 0 (as fast as possible), got {:f}'.format(speed))
+		self._speed = float(speed)
+		self._meas_fs = self._metadata['Fs']
+		# Samples at which the signal frequency changed, with the new frequency, and samples before which blocks were dropped
+		self._frequency_changes = [(0, self._metadata['F'])]
+		gaps = set()
+		for chunk in self._metadata.get('chunks', []):
+			if chunk[2] != self._frequency_changes[-1][1]:
+				if chunk[0] == self._frequency_changes[-1][0]:
+					self._frequency_changes[-1] = (chunk[0], chunk[2])
+				else:
+					self._frequency_changes.append((chunk[0], chunk[2]))
+			if len(chunk) > 3 and chunk[3] > 0 and chunk[0] > 0:
+				gaps.add(chunk[0])
+		self._frequency_change_samples = [sample for (sample, F) in self._frequency_changes]
+		self._gaps = sorted(gaps)
+		self._boundaries = sorted(gaps.union(self._frequency_change_samples[1:]))
+		self._gen_signal_frequency = self._frequency_changes[0][1]
+		self._discontinuity = False
+		self._gen_amplitude = self._metadata.get('amplitude', 1.)
+		self._gen_ch = None
+		self._gen_meas_ch = self._recorded_ch[0]
+		self._gen_output_enabled = False
+		self._measuring = False
+		self._bufsize = 0
+		self._samples_read = 0
+		self._samples_lost = 0
+		self.set_meas_channels(self._recorded_ch[1:] if meas_ch is None else meas_ch)
+
+	def close(self):
+		'''Stop generation and measurement and let go of the recording'''
+		if self._measuring:
+			self.end_measurement()
+		self._rawdata = None
+
+	##############################
+	##### Channel functions ######
+	##############################
+
+	def set_meas_channels(self, ch):
+		'''
+		Set measurement channels, not including the channel for measuring the generated signal
+		Every channel must have been recorded
+		If multiple channels are specified they must be put in a list
+		If only one channel is specified it can be in a list but doesn't have to
+		'''
+		if not isinstance(ch, list):
+			ch = [ch]
+		for c in ch:
+			if c not in self._recorded_ch[1:]:
+				raise RuntimeError('Channel {:s} was not recorded, the recorded measurement channels are {:s}'.format(str(c), str(self._recorded_ch[1:])))
+		self._meas_ch = list(ch)
+		self._rows = [0] + [self._recorded_ch.index(c) for c in ch]
+
+	def set_gen_meas_channel(self, ch):
+		'''The generated signal measurement channel is the first recorded channel, other channels are refused'''
+		if ch != self._gen_meas_ch:
+			raise RuntimeError('The generated signal was recorded on channel {:s}'.format(self._gen_meas_ch))
+
+	def set_gen_channel(self, ch):
+		'''Set generation channel, which means nothing for a recording'''
+		self._gen_ch = ch
+
+	def get_measurement_channels(self):
+		'''
+		Get measurement channels, not including the channel for measuring the generated signal
+		Always returns a list even if the number of channels is one
+		'''
+		return self._meas_ch
+
+	def get_generation_channel(self):
+		'''Get generation channel'''
+		return self._gen_ch
+
+	def get_generated_signal_measurement_channel(self):
+		'''Get channel for measuring generated signal'''
+		return self._gen_meas_ch
+
+	#########################################
+	##### Generator parameter functions #####
+	#########################################
+
+	def set_gen_signal_frequency(self, f):
+		'''The signal frequency is that of the recording, setting it only logs a warning'''
+		if f != self._gen_signal_frequency:
+			logging.warning('Cannot change the signal frequency of a recording, it stays {:f} Hz'.format(self._gen_signal_frequency))
+
+	def retune_gen_signal_frequency(self, f):
+		'''The signal frequency is that of the recording, setting it only logs a warning'''
+		self.set_gen_signal_frequency(f)
+
+	def set_gen_signal_amplitude(self, a):
+		'''The signal amplitude is that of the recording, setting it only logs a warning'''
+		if a != self._gen_amplitude:
+			logging.warning('Cannot change the signal amplitude of a recording, it stays {:f} V'.format(self._gen_amplitude))
+
+	def set_gen_output_impedance(self, Z):
+		'''Set waveform generator output impedance, which means nothing for a recording'''
+		self._gen_output_impedance = Z
+
+	def get_gen_signal_frequency(self):
+		'''Get the frequency of the generated signal'''
+		return self._gen_signal_frequency
+
+	def get_gen_signal_amplitude(self):
+		'''Get the amplitude of the generated signal'''
+		return self._gen_amplitude
+
+	def get_gen_signal_offset(self):
+		'''Get the DC offset of the generated signal'''
+		return 0.
+
+	def get_external_frequencies(self):
+		'''Get the reference frequencies which were demodulated in addition to the signal frequency during the recording'''
+		return list(self._metadata.get('extra_frequencies', []))
+
+	###########################################
+	##### Measurement parameter functions #####
+	###########################################
+
+	def set_meas_sample_frequency(self, fs):
+		'''The sample frequency is that of the recording, setting it only logs a warning'''
+		if fs != self._meas_fs:
+			logging.warning('Cannot change the sample frequency of a recording, it stays {:f} Hz'.format(self._meas_fs))
+
+	def get_meas_sample_frequency(self):
+		'''Get the sample frequency of the recording'''
+		return self._meas_fs
+
+	####################################
+	##### Output control functions #####
+	####################################
+
+	def start_generation(self):
+		'''Start waveform generation'''
+		self._gen_output_enabled = True
+
+	def stop_generation(self):
+		'''Stop waveform generation'''
+		self._gen_output_enabled = False
+
+	############################
+	##### Recording access #####
+	############################
+
+	def _read(self, start, nsamples):
+		'''Copy samples <start> up to <start>+<nsamples> of the generated signal and measurement channels from the recording'''
+		return numpy.array(self._rawdata[self._rows, start:start+nsamples], order='C')
+
+	def _samples_generated(self):
+		'''Number of samples the replayed signal analyser has acquired since the start of the measurement'''
+		if self._speed > 0:
+			n = int((time.time() - self._t_start) * self._meas_fs * self._speed)
+		else:
+			n = self._samples_read + self._bufsize
+		return min(n, self._rawdata.shape[1])
+
+	def samples_left(self):
+		'''Number of samples of the recording which have not been retrieved yet'''
+		return self._rawdata.shape[1] - self._samples_read
+
+	def _next_boundary(self):
+		'''First sample after the retrieved ones at which the frequency changes or a gap starts, or the end of the recording'''
+		i = bisect.bisect_right(self._boundaries, self._samples_read)
+		return self._boundaries[i] if i < len(self._boundaries) else self._rawdata.shape[1]
+
+	def _skip_to(self, sample, skipped=False):
+		'''
+		Continue serving samples from <sample> on after samples up to it were retrieved, or <skipped>
+		Follows the frequency of the recording and notes the gaps which were passed, see take_discontinuity()
+		'''
+		start = self._samples_read
+		self._samples_read = sample
+		F = self._frequency_changes[bisect.bisect_right(self._frequency_change_samples, sample) - 1][1]
+		if F != self._gen_signal_frequency:
+			logging.info('Recording {:s} changes frequency to {:f} Hz at sample {:d}'.format(self._path, F, sample))
+			self._gen_signal_frequency = F
+		for gap in self._gaps[bisect.bisect_right(self._gaps, start):bisect.bisect_right(self._gaps, sample)]:
+			logging.info('Recording {:s} has a gap (dropped blocks) before sample {:d}'.format(self._path, gap))
+			self._discontinuity = True
+		if skipped:
+			self._discontinuity = True
+
+	def take_discontinuity(self):
+		'''
+		Whether a gap of the recording or a buffer overflow was passed since the last call,
+		so the samples retrieved next do not continue the ones retrieved before
+		'''
+		(discontinuity, self._discontinuity) = (self._discontinuity, False)
+		return discontinuity
+
+	################################
+	##### Measurement function #####
+	################################
+
+	def do_measurement(self, nsamples, vmin=-10, vmax=10, timeout=1, config='PSEUDODIFF'):
+		'''
+		Measure signals, which returns the first <nsamples> samples of the recording
+		Returns a multidimensional array.
+		data[0][:] contains the measured generated signal, data[1:][:] contains the other measured signals
+		'''
+		if nsamples > self._rawdata.shape[1]:
+			raise RuntimeWarning('do_measurement: the recording has only {:d} samples'.format(self._rawdata.shape[1]))
+		if self._speed > 0:
+			time.sleep(float(nsamples) / self._meas_fs / self._speed)
+		return self._read(0, nsamples)
+
+	def measure_periods(self, nperiods, vmin=-10, vmax=10, timeout=10, config='PSEUDODIFF'):
+		'''Version of do_measurement() where you specify the number of signal periods (not necessarily integer) instead of the number of samples'''
+		nsamples = int(round(nperiods * self._meas_fs / float(self._gen_signal_frequency)))
+		return self.do_measurement(nsamples, vmin, vmax, timeout, config)
+
+	def measure_seconds(self, nseconds, vmin=-10, vmax=10, timeout=10, config='PSEUDODIFF'):
+		'''Version of do_measurement() where you specify the time in seconds (not necessarily integer) instead of the number of samples'''
+		nsamples = int(round(nseconds*self._meas_fs))
+		return self.do_measurement(nsamples, vmin, vmax, timeout, config)
+
+	def start_measurement(self, vmin=-10, vmax=10, config='PSEUDODIFF', bufsize=204800):
+		'''Start replaying from the start of the recording but don't acquire any samples to the computer just yet'''
+		if self._measuring:
+			raise RuntimeWarning('Already measuring')
+		self._bufsize = bufsize
+		self._samples_read = 0
+		self._samples_lost = 0
+		self._gen_signal_frequency = self._frequency_changes[0][1]
+		self._discontinuity = False
+		self._t_start = time.time()
+		self._measuring = True
+
+	def retrieve_samples(self, nsamples=1, timeout=1.0, assumebuffered=False):
+		'''
+		Retrieve the specified number of samples from the replayed instrument buffer, or all of them if <nsamples> is -1
+		With -1 it stops at the next change of frequency or gap of the recording, the rest follows in the next call
+		Waits for the samples to become available if necessary
+		The timeout you specify is increased the time the measurement should take so you don't have to calculate this time yourself
+		This function returns a channels x samples array
+		'''
+		if not self._measuring:
+			raise RuntimeError('retrieve_samples: not measuring')
+		available = self.measured_samples_in_instrument_buffer()
+		if nsamples == -1:
+			nsamples = min(available, self._next_boundary() - self._samples_read)
+		elif available < nsamples:
+			if nsamples > self.samples_left():
+				raise RuntimeWarning('retrieve_samples: expected {:d} samples but the recording has only {:d} left'.format(nsamples, self.samples_left()))
+			if not assumebuffered and self._speed > 0:
+				timeout += float(nsamples) / self._meas_fs / self._speed
+			t_timeout = time.time() + timeout
+			while available < nsamples:
+				if time.time() > t_timeout:
+					raise RuntimeWarning('retrieve_samples: expected {:d} samples but got {:d}'.format(nsamples, available))
+				time.sleep(max(_RETRIEVE_POLL_INTERVAL, float(nsamples - available) / self._meas_fs / max(self._speed, 1.)))
+				available = self.measured_samples_in_instrument_buffer()
+		if self._samples_read + nsamples > self._next_boundary():
+			logging.warning('Retrieved samples of {:s} span a change of frequency or a gap of the recording'.format(self._path))
+		data = self._read(self._samples_read, nsamples)
+		self._skip_to(self._samples_read + nsamples)
+		if self.samples_left() == 0 and nsamples > 0:
+			logging.info('Replayed all {:d} samples of {:s}'.format(self._rawdata.shape[1], self._path))
+		return data
+
+	def retrieve_periods(self, nperiods=1, timeout=1.0, assumebuffered=False):
+		'''Retrieve a number of samples corresponding to the specified number of signal periods'''
+		nsamples = int(round(nperiods * self._meas_fs / float(self._gen_signal_frequency)))
+		return self.retrieve_samples(nsamples, timeout, assumebuffered)
+
+	def retrieve_seconds(self, nseconds=1, timeout=0.1, assumebuffered=True):
+		'''Retrieve a number of samples corresponding to the specified time in seconds'''
+		return self.retrieve_samples(int(round(nseconds*self._meas_fs)), timeout, assumebuffered)
+
+	def end_measurement(self):
+		'''Stop replaying'''
+		self._measuring = False
+
+	###################################
+	##### Miscellaneous functions #####
+	###################################
+
+	def measured_samples_in_instrument_buffer(self):
+		'''
+		Find out how many samples are left in the replayed instrument buffer
+		When the buffer overflows, the oldest samples are skipped and a warning is logged
+		'''
+		if not self._measuring:
+			return 0
+		available = self._samples_generated() - self._samples_read
+		if available > self._bufsize:
+			lost = available - self._bufsize
+			self._samples_lost += lost
+			self._skip_to(self._samples_read + lost, True)
+			available = self._bufsize
+			logging.warning('Replayed instrument buffer overflow, skipped {:d} samples'.format(lost))
+		return available
+
+	def samples_lost(self):
+		'''Number of samples skipped due to buffer overflows since the start of the measurement'''
+		return self._samples_lost
@@ -0,0 +1,358 @@
+'''
+digitallockinsimhwinterface.py, simulated hardware interface for digital lockin applications
+
+Copyright: Zeust the Unoobian <2noob2banoob@gmail.com>, 2014
+
+This file is part of DigitalLockin.
+
+DigitalLockin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+DigitalLockin is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with DigitalLockin.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import numpy
+import logging
+import time
+
+#Constants
+MIN_SAMPLE_FREQUENCY_MEAS_SIM = 100
+MAX_SAMPLE_FREQUENCY_MEAS_SIM = 204800
+_RETRIEVE_POLL_INTERVAL = 0.001
+
+
+class SimulatedHardwareInterface:
+	'''
+	Drop-in replacement for MeasurementHardwareInterface which does not need any hardware or drivers
+	Generates a sine wave and measures it on every measurement channel, scaled by a complex
+	channel response and with Gaussian noise added
+	The first row of every returned array is the generated signal itself, like with real hardware
+
+	Samples are produced against the computer clock at the configured sample frequency:
+	after start_measurement() the simulated instrument buffer fills up in real time, so reading
+	late leaves a backlog and reading early has to wait, just like with the signal analysers
+	Samples are generated in vectorized blocks when they are retrieved
+	'''
+
+	###################################
+	##### Constructor and similar #####
+	###################################
+
+	def __init__(self, gen_dev='SIM_GEN', meas_dev='SIM_MEAS', gen_ch='0', gen_meas_ch='ai0', meas_ch='ai1',
+			Fs=MAX_SAMPLE_FREQUENCY_MEAS_SIM, Fsignal=1000, gen_amplitude=1, gen_offset=0, gen_output_impedance=50, noise_amplitude=0.1, response=None, realtime=True):
+		'''
+		Constructor, accepts the same arguments as MeasurementHardwareInterface plus:
+			noise_amplitude : float [Default: 0.1]
+				Standard deviation of the Gaussian noise added to the measurement channels in V
+			response        : list of complex [Default: None]
+				Complex transfer of each measurement channel relative to the generated signal
+				None means a transfer of 1 on every channel
+			realtime        : boolean [Default: True]
+				Pace sample production against the computer clock
+				If False, samples are available as soon as they are requested
+		'''
+		self._gen_dev = gen_dev
+		self._meas_dev = meas_dev
+		self._noise_amplitude = noise_amplitude
+		self._realtime = realtime
+		self._gen_output_enabled = False
+		self._measuring = False
+		self._bufsize = 0
+		self._samples_read = 0
+		self._samples_lost = 0
+		self.set_meas_channels(meas_ch)
+		self.set_gen_channel(gen_ch)
+		self.set_gen_meas_channel(gen_meas_ch)
+		self.set_meas_sample_frequency(Fs)
+		self.set_channel_response(response)
+		self._gen_signal_frequency = Fsignal
+		self._gen_amplitude = gen_amplitude
+		self._gen_offset = gen_offset
+		self._external_frequencies = numpy.zeros(0)
+		self.set_gen_output_impedance(gen_output_impedance)
+		self._reset_phase_reference(0)
+
+	def close(self):
+		'''Stop generation and measurement, there are no sessions or tasks to release'''
+		if self._measuring:
+			self.end_measurement()
+		if self._gen_output_enabled:
+			self.stop_generation()
+
+	##############################
+	##### Channel functions ######
+	##############################
+
+	def set_meas_channels(self, ch):
+		'''
+		Set measurement channels, not including the channel for measuring the generated signal
+		If multiple channels are specified they must be put in a list
+		If only one channel is specified it can be in a list but doesn't have to
+		'''
+		if not isinstance(ch, list):
+			ch = [ch]
+		self._meas_ch = list(ch)
+		if hasattr(self, '_response') and len(self._response) != len(self._meas_ch):
+			self.set_channel_response(None)
+
+	def set_gen_meas_channel(self, ch):
+		'''Set channel for measuring generated signal'''
+		self._gen_meas_ch = ch
+
+	def set_gen_channel(self, ch):
+		'''Set generation channel'''
+		self._gen_ch = ch
+
+	def set_channel_response(self, response=None):
+		'''Set the complex transfer of each measurement channel, None means a transfer of 1 on every channel'''
+		if response is None:
+			response = [1.] * len(self._meas_ch)
+		if len(response) != len(self._meas_ch):
+			raise RuntimeError('Got {:d} channel responses for {:d} measurement channels'.format(len(response), len(self._meas_ch)))
+		self._response = numpy.array(response, dtype=complex)
+
+	def get_measurement_channels(self):
+		'''
+		Get measurement channels, not including the channel for measuring the generated signal
+		Always returns a list even if the number of channels is one
+		'''
+		return self._meas_ch
+
+	def get_generation_channel(self):
+		'''Get generation channel'''
+		return self._gen_ch
+
+	def get_generated_signal_measurement_channel(self):
+		'''Get channel for measuring generated signal'''
+		return self._gen_meas_ch
+
+	#########################################
+	##### Generator parameter functions #####
+	#########################################
+
+	def set_gen_signal_frequency(self, f):
+		'''
+		Set the generated signal frequency
+		Unlike the real generators this works while generating, with a continuous phase
+		The new frequency applies from the first sample which has not been retrieved yet
+		'''
+		fsignalmax = self._meas_fs / 2 #Nyquist
+		if f > fsignalmax:
+			logging.warning('Tried to set generated signal frequency to %f Hz, set to Nyquist limit %f Hz instead', f, fsignalmax)
+			f = fsignalmax
+		self._reset_phase_reference(self._samples_read)
+		self._gen_signal_frequency = f
+
+	def retune_gen_signal_frequency(self, f):
+		'''Set the generated signal frequency, which the simulated generator can do while generating anyway'''
+		self.set_gen_signal_frequency(f)
+
+	def set_gen_signal_amplitude(self, a):
+		'''Set the generated signal amplitude'''
+		self._gen_amplitude = a
+
+	def set_external_frequencies(self, freqs):
+		'''
+		Simulate sine waves at frequencies <freqs> from other generators, summed externally with the generated signal
+		They have the same amplitude and channel response as the generated signal and are on or off along with it
+		'''
+		self._external_frequencies = numpy.array(freqs, dtype=float)
+
+	def set_gen_output_impedance(self, Z):
+		'''Set waveform generator output impedance'''
+		self._gen_output_impedance = Z
+
+	def get_gen_signal_frequency(self):
+		'''Get the frequency of the generated signal'''
+		return self._gen_signal_frequency
+
+	def get_gen_signal_amplitude(self):
+		'''Get the amplitude of the generated signal'''
+		return self._gen_amplitude
+
+	def get_gen_signal_offset(self):
+		'''Get the DC offset of the generated signal'''
+		return self._gen_offset
+
+	###########################################
+	##### Measurement parameter functions #####
+	###########################################
+
+	def set_meas_sample_frequency(self, fs):
+		'''Set the measurement sample frequency'''
+		if self._measuring:
+			raise RuntimeWarning('set_meas_sample_frequency: Cannot change sample frequency while measuring')
+		fmin = MIN_SAMPLE_FREQUENCY_MEAS_SIM
+		fmax = MAX_SAMPLE_FREQUENCY_MEAS_SIM
+		if fs < fmin:
+			self._meas_fs = fmin
+			logging.warning('Tried to set measurement sample frequency to %f Hz, set to minimum %f Hz instead', fs, fmin)
+		elif fs > fmax:
+			self._meas_fs = fmax
+			logging.warning('Tried to set measurement sample frequency to %f Hz, set to maximum %f Hz instead', fs, fmax)
+		else:
+			self._meas_fs = fs
+
+	def get_meas_sample_frequency(self):
+		'''Get the sample frequency of the signal analyser'''
+		return self._meas_fs
+
+	####################################
+	##### Output control functions #####
+	####################################
+
+	def start_generation(self):
+		'''Start waveform generation'''
+		self._gen_output_enabled = True
+
+	def stop_generation(self):
+		'''Stop waveform generation'''
+		self._gen_output_enabled = False
+
+	###########################################
+	##### Simulated signal implementation #####
+	###########################################
+
+	def _reset_phase_reference(self, n):
+		'''Remember the generated signal phase at sample <n> so the frequency can change without a phase jump'''
+		if hasattr(self, '_phase_ref_sample'):
+			self._phase_ref = self._phase_at(n)
+		else:
+			self._phase_ref = 0.
+		self._phase_ref_sample = n
+
+	def _phase_at(self, n):
+		'''Phase of the generated signal at sample number(s) <n>'''
+		return self._phase_ref + 2 * numpy.pi * self._gen_signal_frequency / self._meas_fs * (n - self._phase_ref_sample)
+
+	def _generate(self, start, nsamples):
+		'''Generate a channels x samples array of the simulated signals for sample numbers <start> up to <start>+<nsamples>'''
+		n = numpy.arange(start, start + nsamples)
+		phase = self._phase_at(n)
+		data = numpy.empty([len(self._meas_ch) + 1, nsamples])
+		data[0] = numpy.sin(phase)
+		data[1:] = numpy.abs(self._response)[:, numpy.newaxis] * numpy.sin(phase + numpy.angle(self._response)[:, numpy.newaxis])
+		for f in self._external_frequencies:
+			phase = 2 * numpy.pi * f / self._meas_fs * n
+			data[0] += numpy.sin(phase)
+			data[1:] += numpy.abs(self._response)[:, numpy.newaxis] * numpy.sin(phase + numpy.angle(self._response)[:, numpy.newaxis])
+		data *= self._gen_amplitude if self._gen_output_enabled else 0.
+		data += self._gen_offset
+		data[1:] += numpy.random.normal(0, self._noise_amplitude, [len(self._meas_ch), nsamples])
+		return data
+
+	def _samples_generated(self):
+		'''Number of samples the simulated signal analyser has acquired since the start of the measurement'''
+		if self._realtime:
+			return int((time.time() - self._t_start) * self._meas_fs)
+		else:
+			return self._samples_read + self._bufsize
+
+	################################
+	##### Measurement function #####
+	################################
+
+	def do_measurement(self, nsamples, vmin=-10, vmax=10, timeout=1, config='PSEUDODIFF'):
+		'''
+		Measure signals
+		Returns a multidimensional array.
+		data[0][:] contains the measured generated signal, data[1:][:] contains the other measured signals
+		In real-time mode this takes as long as the measurement would take on real hardware
+		'''
+		if self._realtime:
+			time.sleep(float(nsamples) / self._meas_fs)
+		self._reset_phase_reference(0)
+		return self._generate(0, nsamples)
+
+	def measure_periods(self, nperiods, vmin=-10, vmax=10, timeout=10, config='PSEUDODIFF'):
+		'''Version of do_measurement() where you specify the number of signal periods (not necessarily integer) instead of the number of samples'''
+		nsamples = int(round(nperiods * self._meas_fs / float(self._gen_signal_frequency)))
+		return self.do_measurement(nsamples, vmin, vmax, timeout, config)
+
+	def measure_seconds(self, nseconds, vmin=-10, vmax=10, timeout=10, config='PSEUDODIFF'):
+		'''Version of do_measurement() where you specify the time in seconds (not necessarily integer) instead of the number of samples'''
+		nsamples = int(round(nseconds*self._meas_fs))
+		return self.do_measurement(nsamples, vmin, vmax, timeout, config)
+
+	def start_measurement(self, vmin=-10, vmax=10, config='PSEUDODIFF', bufsize=204800):
+		'''Start filling the simulated instrument buffer but don't acquire any samples to the computer just yet'''
+		if self._measuring:
+			raise RuntimeWarning('Already measuring')
+		self._bufsize = bufsize
+		self._samples_read = 0
+		self._samples_lost = 0
+		self._phase_ref_sample = 0
+		self._phase_ref = 0.
+		self._t_start = time.time()
+		self._measuring = True
+
+	def retrieve_samples(self, nsamples=1, timeout=1.0, assumebuffered=False):
+		'''
+		Retrieve the specified number of samples from the simulated instrument buffer, or all of them if <nsamples> is -1
+		Waits for the samples to be acquired if necessary
+		The timeout you specify is increased the time the measurement should take so you don't have to calculate this time yourself
+		This function returns a channels x samples array
+		'''
+		if not self._measuring:
+			raise RuntimeError('retrieve_samples: not measuring')
+		available = self.measured_samples_in_instrument_buffer()
+		if nsamples == -1:
+			nsamples = available
+		elif available < nsamples:
+			if not assumebuffered:
+				timeout += float(nsamples) / self._meas_fs
+			t_timeout = time.time() + timeout
+			while available < nsamples:
+				if time.time() > t_timeout:
+					raise RuntimeWarning('retrieve_samples: expected {:d} samples but got {:d}'.format(nsamples, available))
+				time.sleep(max(_RETRIEVE_POLL_INTERVAL, float(nsamples - available) / self._meas_fs))
+				available = self.measured_samples_in_instrument_buffer()
+		data = self._generate(self._samples_read, nsamples)
+		self._samples_read += nsamples
+		return data
+
+	def retrieve_periods(self, nperiods=1, timeout=1.0, assumebuffered=False):
+		'''Retrieve a number of samples corresponding to the specified number of signal periods'''
+		nsamples = int(round(nperiods * self._meas_fs / float(self._gen_signal_frequency)))
+		return self.retrieve_samples(nsamples, timeout, assumebuffered)
+
+	def retrieve_seconds(self, nseconds=1, timeout=0.1, assumebuffered=True):
+		'''Retrieve a number of samples corresponding to the specified time in seconds, rounded to an integer amount of signal periods'''
+		nperiods = round(nseconds*self._gen_signal_frequency)
+		return self.retrieve_periods(nperiods, timeout, assumebuffered)
+
+	def end_measurement(self):
+		'''Stop filling the simulated instrument buffer'''
+		self._measuring = False
+
+	###################################
+	##### Miscellaneous functions #####
+	###################################
+
+	def measured_samples_in_instrument_buffer(self):
+		'''
+		Find out how many samples are left in the simulated instrument buffer
+		When the buffer overflows, the oldest samples are skipped and a warning is logged
+		'''
+		if not self._measuring:
+			return 0
+		available = self._samples_generated() - self._samples_read
+		if available > self._bufsize:
+			lost = available - self._bufsize
+			self._samples_lost += lost
+			self._samples_read += lost
+			available = self._bufsize
+			logging.warning('Simulated instrument buffer overflow, skipped {:d} samples'.format(lost))
+		return available
+
+	def samples_lost(self):
+		'''Number of samples skipped due to buffer overflows since the start of the measurement'''
+		return self._samples_lost
@@ -28,46 +28,120 @@ Other features (most notably the simulated mode) also work on other, potentially
 non-Windows systems, provided they have a sufficiently recent version of Python
 installed along with the necessary Python packages.
 
+Usage: python main.py [COM port|NONE] [--simulated] [--tcp <port>] [--unix <path>] [--record-dir <path>] [--replay <path> [--replay-speed <speed>]]
+The COM port defaults to comport_to_use, --simulated uses simulated lock-ins (see use_simulated_lockins)
+--replay creates lock-ins which run on a recording made with RECORD START instead of on the instruments,
+each new lock-in replaying it from the start (at --replay-speed times real time, 0 for as fast as possible),
+so recorded data can be processed again with other settings such as SET T, ORDER or HARMONICS.
+The lock-ins follow the frequency changes of the recording and reset their filter at its gaps
+--tcp and --unix also accept commands from any number of clients on a TCP port (on tcp_host)
+or a Unix socket, one command per line just like on the COM port. Every client (and the COM port)
+has its own selected lock-in, so clients can use different lock-ins at the same time
+Commands are executed as soon as they arrive, benchmarks/bench_command_latency.py
+measures the round-trip latency over a pseudo-terminal pair
+benchmarks/bench_suite.py times the signal processing, reply formatting and command handling without
+NI hardware and writes the results to a JSON file, which a later run can compare with (--compare)
+The tests in tests/ run without NI hardware too: python -m unittest discover tests
+
+Several commands can be sent on one line separated by semicolons, for example
+SELECT 1;GET RPHI;SELECT 2;GET RPHI. They are executed in order while the results of all lock-ins
+are held still, so they describe the same moment, and answered with the replies separated by semicolons
+on one line (OK;OK 0.99, 0.01;OK;OK 1.01, 0.02). The batch stops at the first command which fails,
+whose reply is ERROR. A command which has to wait (GET SWEEP) ends the snapshot, the rest of the batch
+is executed after it
+
+Every command except SELECT can address a lock-in directly instead of using the selected one, by
+putting <lock-in>: in front of its arguments, for example GET 2:R, SET 2:F 1000 or SWEEP 1:100,200.
+START, STOP and CLOSE also accept just the lock-in number (START 2). R, PHI, X and Y can be followed
+by a measurement channel number to get only that channel, for example GET 1:PHI3 or GET R2 H2
+
 Supported commands:
 	SELECT
-		Select a lock-in instrument
-	SET F|FS|A|T|PHASEOFFSET|MEASCH <value>
+		Select a lock-in instrument for this connection
+	SET F|FS|A|T|PHASEOFFSET|MEASCH|ORDER|RATE|BUFLEN|HARMONICS|REFS <value>
 		Set the value of a variable of the selected lock-in instrument
 	GET RPHIBUFFER
 		Get multiline representation of all values of R and PHI acquired from
-		the selected lock-in instrument since last time they were queried
+		the selected lock-in instrument since last time they were queried on this connection
+		Each line starts with the time in seconds since START
+		In continuous mode the lock-in fills this buffer at the rate set by SET RATE
+		The buffer holds the last 1000 results (SET BUFLEN changes this), older results are overwritten
+		If results were overwritten before they were read, the reply starts with OK DROPPED <number>
 	GET RPHI|R|PHI|XY|X|Y
 		Get the last acquired values of R/PHI/X/Y from the selected lock-in
 		This function may still return multiple values (comma-separated) when
 		multiple channels are in use
-	GET F|FS|A|T|PHASEOFFSET
+		R, PHI, XY, X and Y wait for a new value if the last one has already been read as the same
+		variable on this connection. Reading does not take values away from other variables or
+		connections, so GET R followed by GET PHI gives both of the same integration interval
+	GET RPHI|R|PHI|XY|X|Y H<n>
+		Get the last acquired values of R/PHI/X/Y at the n-th harmonic of the
+		excitation frequency, which must be one of the harmonics set by SET HARMONICS
+	GET RPHI|R|PHI|XY|X|Y F<k> [H<n>]
+		Get the last acquired values of R/PHI/X/Y at the k-th reference frequency,
+		F1 being the excitation frequency and the others being set by SET REFS
+		All reference frequencies are demodulated from the same samples, so one signal
+		analyser can measure the transfers at several frequencies at once
+	GET F|FS|A|T|PHASEOFFSET|ORDER|RATE|BUFLEN|HARMONICS|REFS
 		Get value of excitation/measurement control variable of selected lock-in instrument
+	SET FORMAT TEXT|FLOAT32|FLOAT64
+		Set the format of array replies (R, PHI, buffers, ...) on this connection, TEXT by default
+		In FLOAT32 and FLOAT64 format an array reply is the line 'OK BIN <dtype> <shape> <sequence>'
+		followed by the raw data in C order, for example 'OK BIN <f4 12,5 3' followed by 12*5*4 bytes
+		of little-endian float32, which a Python client reads with numpy.frombuffer(data, '<f4').reshape(12, 5)
+		The sequence number counts the binary replies on the connection
+	GET FORMAT
+		Get the format of array replies on this connection
+	SET PRECISION <digits>
+		Set the number of significant digits of values in text replies on this connection, 0 (the default) for full precision
+	GET PRECISION
+		Get the number of significant digits of values in text replies on this connection
 	START
 		Start measurements on the selected lock-in instrument
 	STOP
 		Stop measurements on the selected lock-in instrument
 	CLOSE
 		Close the selected lock-in instrument
+		The other lock-ins keep their number, the next new lock-in gets the lowest free number
 	CLOSE ALL
 		Close all lock-in instruments and exit
+	RECORD START <path>
+		Record the raw samples of all channels of the selected lock-in instrument, as they are retrieved,
+		to .npy file <path> in the recording directory (see recording_dir and --record-dir). <path> must be
+		relative, must not contain .. and must not exist yet (numpy.load(path, mmap_mode='r') gives a channels x samples array, the first
+		channel being the generated signal). A metadata file with the same name and extension .json holds
+		the sample frequency, channel names, amplitude and the first sample, time and frequency of every block,
+		including gap markers where blocks were dropped because the disk could not keep up
+	RECORD STOP
+		Stop recording and finish the files, replies with the number of recorded samples
+	SWEEP <f1>,<f2>,...|<start> <stop> <points> [LIN|LOG]
+		Measure the selected lock-in instrument at a list of frequencies, running the whole
+		sweep without further commands. The filter time constant and settling time at every
+		frequency follow from the integration time (SET T) and the frequency
+	GET SWEEP
+		Get the results of the last sweep, waits until it has finished
+		Each line contains the frequency, the excitation amplitude and R and PHI of all channels
 	PHASENULL
 		Set the phase offset of the current lock-in instrument to the current phase
+	SUBSCRIBE [<lock-in>] R|PHI|X|Y|RPHI|XY[,...] [<rate>]
+		Push the results of a lock-in to this connection as soon as they are stored, instead of polling with GET
+		Every result is a line DATA <lock-in> <sequence number> <time>, <values of the variables for all channels>
+		In binary format the results come in a block with header DATA <lock-in> BIN <dtype> <results>,<values> <sequence>,
+		followed by the sequence numbers (int64), the times (float64) and then the values (<dtype>), all little-endian
+		If a client does not read fast enough, results are dropped instead of holding up the instrument,
+		and the next results which are sent are preceded by a line DATA <lock-in> DROPPED <number>
+		The results are decimated to <rate> Hz (default: all results), which needs an output rate set by SET RATE
+	UNSUBSCRIBE [<lock-in>]
+		Stop pushing the results of a lock-in, or of all lock-ins, to this connection
 
 Known issues:
  *  When setting parameters while a measurement is running, the parameters are never really
     set in the hardware. [Now solved for generator parameters (except channel) but not yet for Fs and channels]
- *  No getter for dl_selected
- *  When deleting a lock-in, the identifier of each lock-in with a higher identifier
-    than the deleted one decreases by one, which may not be the best behaviour
 
 Potential code readability/architecture enhancements:
  *  This file and digitallockin.py contain two lock-in implementations, the code may be
     cleaned up a lot by removing one of them
  *  Some global variables might be better suited as properties of a DigitalLockin object
- *  A DigitalLockin object currently holds a MeasurementHardwareInterface as a member
-    (if it  is not simulated), while in simulation mode it handles everything by itself.
-    Maybe it's a better idea to create a SimulatedHardwareInterface class and move all
-    simulation-specific code there.
  *  One may argue that using the HardwareInterface as a member is not as elegant as making
     DigitalLockin inherit from it. In principle I would agree; however since it would not
 	use the MeasurementHardwareInterface in simulated mode that would require a conditional
@@ -87,16 +161,34 @@ Fixed issues since the "known issues" list was created:
     or it may lead to values in the buffer being overwritten before the computer retrieves
     them, while the computer will assume that this does not happen.
  *  No instruction to retrieve detected reference signal amplitude (to which everything is normalised)
+ *  A DigitalLockin object handled simulation mode by itself and did not support continuous mode
+    in simulation. Simulation is now done by a SimulatedHardwareInterface which produces samples
+    in real time, so the continuous lock-in can be run without NI hardware.
+ *  No getter for dl_selected (the selected lock-in is now kept per connection)
+ *  When deleting a lock-in, the identifier of each lock-in with a higher identifier
+    than the deleted one decreased by one. Lock-ins now keep their identifier and SELECT
+    creates a new lock-in with the lowest free identifier
 '''
 
 import logging
 logging.root.setLevel(logging.INFO)
 import sys
+import os
+import re
+import stat
+import argparse
+import collections
+import functools
 import signal
 import serial
+import socket
+import threading
 import time
 import numpy
-import string
+try:
+	import queue
+except ImportError:
+	import Queue as queue
 
 import digitallockin as dlm
 
@@ -110,17 +202,27 @@ def interrupt_handler(signal, frame):
 	else:
 		interrupt_received = True
 		logging.info('got keyboard interrupt or similar signal, preparing to exit...')
-signal.signal(signal.SIGINT, interrupt_handler)
 
 ##### Constants which are probably (but not necessarily)
 ##### the same for you as for the author of the code
 MEASUREMENT_TIME_MAX = 0.5
-R_PHI_BUFFER_LEN_MAX = 1000
+R_PHI_BUFFER_LEN_DEFAULT = 1000 # Capacity of the R/PHI buffer of a new lock-in (see SET BUFLEN)
+R_PHI_BUFFER_LEN_MAX = 1000000
 CHANNELS_MAX = 3
+# One result in the R/PHI buffer of a lock-in (see LockinSession)
+RESULT_DTYPE = numpy.dtype([('t', numpy.float64), ('ref_amplitude', numpy.float64), ('amplitude', numpy.float64, (CHANNELS_MAX,)), ('phase', numpy.float64, (CHANNELS_MAX,))])
 MAX_BUFFERED_SAMPLES_AFTER_READ = 50000 # about 250 ms at maximum Fs
 MIN_BUFFERED_SAMPLES_AFTER_READ = 2000 # about 10 ms at maximum Fs
 TIME_CHANGE_IF_TOO_MANY_BUFFERED_SAMPLES = 0.01 # 10 ms
 TIME_CHANGE_IF_TOO_FEW_BUFFERED_SAMPLES = 0.001 # 1 ms
+SWEEP_PERIODS_MIN = 10. # Minimum filter time constant during a sweep, in signal periods
+SWEEP_SETTLE_ERROR = 1e-4 # Relative error of the filter output after settling at a sweep point
+MAIN_LOOP_INTERVAL = 0.01 # Interval at which the main loop collects lock-in results and retries waiting commands
+BINARY_REPLY_FORMATS = {'FLOAT32': '<f4', 'FLOAT64': '<f8'} # Data types of the binary reply formats (see SET FORMAT)
+SUBSCRIBE_SHORTHANDS = {'rphi': ['r', 'phi'], 'xy': ['x', 'y']} # Variables which stand for several variables in SUBSCRIBE
+SERIAL_ERROR_BACKOFF = 0.1 # Time to wait after the COM port could not be read
+SOCKET_SEND_QUEUE_MAX = 1000 # Writes waiting to be sent to a socket connection above which pushed results are dropped
+SOCKET_CLOSE_TIMEOUT = 1. # Time to wait for the writes to a socket connection to be sent when it is closed
 
 ##############################################################
 #####     Variables specific to our measurement setup    #####
@@ -130,47 +232,311 @@ available_waveform_generators = ['PXI5412_12', 'PXI5412_14']
 available_signal_analysers = ['PXI4462_3', 'PXI4462_4']
 comport_to_use = 'COM4' # Part of virtual pair COM3 <-> COM4
 #comport_to_use = '/dev/pts/3' # Part of virtual pair /dev/pts/2 <-> /dev/pts/3
-comport_timeout = 0.001
+comport_timeout = 0.1 # Only determines how quickly the COM port reader thread notices that the program exits
+tcp_host = '127.0.0.1' # Address on which to accept TCP connections, '' for all interfaces
+tcp_port = None # TCP port on which to accept connections (for example 5025), None to disable
+unix_socket_path = None # Path of a Unix socket on which to accept connections, None to disable
+recording_dir = 'recordings' # Directory in which RECORD START creates its files, clients cannot write outside of it
 integrationtime_default = 0.1
+output_rate_default = 0. # Rate at which continuous lock-ins fill the R/PHI buffers, 0 to disable
+use_simulated_lockins = False # Create lock-ins on a SimulatedHardwareInterface, for testing without NI hardware
+replay_recording = None # Path of a recording (see RECORD) on which to create lock-ins instead of on hardware, None to disable
+replay_speed = 1. # Speed relative to real time at which lock-ins replay replay_recording, 0 for as fast as possible
+acquisition_interval = 0.01 # Interval in seconds at which the acquisition thread of each lock-in retrieves and filters samples
 
 ############################
 ##### Helper functions #####
 ############################
-def _get_lockin(idx):
+class _Connection:
 	'''
-	Checks if lock-in with index <idx> exists (first index = 1)
-	Returns it if it does, throws error otherwise
+	A client connection: the COM port or a TCP or Unix socket connection
+	Each connection has its own partially received command and its own selected lock-in
 	'''
-	global dl
-	if 0 < idx <= len(dl):
-		return dl[idx-1]
-	else:
+
+	def __init__(self, port, name):
+		self.port = port # Anything with write() and close() methods, like a serial port
+		self.name = name
+		self.cmd = ''
+		self.selected = 0 # Default = none.
+		self.inbox = collections.deque() # Received data which has not been passed to command_loop() yet
+		self.format = 'TEXT' # Format of array replies, TEXT or one of BINARY_REPLY_FORMATS
+		self.precision = None # Significant digits of floats in text replies, None for full precision
+		self.sequence = 0 # Sequence number of the last binary reply
+		self.replies = [] # Replies to the commands of a batch which has not finished yet
+		self.cursors = {} # Read cursors of this connection in the R/PHI buffers, see LockinSession.unread_results
+		self.subscriptions = {} # LockinSession -> (variables, rate) of the results pushed to this connection, see publish_loop
+		self.push_dropped = {} # Lock-in ID -> number of results which could not be pushed since the last push which was sent
+
+	def waiting(self):
+		'''Check whether a complete command is waiting to be retried (e.g. for data to become available)'''
+		return len(self.cmd) > 0 and self.cmd[-1] == '\n'
+
+	def set(self, var, val):
+		'''Set connection variable <var> (lower case) to <val> (string), returns False if <var> is not a connection variable'''
+		if var == 'format':
+			if val.upper() != 'TEXT' and val.upper() not in BINARY_REPLY_FORMATS:
+				raise RuntimeError('SET: invalid format {:s}'.format(val))
+			self.format = val.upper()
+			return True
+		elif var == 'precision':
+			if int(val) < 0:
+				raise RuntimeError('SET: precision must be at least 0, got {:s}'.format(val))
+			self.precision = int(val) if int(val) > 0 else None
+			return True
+		return False
+
+	def get(self, var):
+		'''Get connection variable <var> (lower case) as reply string, returns None if <var> is not a connection variable'''
+		if var == 'format':
+			return 'OK {:s}\n'.format(self.format)
+		elif var == 'precision':
+			return 'OK {:d}\n'.format(0 if self.precision is None else self.precision)
+		return None
+
+	def push(self, lockin, seqs, x):
+		'''
+		Push results with sequence numbers <seqs> of lock-in number <lockin> to this connection
+		<x> has a row per result: the time since START followed by the subscribed variables
+		In text format every result is a line 'DATA <lockin> <sequence number> <time>, <values>'
+		In binary format the results are sent like a binary reply with header 'DATA <lockin> BIN <dtype> <results>,<values> ...'
+		of the variables, preceded by the sequence numbers as little-endian int64 and the times as little-endian float64,
+		so they stay exact whatever <dtype> is
+		If the port cannot take the results because the client does not read fast enough (see _poffer),
+		they are dropped and counted, and the next push which is sent starts with a line 'DATA <lockin> DROPPED <number>'
+		'''
+		dropped = self.push_dropped.get(lockin, 0)
+		header = 'DATA {:d} DROPPED {:d}\n'.format(lockin, dropped) if dropped > 0 else ''
+		if self.format == 'TEXT':
+			lines = _fmt_array_for_com(x, self.precision).split('\n')[1:]
+			data = header + ''.join(['DATA {:d} {:d} {:s}\n'.format(lockin, int(seq), line) for (seq, line) in zip(seqs, lines)])
+		else:
+			self.sequence += 1
+			preamble = numpy.asarray(seqs, dtype='<i8').tobytes() + numpy.asarray(x[:, 0], dtype='<f8').tobytes()
+			data = bytearray(header.encode('utf-8')) + _fmt_binary_reply(x[:, 1:], BINARY_REPLY_FORMATS[self.format], self.sequence, 'DATA {:d}'.format(lockin), preamble)
+		if _poffer(self.port, data):
+			self.push_dropped.pop(lockin, None)
+		else:
+			if dropped == 0:
+				logging.warning('Connection {:s} does not keep up with the results of lock-in {:d}, dropping them'.format(self.name, lockin))
+			self.push_dropped[lockin] = dropped + len(seqs)
+
+	def reply_formatter(self):
+		'''Get the function which formats array replies to GET commands in the format of this connection'''
+		if self.format == 'TEXT':
+			return functools.partial(_fmt_reply, precision=self.precision)
+		def fmt(x, prefix='OK'):
+			self.sequence += 1
+			return _fmt_binary_reply(x, BINARY_REPLY_FORMATS[self.format], self.sequence, prefix)
+		return fmt
+
+class _SocketPort:
+	'''
+	Gives a connected socket the write() and close() methods of a serial port
+	Writes are put in a send queue and sent by a writer thread, so a client which does not read
+	never blocks the main loop. offer() is write() for data which may be dropped (see _poffer)
+	'''
+
+	def __init__(self, sock, name):
+		self._sock = sock
+		self._queue = collections.deque()
+		self._cond = threading.Condition()
+		self._closing = False
+		self._writer = threading.Thread(target=self._writer_loop, name='Writer for {:s}'.format(name))
+		self._writer.daemon = True
+		self._writer.start()
+
+	def write(self, data):
+		with self._cond:
+			self._queue.append(data)
+			self._cond.notify()
+
+	def offer(self, data):
+		'''Queue <data> if fewer than SOCKET_SEND_QUEUE_MAX writes are waiting, returns whether it was queued'''
+		with self._cond:
+			if len(self._queue) >= SOCKET_SEND_QUEUE_MAX:
+				return False
+			self._queue.append(data)
+			self._cond.notify()
+			return True
+
+	def _writer_loop(self):
+		'''Main function of the writer thread, sends the queued writes until the port is closed and the queue is empty'''
+		while True:
+			with self._cond:
+				while len(self._queue) == 0 and not self._closing:
+					self._cond.wait()
+				if len(self._queue) == 0:
+					return
+				data = self._queue.popleft()
+			try:
+				self._sock.sendall(data)
+			except socket.error as e:
+				logging.warning('Could not send response: {:s}'.format(str(e)))
+				with self._cond:
+					self._queue.clear()
+
+	def close(self):
+		'''Close the socket once the queued writes have been sent, or after SOCKET_CLOSE_TIMEOUT'''
+		with self._cond:
+			self._closing = True
+			self._cond.notify()
+		self._writer.join(SOCKET_CLOSE_TIMEOUT)
+		try:
+			self._sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self._sock.close()
+
+class LockinSession(object):
+	'''
+	A lock-in and the bookkeeping main.py does for it: the timing of the measurement loop, the R/PHI buffer,
+	the phase offset and the last sweep
+	Sessions are kept in the sessions dictionary under their ID, which does not change when other lock-ins are closed
+	The R/PHI buffer is a ring buffer in one preallocated structured array of RESULT_DTYPE: the result with
+	sequence number <seq> is at index <seq> % capacity, and when it is full a new result overwrites the oldest one
+	'''
+	__slots__ = ['id', 'li', 'integrationtime', 'acquiretime', 'measperint', 't_lastmeas', 'meas_in_cur_int', 't_lastintegration', 'results', 'result_num', 'result_seq', 'phase_offset', 'sweep']
+
+	def __init__(self, sid, li):
+		self.id = sid
+		self.li = li # DigitalLockin object
+		self.integrationtime = integrationtime_default
+		self.acquiretime = integrationtime_default #TODO don't assume max_meastime > integrationtime_default
+		self.measperint = 1 #TODO don't assume max_meastime > integrationtime_default
+		self.t_lastmeas = 0.
+		self.meas_in_cur_int = 0
+		self.t_lastintegration = 0.
+		self.results = numpy.zeros([R_PHI_BUFFER_LEN_DEFAULT], dtype=RESULT_DTYPE)
+		self.result_num = 0 # Number of results in the R/PHI buffer
+		self.result_seq = 0 # Sequence number of the next result, i.e. the number of results stored since the lock-in was created
+		self.phase_offset = 0.
+		self.sweep = None # None or a dict describing the last frequency sweep
+
+	def store_result(self, t, ref_amplitude, amplitude, phase):
+		'''
+		Store one result in the R/PHI buffer, overwriting the oldest result if the buffer is full
+		The result gets sequence number result_seq, which then increases by one
+		'''
+		result = self.results[self.result_seq % len(self.results)]
+		result['t'] = t
+		result['ref_amplitude'] = ref_amplitude
+		result['amplitude'][:len(amplitude)] = amplitude
+		result['phase'][:len(phase)] = phase - self.phase_offset
+		self.result_num = min(self.result_num + 1, len(self.results))
+		self.result_seq += 1
+
+	def set_buffer_length(self, n):
+		'''Change the capacity of the R/PHI buffer to <n> results, keeping the most recent results which fit'''
+		if not 0 < n <= R_PHI_BUFFER_LEN_MAX:
+			raise RuntimeError('SET: buffer length must be between 1 and {:d}, got {:d}'.format(R_PHI_BUFFER_LEN_MAX, n))
+		num = min(self.result_num, n)
+		results = numpy.zeros([n], dtype=RESULT_DTYPE)
+		seqs = numpy.arange(self.result_seq - num, self.result_seq)
+		results[seqs % n] = self.results[seqs % len(self.results)]
+		self.results = results
+		self.result_num = num
+
+	def take(self, first, stop):
+		'''Get a copy of the results with sequence numbers <first> up to <stop>, which must be in the R/PHI buffer'''
+		return self.results[numpy.arange(first, stop) % len(self.results)]
+
+	def latest(self):
+		'''Get the most recent result, which must exist'''
+		return self.results[(self.result_seq - 1) % len(self.results)]
+
+	def unread_results(self, var, cursors, latest=False):
+		'''
+		Find the results which have not been read as <var> according to read cursors <cursors> and move the cursor past them
+		Returns (first, stop, dropped): the sequence numbers of the first unread result and of the result after the last one
+		(see take), and the number of results which were overwritten before they were read. Returns None if there are none
+		If <latest>, only the most recent result is returned and the results before it are not counted as dropped
+		Reading does not remove results, so other variables and other connections (which have their own cursors) can still read them
+		<cursors> maps (session, variable) to the sequence number of the first result which has not been read
+		'''
+		key = (self, var)
+		cursor = cursors.get(key, 0)
+		if self.result_num == 0 or cursor >= self.result_seq:
+			return None
+		first = self.result_seq - 1 if latest else max(cursor, self.result_seq - self.result_num)
+		cursors[key] = self.result_seq
+		return (first, self.result_seq, 0 if latest else first - cursor)
+
+def _get_session(sid):
+	'''
+	Checks if lock-in with ID <sid> exists
+	Returns its LockinSession if it does, throws error otherwise
+	'''
+	if sid in sessions:
+		return sessions[sid]
+	elif sid == 0:
 		raise RuntimeError('No lock-in selected')
+	else:
+		raise RuntimeError('No lock-in {:d}'.format(sid))
+
+def _get_lockin(sid):
+	'''
+	Checks if lock-in with ID <sid> exists
+	Returns it if it does, throws error otherwise
+	'''
+	return _get_session(sid).li
 
-def _fmt_array_for_com(x):
+def _fmt_array_for_com(x, precision=None):
 	'''
 	Formats array as string to be sent over com port
 	The last dimension is separated by commas and spaces
 	All other dimensions are separated by newlines
+	Floats are written with <precision> significant digits, or in full if it is None
+	The whole array is formatted by one % operation, so this is fast for long buffers
 	'''
-	x = numpy.array(x)
+	x = numpy.asarray(x)
+	if x.ndim == 0:
+		x = x.reshape(1)
+	if x.dtype.kind in 'iu':
+		valfmt = '%d'
+	elif precision is None:
+		valfmt = '%r'
+	else:
+		valfmt = '%.{:d}g'.format(precision)
 	if x.ndim > 1:
-		y = ''
-		for i in range(len(x)):
-			y = '{:s}{:s}'.format(y, _fmt_array_for_com(x[i]))
-		return 'OK {:d} lines\n{:s}'.format(len(x), y)
+		x = x.reshape([-1, x.shape[-1]])
+		linefmt = ', '.join([valfmt] * x.shape[1]) + '\n'
+		return 'OK {:d} lines\n{:s}'.format(len(x), (linefmt * len(x)) % tuple(x.ravel().tolist()))
+	elif len(x) == 0:
+		return 'EMPTY'
 	else:
-		if len(x) == 0:
-			return 'EMPTY'
-		else:
-			return string.join([str(z) for z in x], ', ') + '\n'
+		return (', '.join([valfmt] * len(x)) + '\n') % tuple(x.tolist())
+
+def _fmt_reply(x, precision=None, prefix='OK'):
+	'''
+	Formats array <x> as text reply to a GET command, with <precision> significant digits (None for full precision)
+	The reply starts with <prefix>
+	'''
+	return prefix + ' ' + _fmt_array_for_com(x, precision)
 
-def _new_lockin():
+def _fmt_binary_reply(x, dtype, sequence, prefix='OK', preamble=b''):
 	'''
-	Generates a new lock-in object with the first available waveform generator and the first available signal analyser
-	Also appends appropriate default values to all the arrays used for bookkeeping of lock-ins
+	Formats array <x> as binary reply to a GET command: the header line '<prefix> BIN <dtype> <shape> <sequence>'
+	followed by the raw data of <x> in C order as numpy type <dtype> (e.g. '<f4' for little-endian float32)
+	<shape> is comma-separated, the size of the data follows from it and <dtype>
+	<preamble> is written between the header line and the data (see _Connection.push)
+	Returns a bytearray, which _pwrite writes as is
 	'''
-	global waveform_generators_used, signal_analysers_used, dl, available_waveform_generators, available_signal_analysers, acquiretimes, measperint, integrationtimes, t_lastmeas, meas_in_cur_int, t_lastintegration, ref_amplitude_buffer, amplitude_buffer, phase_buffer, amplitude_num, phase_num, phase_offset
+	x = numpy.ascontiguousarray(numpy.atleast_1d(x), dtype=dtype)
+	header = '{:s} BIN {:s} {:s} {:d}\n'.format(prefix, x.dtype.str, ','.join([str(n) for n in x.shape]), sequence)
+	return bytearray(header.encode('utf-8')) + preamble + x.tobytes()
+
+def _new_session(sid, li):
+	'''Configure new lock-in object <li>, start its acquisition thread and add it to the sessions with ID <sid>'''
+	li.reserve_rawdata_seconds(integrationtime_default)
+	li.set_output_rate(output_rate_default)
+	li.start_acquisition_thread(acquisition_interval)
+	sessions[sid] = LockinSession(sid, li)
+
+def _new_lockin(sid):
+	'''
+	Generates a new lock-in object with ID <sid> using the first available waveform generator and the first available signal analyser
+	'''
+	global waveform_generators_used, signal_analysers_used, available_waveform_generators, available_signal_analysers
 	try:
 		gen_dev_idx = waveform_generators_used.index(False)
 	except Exception as e:
@@ -181,47 +547,240 @@ def _new_lockin():
 		raise RuntimeError('Out of signal analysers:\n{:s}'.format(str(e)))
 	waveform_generators_used[gen_dev_idx] = True
 	signal_analysers_used[meas_dev_idx] = True
-	dl.append(dlm.DigitalLockin(gen_dev=available_waveform_generators[gen_dev_idx], meas_dev=available_signal_analysers[meas_dev_idx]))
-	measperint.append(1) #TODO don't assume max_meastime > integrationtime_default
-	acquiretimes.append(integrationtime_default) #TODO don't assume max_meastime > integrationtime_default
-	integrationtimes.append(integrationtime_default)
-	t_lastmeas.append(0.)
-	meas_in_cur_int.append(0)
-	t_lastintegration.append(0.)
-	ref_amplitude_buffer.append(numpy.zeros([R_PHI_BUFFER_LEN_MAX]))
-	amplitude_buffer.append(numpy.zeros([R_PHI_BUFFER_LEN_MAX, CHANNELS_MAX]))
-	phase_buffer.append(numpy.zeros([R_PHI_BUFFER_LEN_MAX, CHANNELS_MAX]))
-	amplitude_num.append(0)
-	phase_num.append(0)
-	phase_offset.append(0.)
-
-def _new_simulated_lockin():
-	'''
-	Generates a new lock-in object using simulated instruments
-	Also appends appropriate default values to all the arrays used for bookkeeping of lock-ins
-	'''
-	global dl, acquiretimes, measperint, integrationtimes, t_lastmeas, meas_in_cur_int, t_lastintegration, ref_amplitude_buffer, amplitude_buffer, phase_buffer, amplitude_num, phase_num, phase_offset
-	dl.append(dlm.DigitalLockin(simulated=True))
-	measperint.append(1) #TODO don't assume max_meastime > integrationtime_default
-	acquiretimes.append(integrationtime_default) #TODO don't assume max_meastime > integrationtime_default
-	integrationtimes.append(integrationtime_default)
-	t_lastmeas.append(0.)
-	meas_in_cur_int.append(0)
-	t_lastintegration.append(0.)
-	ref_amplitude_buffer.append(numpy.zeros([R_PHI_BUFFER_LEN_MAX]))
-	amplitude_buffer.append(numpy.zeros([R_PHI_BUFFER_LEN_MAX, CHANNELS_MAX]))
-	phase_buffer.append(numpy.zeros([R_PHI_BUFFER_LEN_MAX, CHANNELS_MAX]))
-	amplitude_num.append(0)
-	phase_num.append(0)
-	phase_offset.append(0.)
+	_new_session(sid, dlm.DigitalLockin(gen_dev=available_waveform_generators[gen_dev_idx], meas_dev=available_signal_analysers[meas_dev_idx]))
+
+def _new_simulated_lockin(sid):
+	'''
+	Generates a new lock-in object with ID <sid> using simulated instruments
+	'''
+	_new_session(sid, dlm.DigitalLockin(simulated=True))
+
+def _new_replay_lockin(sid):
+	'''
+	Generates a new lock-in object with ID <sid> which replays replay_recording from its start
+	'''
+	_new_session(sid, dlm.DigitalLockin(replay=replay_recording, replay_speed=replay_speed))
+
+def _get_harmonic(session, var, harmonic, ref=1, fmt=_fmt_reply):
+	'''
+	Getter for R/PHI/X/Y at harmonic <harmonic> of reference frequency number <ref> on the lock-in of <session>
+	Reference frequency 1 is the excitation frequency, the others are set by SET REFS
+	Returns value in COMport-compliant string format, arrays are formatted by <fmt>
+	'''
+	(rref, r, phi) = session.li.get_harmonic_results(harmonic, ref)
+	phi = phi - harmonic * session.phase_offset
+	if var == 'rphi':
+		return fmt(numpy.append(numpy.append(rref, r), phi))
+	elif var == 'r':
+		return fmt(r)
+	elif var == 'phi':
+		return fmt(phi)
+	elif var == 'xy':
+		return fmt(numpy.append(r*numpy.cos(phi), r*numpy.sin(phi)))
+	elif var == 'x':
+		return fmt(r*numpy.cos(phi))
+	elif var == 'y':
+		return fmt(r*numpy.sin(phi))
+	else:
+		raise RuntimeError('GET: variable {:s} is not available per harmonic or reference frequency'.format(var))
+
+def _parse_harmonic_modifiers(modifiers):
+	'''Parse the H<n> and F<k> modifiers of a GET command, returns (harmonic, reference frequency number)'''
+	harmonic = 1
+	ref = 1
+	for m in modifiers:
+		if m[0] == 'h':
+			harmonic = int(m[1:])
+		elif m[0] == 'f':
+			ref = int(m[1:])
+		else:
+			raise RuntimeError('GET: invalid modifier {:s}'.format(m))
+	return (harmonic, ref)
+
+def _parse_address(args, default):
+	'''
+	Split the lock-in address off the arguments <args> of a command, e.g. '2:R' addresses lock-in 2
+	Returns (lock-in index, remaining arguments), the index is <default> if there is no address
+	'''
+	m = re.match(r'^\s*(\d+):(.*)$', args)
+	if m is None:
+		return (default, args)
+	return (int(m.group(1)), m.group(2))
+
+def _parse_channel(var):
+	'''
+	Split the channel number off GET variable <var> (lower case), e.g. 'phi3' is channel 3 of PHI
+	Returns (variable, channel number), the channel number is None if there is none
+	'''
+	m = re.match(r'^(r|phi|x|y)(\d+)$', var)
+	if m is None:
+		return (var, None)
+	return (m.group(1), int(m.group(2)))
+
+def _channel_formatter(fmt, ch):
+	'''Get a reply formatter which formats only the value of channel <ch> (first channel = 1) of a per-channel array with <fmt>'''
+	def channel_fmt(x, prefix='OK'):
+		x = numpy.atleast_1d(x)
+		if not 0 < ch <= len(x):
+			raise RuntimeError('GET: no channel {:d}, there are {:d} channels'.format(ch, len(x)))
+		return fmt(x[ch-1:ch], prefix=prefix)
+	return channel_fmt
+
+def _settle_time(tau, order):
+	'''
+	Time after which the step response of a cascade of <order> alpha filters with time constant <tau>
+	is within SWEEP_SETTLE_ERROR of its final value
+	The remaining error after x time constants is exp(-x) * sum(x^k / k!) for k < order
+	'''
+	x = 0.
+	while True:
+		x += 0.1
+		term = 1.
+		error = 0.
+		for k in range(order):
+			error += term
+			term *= x / (k + 1)
+		if numpy.exp(-x) * error < SWEEP_SETTLE_ERROR:
+			return x * tau
+
+def _sweep_to_point(session):
+	'''Retune the lock-in of <session> to the current frequency of its sweep and set the time at which it has settled'''
+	sweep = session.sweep
+	f = sweep['freqs'][sweep['idx']]
+	tau = max(sweep['tau'], SWEEP_PERIODS_MIN / f)
+	session.li.retune(f)
+	session.li.set_flt_time_constant(tau)
+	sweep['t_next'] = time.time() + _settle_time(tau, session.li.get_flt_order())
+
+def _end_sweep(session):
+	'''Restore the frequency and time constant of the lock-in of <session> from before its sweep, and stop it if the sweep started it'''
+	sweep = session.sweep
+	li = session.li
+	li.set_flt_time_constant(sweep['tau'])
+	if li.is_measuring():
+		li.retune(sweep['f'])
+		if sweep['started']:
+			stop_lockin(li)
+	else:
+		li.set(F=sweep['f'])
+	sweep['done'] = True
+
+def _serial_reader(p, conn, lines):
+	'''
+	Main function of the COM port reader thread, puts everything read from port <p> in queue <lines> as (<conn>, data)
+	readline() returns as soon as a line is complete, so commands are handled the moment they arrive
+	On a timeout it may return part of a line, which command_loop() puts together again
+	'''
+	while not interrupt_received:
+		try:
+			data = p.readline()
+		except serial.SerialException as e:
+			if str(e) != 'read failed: (4, \'Interrupted system call\')':
+				logging.error('Could not read command:\n{:s}'.format(str(e)))
+				time.sleep(SERIAL_ERROR_BACKOFF)
+			continue
+		if len(data) > 0:
+			if not isinstance(data, str):
+				data = data.decode('utf-8')
+			lines.put((conn, data))
+
+def _socket_reader(sock, conn, lines):
+	'''
+	Main function of the reader thread of a socket connection, puts every line read from <sock> in queue <lines> as (<conn>, line)
+	When the connection is closed it puts (<conn>, None) in the queue
+	'''
+	f = sock.makefile('rb')
+	try:
+		while True:
+			data = f.readline()
+			if len(data) == 0:
+				break
+			if not isinstance(data, str):
+				data = data.decode('utf-8')
+			lines.put((conn, data))
+	except socket.error as e:
+		logging.info('Connection {:s} failed: {:s}'.format(conn.name, str(e)))
+	lines.put((conn, None))
+
+def _socket_listener(server, name, lines):
+	'''
+	Main function of the thread which accepts connections on listening socket <server>
+	Every connection gets a _Connection, which is announced by putting (connection, '') in queue <lines>, and a reader thread
+	'''
+	while not interrupt_received:
+		try:
+			(sock, address) = server.accept()
+		except socket.error as e:
+			if interrupt_received:
+				break
+			logging.error('Could not accept connection on {:s}:\n{:s}'.format(name, str(e)))
+			time.sleep(SERIAL_ERROR_BACKOFF)
+			continue
+		conn_name = '{:s} {:s}'.format(name, str(address)) if address else name
+		conn = _Connection(_SocketPort(sock, conn_name), conn_name)
+		lines.put((conn, ''))
+		thread = threading.Thread(target=_socket_reader, args=(sock, conn, lines), name='Reader for {:s}'.format(conn.name))
+		thread.daemon = True
+		thread.start()
+
+def _open_server(family, address, name, lines):
+	'''Listen for connections of address family <family> on <address> and start a thread which accepts them, returns the listening socket'''
+	server = socket.socket(family, socket.SOCK_STREAM)
+	if family == socket.AF_INET:
+		server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	server.bind(address)
+	server.listen(5)
+	thread = threading.Thread(target=_socket_listener, args=(server, name, lines), name='Listener on {:s}'.format(name))
+	thread.daemon = True
+	thread.start()
+	logging.info('Accepting connections on {:s}'.format(name))
+	return server
+
+def _join_replies(replies):
+	'''
+	Combines the replies to a batch of commands into one reply, separated by semicolons and ended by one newline
+	The trailing newline of each text reply is replaced by the separator, multi-line and binary replies are kept whole
+	'''
+	if len(replies) == 1:
+		return replies[0]
+	parts = [r[:-1] if not isinstance(r, bytearray) and r.endswith('\n') else r for r in replies]
+	if any([isinstance(r, bytearray) for r in parts]):
+		return bytearray(b';').join([r if isinstance(r, bytearray) else bytearray(r.encode('utf-8')) for r in parts]) + bytearray(b'\n')
+	return ';'.join(parts) + '\n'
+
+def _hold_lockins():
+	'''Keep the acquisition threads of all lock-ins from changing their results until _release_lockins()'''
+	for session in sessions.values():
+		session.li.hold()
+		held_lockins.append(session.li)
+
+def _release_lockins():
+	'''Let the acquisition threads held by _hold_lockins() continue'''
+	while len(held_lockins) > 0:
+		held_lockins.pop().release()
 
 def _pwrite(p, stw):
-	'''Helper function to write string <stw> to port <p> as UTF-8 encoded byte list'''
+	'''Helper function to write string <stw> to port <p> as UTF-8 encoded byte list, a bytearray is written as is'''
+	if isinstance(stw, bytearray):
+		p.write(bytes(stw))
+		return
 	if stw[-1] != '\n':
 		stw += '\n'
 	p.write(bytes(bytearray(stw, encoding='utf-8')))
 	#logging.info('Response: {:s}'.format(stw.strip()))
 
+def _poffer(p, stw):
+	'''
+	Like _pwrite, for data which is sent without being asked for and may be dropped
+	A port with a send queue (_SocketPort) refuses it when the queue is full, returns whether it was written
+	'''
+	if not hasattr(p, 'offer'):
+		_pwrite(p, stw)
+		return True
+	if not isinstance(stw, bytearray):
+		stw = bytearray(stw, encoding='utf-8')
+	return p.offer(bytes(stw))
+
 def _inttime_to_meastime(inttime, max_meastime):
 	'''Determine how many times to measure per integration period, returns the number of times and the time per measurement'''
 	i = int(numpy.ceil(float(inttime) / max_meastime))
@@ -231,34 +790,44 @@ def _inttime_to_meastime(inttime, max_meastime):
 ##### Functional functions #####
 ################################
 
-def select_lockin(s):
+def select_lockin(s, conn):
 	'''
-	Selects a measurement channel
-	If the measurement channel does not exist but is the next one to be created, tries to create it
+	Selects the lock-in with ID <s> for connection <conn>
+	If the lock-in does not exist but <s> is the lowest free ID, tries to create it
 	'''
-	global dl, dl_selected
-	if s <= len(dl): #Existing channel
-		dl_selected = s
+	if s in sessions: #Existing lock-in
+		conn.selected = s
 		logging.info('Selected lockin {:d}'.format(s))
-	elif s == len(dl) + 1: #New channel
+	elif s == _free_session_id(): #New lock-in
 		try:
-			_new_lockin()
-			#_new_simulated_lockin()
-			dl_selected = s
+			if replay_recording is not None:
+				_new_replay_lockin(s)
+			elif use_simulated_lockins:
+				_new_simulated_lockin(s)
+			else:
+				_new_lockin(s)
+			conn.selected = s
 			logging.info('Created and selected lockin {:d}'.format(s))
 		except Exception as e:
 			#raise RuntimeError('SELECT: Failed to create new channel:\n{:s}'.format(str(e)))
 			e.args = ('SELECT: Failed to create new channel:',) + (e.args)
 			raise
-	else: #Uncreatable channel
-		raise RuntimeError('SELECT: Channel {:d} does not exist and is not the next one to be created'.format(s))
+	else: #Uncreatable lock-in
+		raise RuntimeError('SELECT: Lock-in {:d} does not exist and is not the next one to be created ({:d})'.format(s, _free_session_id()))
+
+def _free_session_id():
+	'''Get the lowest lock-in ID which is not in use, which is the ID the next lock-in gets'''
+	sid = 1
+	while sid in sessions:
+		sid += 1
+	return sid
 
-def get(idx, var, firsttry=True):
+def get(idx, var, firsttry=True, fmt=_fmt_reply, cursors=None):
 	'''
 	Getter for variable with name <var> on lock-in <li>
 	Returns value in COMport-compliant string format
 	Supported variables:
-		RPHIBUFFER  : buffer of floats : excitation amplitude and detected amplitude and phase relative to excitation signal
+		RPHIBUFFER  : buffer of floats : time since START, excitation amplitude and detected amplitude and phase relative to excitation signal
 		RPHI        :  list of floats  : excitation amplitude and detected amplitude and phase relative to excitation signal
 		R           :  list of floats  : detected amplitude relative to excitation amplitude
 		PHI         :  list of floats  : detected phase relative to excitation phase
@@ -270,7 +839,20 @@ def get(idx, var, firsttry=True):
 		A           :       float      : excitation amplitude
 		T           :       float      : integration time
 		PHASEOFFSET :       float      : phase offset (set by PHASENULL)
+		ORDER       :        int       : filter order of the continuous lock-in
+		RATE        :       float      : rate at which the continuous lock-in fills the R/PHI buffers
+		BUFLEN      :        int       : capacity of the R/PHI buffer
+		HARMONICS   :   list of ints   : harmonics of the excitation frequency which are demodulated
+		REFS        :  list of floats  : reference frequencies which are demodulated in addition to the excitation frequency
+		SWEEP       : buffer of floats : results of the last sweep, waits until the sweep has finished
+	RPHI, R, PHI, XY, X and Y can be followed by H<n> to get the value at the n-th harmonic, for example 'r h2',
+	and/or by F<k> to get the value at the k-th reference frequency (F1 being the excitation frequency), for example 'r f2 h2'
 	For a buffer of floats, a multi-line representation of the buffer is returned
+	RPHIBUFFER returns the results which have not been read as RPHIBUFFER before, R, PHI, XY, X and Y
+	return the most recent result if it has not been read as the same variable before, otherwise they wait
+	What has been read is kept in read cursors <cursors> (see LockinSession.unread_results), so reading R does not
+	take the result away from PHI or from other connections. Without <cursors>, everything is unread
+	Arrays (buffers and lists) are formatted by <fmt>, which makes the whole reply (see _fmt_reply and _fmt_binary_reply)
 	Values corresponding to the same integration interval but different channels are printed on the same line, separated by commas
 	Values corresponding to subsequent integration intervals are printed on subsequent lines
 	If R and PHI are both requested and there are multiple channels, both variables are still printed on
@@ -278,24 +860,29 @@ def get(idx, var, firsttry=True):
 	R(ch1), R(ch2), R(ch3), PHI(ch1), PHI(ch2), PHI(ch3)
 	'''
 	try:
-		global ref_amplitude_buffer, amplitude_buffer, phase_buffer, integrationtimes, phase_offset
-		li = _get_lockin(idx)
+		session = _get_session(idx)
+		li = session.li
+		if cursors is None:
+			cursors = {}
+		if len(var.split()) > 1:
+			(harmonic, ref) = _parse_harmonic_modifiers(var.split()[1:])
+			return _get_harmonic(session, var.split()[0], harmonic, ref, fmt)
 		if var == 'rphibuffer':
-			if amplitude_num[idx-1] == 0 or phase_num[idx-1] == 0:
+			unread = session.unread_results(var, cursors)
+			if unread is None:
 				if firsttry:
 					logging.warning('GET: Tried to read RPHIBUFFER but it is not available, will try again next iteration')
 				return None
-			dnum = amplitude_num[idx-1] - phase_num[idx-1]
-			rref = ref_amplitude_buffer[idx-1][max(0,dnum):amplitude_num[idx-1]]
-			r = amplitude_buffer[idx-1][max(0,dnum):amplitude_num[idx-1],:dl[idx-1].get_num_meas_ch()]
-			r = numpy.append(numpy.array([rref]).T, r, axis=1)
-			phi = phase_buffer[idx-1][max(0,-dnum):phase_num[idx-1],:dl[idx-1].get_num_meas_ch()]
-			bufstr = _fmt_array_for_com(numpy.append(r, phi, 1))
-			amplitude_num[idx-1] = 0
-			phase_num[idx-1] = 0
-			return 'OK ' + bufstr
+			(first, stop, dropped) = unread
+			nch = li.get_num_meas_ch()
+			results = session.take(first, stop)
+			data = numpy.column_stack([results['t'], results['ref_amplitude'], results['amplitude'][:,:nch], results['phase'][:,:nch]])
+			if dropped > 0:
+				logging.warning('GET: {:d} results of lock-in {:d} were overwritten before they were read, SET BUFLEN to keep more'.format(dropped, idx))
+				return fmt(data, prefix='OK DROPPED {:d}'.format(dropped))
+			return fmt(data)
 		elif var == 'rphi':
-			return 'OK ' + _fmt_array_for_com(numpy.append(*li.continuous_get_r_phi()))
+			return fmt(numpy.append(*li.continuous_get_r_phi()))
 			''' Non-continuous lock-in
 			if amplitude_num[idx-1] == 0 or phase_num[idx-1] == 0:
 				if firsttry:
@@ -310,57 +897,25 @@ def get(idx, var, firsttry=True):
 			phase_num[idx-1] = 0
 			return 'OK ' + valstr
 			'''
-		elif var == 'r':
-			if amplitude_num[idx-1] == 0:
-				if firsttry:
-					logging.warning('GET: Tried to read R but it is not available, will try again next iteration')
-				return None
-			logging.info('Returning {:d} values of R'.format(amplitude_num[idx-1]))
-			rvalstr = _fmt_array_for_com(amplitude_buffer[idx-1][amplitude_num[idx-1]-1,:dl[idx-1].get_num_meas_ch()])
-			amplitude_num[idx-1] = 0
-			return 'OK ' + rvalstr
-		elif var == 'phi':
-			if phase_num[idx-1] == 0:
-				if firsttry:
-					logging.warning('GET: Tried to read PHI but it is not available, will try again next iteration')
-				return None
-			logging.info('Returning {:d} values of phi'.format(phase_num[idx-1]))
-			phivalstr = _fmt_array_for_com(phase_buffer[idx-1][phase_num[idx-1]-1,:dl[idx-1].get_num_meas_ch()])
-			phase_num[idx-1] = 0
-			return 'OK ' + phivalstr
-		elif var == 'xy':
-			if amplitude_num[idx-1] == 0 or phase_num[idx-1] == 0:
-				if firsttry:
-					logging.warning('GET: Tried to read XY but it is not available, will try again next iteration')
-				return None
-			r = amplitude_buffer[idx-1][amplitude_num[idx-1]-1,:dl[idx-1].get_num_meas_ch()]
-			phi = phase_buffer[idx-1][phase_num[idx-1]-1,:dl[idx-1].get_num_meas_ch()]
-			valstr = _fmt_array_for_com(numpy.append(r*numpy.cos(phi), r*numpy.sin(phi)))
-			amplitude_num[idx-1] = 0
-			phase_num[idx-1] = 0
-			return 'OK ' + valstr
-		elif var == 'x':
-			if amplitude_num[idx-1] == 0 or phase_num[idx-1] == 0:
+		elif var in ['r', 'phi', 'xy', 'x', 'y']:
+			unread = session.unread_results(var, cursors, latest=True)
+			if unread is None:
 				if firsttry:
-					logging.warning('GET: Tried to read X but it is not available, will try again next iteration')
+					logging.warning('GET: Tried to read {:s} but it is not available, will try again next iteration'.format(var.upper()))
 				return None
-			r = amplitude_buffer[idx-1][amplitude_num[idx-1]-1,:dl[idx-1].get_num_meas_ch()]
-			phi = phase_buffer[idx-1][phase_num[idx-1]-1,:dl[idx-1].get_num_meas_ch()]
-			xstr = _fmt_array_for_com(r * numpy.cos(phi))
-			amplitude_num[idx-1] = 0
-			phase_num[idx-1] = 0
-			return 'OK ' + xstr
-		elif var == 'y':
-			if amplitude_num[idx-1] == 0 or phase_num[idx-1] == 0:
-				if firsttry:
-					logging.warning('GET: Tried to read Y but it is not available, will try again next iteration')
-				return None
-			r = amplitude_buffer[idx-1][amplitude_num[idx-1]-1,:dl[idx-1].get_num_meas_ch()]
-			phi = phase_buffer[idx-1][phase_num[idx-1]-1,:dl[idx-1].get_num_meas_ch()]
-			ystr = _fmt_array_for_com(r * numpy.sin(phi))
-			amplitude_num[idx-1] = 0
-			phase_num[idx-1] = 0
-			return 'OK ' + ystr
+			result = session.latest()
+			r = result['amplitude'][:li.get_num_meas_ch()]
+			phi = result['phase'][:li.get_num_meas_ch()]
+			if var == 'r':
+				return fmt(r)
+			elif var == 'phi':
+				return fmt(phi)
+			elif var == 'xy':
+				return fmt(numpy.append(r*numpy.cos(phi), r*numpy.sin(phi)))
+			elif var == 'x':
+				return fmt(r * numpy.cos(phi))
+			else:
+				return fmt(r * numpy.sin(phi))
 		elif var == 'f':
 			return 'OK {:f}\n'.format(li.get_f())
 		elif var == 'fs':
@@ -368,9 +923,27 @@ def get(idx, var, firsttry=True):
 		elif var == 'a':
 			return 'OK {:f}\n'.format(li.get_gen_amplitude())
 		elif var == 't':
-			return 'OK {:f}\n'.format(integrationtimes[idx-1])
+			return 'OK {:f}\n'.format(session.integrationtime)
 		elif var == 'phaseoffset':
-			return 'OK {:f}\n'.format(phase_offset[idx-1])
+			return 'OK {:f}\n'.format(session.phase_offset)
+		elif var == 'buflen':
+			return 'OK {:d}\n'.format(len(session.results))
+		elif var == 'order':
+			return 'OK {:d}\n'.format(li.get_flt_order())
+		elif var == 'rate':
+			return 'OK {:f}\n'.format(li.get_output_rate())
+		elif var == 'harmonics':
+			return fmt(li.get_harmonics())
+		elif var == 'refs':
+			return fmt(li.get_extra_frequencies())
+		elif var == 'sweep':
+			if session.sweep is None:
+				raise RuntimeError('GET: no sweep has been started')
+			if not session.sweep['done']:
+				return None
+			results = session.sweep['results']
+			session.sweep = None
+			return fmt(numpy.array(results))
 		else:
 			raise RuntimeError('GET: invalid variable {:s}'.format(var))
 	except Exception as e:
@@ -387,13 +960,22 @@ def set(idx, var, val):
 		T           :  float  : integration time [s]
 		PHASEOFFSET :  float  : phase which is considered zero [radians]
 		MEASCH : list(string) : measurement channels (excluding the one measuring the generated signal)
+		ORDER       :   int   : filter order of the continuous lock-in (number of cascaded alpha filters)
+		RATE        :  float  : rate at which the continuous lock-in fills the R/PHI buffers [Hz], 0 to disable
+		BUFLEN      :   int   : capacity of the R/PHI buffer, when it is full the oldest results are overwritten
+		HARMONICS :  list(int) : harmonics of the excitation frequency to demodulate (the fundamental is always included)
+		REFS    : list(float) : reference frequencies to demodulate in addition to the excitation frequency [Hz], 0 for none
+		                        These must be present on the generated signal measurement channel, for example
+		                        from other generators which are summed with the excitation externally
 	Examples:
 		set('F', '1000.0')
 		set('MEASCH', 'ai1,ai2,ai3')
+		set('HARMONICS', '1,2,3')
+		set('REFS', '1300,1700')
 	Note: setting the integration time while a measurement is running might lead to timing issues and/or skipped samples, so don't do this
 	'''
-	global integrationtimes, measperint, acquiretimes, phase_offset
-	li = _get_lockin(idx)
+	session = _get_session(idx)
+	li = session.li
 	if var == 'f':
 		li.set(F=float(val))
 	elif var == 'fs':
@@ -402,11 +984,14 @@ def set(idx, var, val):
 		li.set(A=float(val))
 	elif var == 't':
 		li.set_flt_time_constant(float(val))
-		integrationtimes[idx-1] = float(val)
-		(measperint[idx-1], acquiretimes[idx-1]) = _inttime_to_meastime(val, MEASUREMENT_TIME_MAX)
-		logging.info('Tint={:.2f}, dt={:.2f}, ratio={:d}'.format(integrationtimes[idx-1], acquiretimes[idx-1], measperint[idx-1]))
+		session.integrationtime = float(val)
+		li.reserve_rawdata_seconds(session.integrationtime)
+		(session.measperint, session.acquiretime) = _inttime_to_meastime(val, MEASUREMENT_TIME_MAX)
+		logging.info('Tint={:.2f}, dt={:.2f}, ratio={:d}'.format(session.integrationtime, session.acquiretime, session.measperint))
 	elif var == 'phaseoffset':
-		phase_offset[idx-1] = float(val)
+		session.phase_offset = float(val)
+	elif var == 'buflen':
+		session.set_buffer_length(int(val))
 	elif var == 'measch':
 		ch = val.split(',')
 		for i in range(len(ch)):
@@ -419,203 +1004,500 @@ def set(idx, var, val):
 		li.set_channels(meas_ch=ch)
 	elif var == 'alpha':
 		li.set_flt_alpha(float(val))
+	elif var == 'order':
+		li.set_flt_order(int(val))
+	elif var == 'rate':
+		li.set_output_rate(float(val))
+	elif var == 'harmonics':
+		li.set_harmonics([int(h) for h in val.split(',')])
+	elif var == 'refs':
+		li.set_extra_frequencies([float(f) for f in val.split(',') if float(f) != 0])
 	else:
 		raise RuntimeError('SET: invalid variable {:s} (tried to assign value {:s})'.format(var, val))
 
-def phasenull(ch='1'):
-	'''Set the phase offset to compensate for the last measured phase of the <ch>th measurement channel'''
+def phasenull(idx, ch='1'):
+	'''Set the phase offset of lock-in <idx> (first index = 1) to compensate for the last measured phase of the <ch>th measurement channel'''
 	try:
 		ch = int(ch) - 1
 	except ValueError as e:
 		logging.warning('Cannot apply phase-nulling to channel number {:s}, will default to channel 1'.format(ch))
 		ch = 0
-	global phase_offset
-	if bool(dl_selected):
-		if bool(phase_num[dl_selected-1]):
-			phase_offset_increase = phase_buffer[dl_selected-1][phase_num[dl_selected-1]-1, ch]
-			logging.info('Phase offset for lock-in {:d} was {:f} rad, increases by {:f} rad based on channel {:d}'.format(dl_selected, phase_offset[dl_selected-1], phase_offset_increase, ch+1))
-			phase_offset[dl_selected-1] += phase_offset_increase
+	if bool(idx):
+		session = _get_session(idx)
+		if bool(session.result_num):
+			phase_offset_increase = session.latest()['phase'][ch]
+			logging.info('Phase offset for lock-in {:d} was {:f} rad, increases by {:f} rad based on channel {:d}'.format(idx, session.phase_offset, phase_offset_increase, ch+1))
+			session.phase_offset += phase_offset_increase
 		else:
 			raise RuntimeError('Could not phase-null because no phase information is available')
 	else:
 		raise RuntimeError('Could not phase-null because no lock-in is selected')
 
+def subscribe(conn, idx, variables, rate=0.):
+	'''
+	Push the results of lock-in <idx> (first index = 1) to connection <conn> as they are stored, see publish_loop
+	<variables> is a comma-separated list of R, PHI, X and Y (RPHI and XY are short for R,PHI and X,Y)
+	<rate> is the rate in Hz at which results are pushed, 0 for every result
+	The results are decimated to this rate, so it is rounded to the output rate of the lock-in (SET RATE) divided by an integer
+	'''
+	session = _get_session(idx)
+	li = session.li
+	names = []
+	for v in variables.lower().split(','):
+		names.extend(SUBSCRIBE_SHORTHANDS.get(v, [v]))
+	for v in names:
+		if v not in ['r', 'phi', 'x', 'y']:
+			raise RuntimeError('SUBSCRIBE: invalid variable {:s}'.format(v))
+	if li.get_output_rate() <= 0:
+		raise RuntimeError('SUBSCRIBE: lock-in {:d} produces no results, SET RATE first'.format(idx))
+	conn.cursors[(session, 'subscribe')] = session.result_seq
+	conn.subscriptions[session] = (names, rate)
+
+def _subscription_decimation(li, rate):
+	'''Push every how many-th result of lock-in <li> to push results at <rate> Hz, for the output rate it has now'''
+	return max(1, int(round(li.get_output_rate() / rate))) if rate > 0 else 1
+
+def start_sweep(idx, args):
+	'''
+	Start a frequency sweep on lock-in amplifier with index <idx> (first index = 1), the results are read with GET SWEEP
+	<args> is either a comma-separated list of frequencies or '<start> <stop> <points> [LIN|LOG]'
+	At every frequency the filter time constant is the integration time, or SWEEP_PERIODS_MIN signal periods
+	if that is longer, and the filter output is taken once it has settled (see _settle_time)
+	The sweep runs in the main loop (see sweep_loop) and starts the lock-in if it was not measuring yet
+	'''
+	session = _get_session(idx)
+	li = session.li
+	if session.sweep is not None and not session.sweep['done']:
+		raise RuntimeError('SWEEP: a sweep is already running')
+	args = args.split()
+	if len(args) == 1:
+		freqs = [float(f) for f in args[0].split(',')]
+	elif len(args) == 3 or (len(args) == 4 and args[3].lower() in ['lin', 'log']):
+		(fstart, fstop, points) = (float(args[0]), float(args[1]), int(args[2]))
+		if len(args) == 4 and args[3].lower() == 'log':
+			freqs = list(numpy.logspace(numpy.log10(fstart), numpy.log10(fstop), points))
+		else:
+			freqs = list(numpy.linspace(fstart, fstop, points))
+	else:
+		raise RuntimeError('SWEEP: expected a list of frequencies or <start> <stop> <points> [LIN|LOG], got {:s}'.format(' '.join(args)))
+	if len(freqs) == 0 or min(freqs) <= 0:
+		raise RuntimeError('SWEEP: frequencies must be positive')
+	session.sweep = {'freqs': freqs, 'idx': 0, 'results': [], 'f': li.get_f(), 'tau': session.integrationtime, 'started': not li.is_measuring(), 'done': False, 't_next': 0.}
+	if not li.is_measuring():
+		start_lockin(idx)
+	_sweep_to_point(session)
+
 def start_lockin(idx):
-	'''Starts measurement on lock-in amplifier with index <idx> (first index = 1)'''
-	li = _get_lockin(idx)
-	li.start_measurement()
-	t_lastmeas[idx-1] = time.time()
-	meas_in_cur_int[idx-1] = 0
-	t_lastintegration[idx-1] = t_lastmeas[idx-1]
+	'''Starts measurement on lock-in amplifier with ID <idx>'''
+	session = _get_session(idx)
+	session.li.start_measurement()
+	session.t_lastmeas = time.time()
+	session.meas_in_cur_int = 0
+	session.t_lastintegration = session.t_lastmeas
 
 def stop_lockin(li):
 	'''Stops measurement on lock-in amplifier <li>'''
 	li.stop_measurement()
 
 def close_lockin(idx):
-	'''Closes lock-in device with index <idx> (first index = 1)'''
-	global waveform_generators_used, available_waveform_generators, signal_analysers_used, available_signal_analysers, dl, integrationtimes, t_lastmeas, meas_in_cur_int, t_lastintegration, ref_amplitude_buffer, amplitude_buffer, phase_buffer, amplitude_num, phase_num, phase_offset, dl_selected
-	li = _get_lockin(idx)
+	'''Closes lock-in device with ID <idx>, the IDs of the other lock-ins do not change'''
+	global waveform_generators_used, available_waveform_generators, signal_analysers_used, available_signal_analysers
+	session = _get_session(idx)
+	li = session.li
+	if li in held_lockins:
+		held_lockins.remove(li)
+		li.release()
 	li.close()
 	waveform_generators_used[available_waveform_generators.index(li.gen_dev_str)] = False
 	signal_analysers_used[available_signal_analysers.index(li.meas_dev_str)] = False
-	del dl[idx-1], integrationtimes[idx-1], measperint[idx-1], acquiretimes[idx-1], t_lastmeas[idx-1], meas_in_cur_int[idx-1], t_lastintegration[idx-1], ref_amplitude_buffer[idx-1], amplitude_buffer[idx-1], phase_buffer[idx-1], amplitude_num[idx-1], phase_num[idx-1], phase_offset[idx-1]
-	if dl_selected == idx:
-		dl_selected = 0
+	del sessions[idx]
+	for conn in connections:
+		for key in [key for key in conn.cursors if key[0] is session]:
+			del conn.cursors[key]
+		conn.subscriptions.pop(session, None)
+		conn.push_dropped.pop(idx, None)
+		if conn.selected == idx:
+			conn.selected = 0
 
 ##########################
 ##### Loop functions #####
 ##########################
-def command_loop(cmdnow):
+def _command_idn(conn, idx, args, firsttry):
+	'''*IDN?: identify the instrument'''
+	return 'DigitalLockin virtual/software-based lock-in amplifier\n'
+
+def _command_select(conn, idx, args, firsttry):
+	'''SELECT <lock-in>: select (or create) a lock-in for connection <conn>'''
+	select_lockin(int(args), conn)
+	return 'OK\n'
+
+def _command_get(conn, idx, args, firsttry):
+	'''GET <variable>: get a variable of the connection or of lock-in <idx>, returns None if it is not available yet'''
+	gotstr = conn.get(args.strip().lower())
+	if gotstr is not None:
+		return gotstr
+	words = args.lower().split()
+	if len(words) == 0:
+		raise RuntimeError('GET: no variable given')
+	(var, ch) = _parse_channel(words[0])
+	fmt = conn.reply_formatter()
+	if ch is not None:
+		fmt = _channel_formatter(fmt, ch)
+	return get(idx, ' '.join([var] + words[1:]), firsttry, fmt, conn.cursors)
+
+def _command_set(conn, idx, args, firsttry):
+	'''SET <variable> <value>: set a variable of the connection or of lock-in <idx>'''
+	setstr = args.split(' ')
+	if len(setstr) == 2:
+		if not conn.set(setstr[0].lower(), setstr[1]):
+			set(idx, setstr[0].lower(), setstr[1])
+		return 'OK\n'
+	else:
+		raise RuntimeError('SET: Incorrect number of arguments ({:d}): {:s}'.format(len(setstr), args))
+
+def _command_start(conn, idx, args, firsttry):
+	'''START [<lock-in>]: start measuring'''
+	start_lockin(int(args) if len(args.strip()) > 0 else idx)
+	return 'OK\n'
+
+def _command_stop(conn, idx, args, firsttry):
+	'''STOP [<lock-in>]: stop measuring'''
+	stop_lockin(_get_lockin(int(args) if len(args.strip()) > 0 else idx))
+	return 'OK\n'
+
+def _command_close(conn, idx, args, firsttry):
+	'''CLOSE [<lock-in>|ALL]: close a lock-in, or all lock-ins and exit'''
+	global interrupt_received
+	if args.strip().upper() == 'ALL':
+		interrupt_received = True
+	else:
+		close_lockin(int(args) if len(args.strip()) > 0 else idx)
+	return 'OK\n'
+
+def _recording_path(path):
+	'''
+	Path in recording_dir of the recording a client asked for as <path>, creating recording_dir if needed
+	Refuses paths which could lead out of recording_dir and recordings which already exist
+	'''
+	parts = re.split(r'[\\/]', path)
+	if os.path.isabs(path) or os.path.splitdrive(path)[0] or '..' in parts:
+		raise RuntimeError('RECORD: path must be relative to the recording directory and must not contain .., got {:s}'.format(path))
+	fullpath = os.path.join(recording_dir, path)
+	for f in [fullpath, dlm.recorder.metadata_path(fullpath)]:
+		if os.path.exists(f):
+			raise RuntimeError('RECORD: {:s} already exists'.format(f))
+	directory = os.path.dirname(fullpath)
+	if directory != '' and not os.path.isdir(directory):
+		os.makedirs(directory)
+	return fullpath
+
+def _command_record(conn, idx, args, firsttry):
+	'''RECORD START <path>|STOP: record the raw data of a lock-in to a file in recording_dir'''
+	words = args.strip().split(None, 1)
+	if len(words) == 2 and words[0].upper() == 'START':
+		_get_lockin(idx).start_recording(_recording_path(words[1]))
+		return 'OK\n'
+	elif len(words) == 1 and words[0].upper() == 'STOP':
+		return 'OK {:d}\n'.format(_get_lockin(idx).stop_recording())
+	else:
+		raise RuntimeError('RECORD: expected START <path> or STOP, got {:s}'.format(args))
+
+def _command_sweep(conn, idx, args, firsttry):
+	'''SWEEP <frequencies>: start a frequency sweep'''
+	start_sweep(idx, args)
+	return 'OK\n'
+
+def _command_phasenull(conn, idx, args, firsttry):
+	'''PHASENULL [<channel>]: set the phase offset to the current phase'''
+	if len(args.strip()) > 0:
+		phasenull(idx, args.strip())
+	else:
+		phasenull(idx)
+	return 'OK\n'
+
+def _command_subscribe(conn, idx, args, firsttry):
+	'''SUBSCRIBE [<lock-in>] <variables> [<rate>]: push new results of a lock-in to this connection'''
+	words = args.split()
+	if len(words) > 0 and words[0].isdigit():
+		idx = int(words[0])
+		words = words[1:]
+	if not 1 <= len(words) <= 2:
+		raise RuntimeError('SUBSCRIBE: expected [<lock-in>] <variables> [<rate>], got {:s}'.format(args))
+	subscribe(conn, idx, words[0], float(words[1]) if len(words) > 1 else 0.)
+	return 'OK\n'
+
+def _command_unsubscribe(conn, idx, args, firsttry):
+	'''UNSUBSCRIBE [<lock-in>]: stop pushing results of a lock-in, or of all lock-ins, to this connection'''
+	if len(args.strip()) == 0:
+		conn.subscriptions.clear()
+		conn.push_dropped.clear()
+	else:
+		session = _get_session(int(args))
+		if session not in conn.subscriptions:
+			raise RuntimeError('UNSUBSCRIBE: not subscribed to lock-in {:d}'.format(session.id))
+		del conn.subscriptions[session]
+		conn.push_dropped.pop(session.id, None)
+	return 'OK\n'
+
+# Handlers of the commands, called as handler(connection, lock-in index, arguments, firsttry)
+COMMANDS = {
+	'*IDN?': _command_idn,
+	'SELECT': _command_select,
+	'GET': _command_get,
+	'SET': _command_set,
+	'START': _command_start,
+	'STOP': _command_stop,
+	'CLOSE': _command_close,
+	'RECORD': _command_record,
+	'SWEEP': _command_sweep,
+	'PHASENULL': _command_phasenull,
+	'SUBSCRIBE': _command_subscribe,
+	'UNSUBSCRIBE': _command_unsubscribe,
+}
+
+def execute_command(cmd, conn, firsttry=True):
+	'''
+	Executes the single command <cmd> (without newline) from connection <conn>
+	The arguments may start with a lock-in address (e.g. GET 2:R), otherwise the lock-in selected by <conn> is used
+	Returns the reply, or None if the command has to wait (e.g. for data to become available) and must be tried again
+	<firsttry> is False when trying again
 	'''
-	Interprets command that has been written to the COM-port and executes the command.
+	words = cmd.strip().split(' ', 1)
+	handler = COMMANDS.get(words[0].upper())
+	if handler is None:
+		raise RuntimeError('Unknown command: {:s}'.format(cmd))
+	if words[0].upper() == 'SELECT':
+		(idx, args) = (conn.selected, words[1] if len(words) > 1 else '')
+	else:
+		(idx, args) = _parse_address(words[1] if len(words) > 1 else '', conn.selected)
+	return handler(conn, idx, args, firsttry)
+
+def command_loop(cmdnow, conn):
+	'''
+	Interprets command that has been written to connection <conn> and executes the command.
 	Checks if cmdnow is a complete string.
-	cmdnow (str) = command from com port (pcom.readline()).
+	cmdnow (str) = data received from the connection.
+	A line can contain a batch of commands separated by semicolons, which are executed one after the other
+	while the results of all lock-ins are held still, and answered with one combined reply (see _join_replies)
+	The batch stops at the first command which fails, its reply is ERROR
+	A command in a batch which has to wait (e.g. GET SWEEP) lets go of the results, the rest of the batch
+	is executed when it has finished
 	'''
-	global cmd, dl_selected, interrupt_received
 	if len(cmdnow) > 0:
-		cmd = '{:s}{:s}'.format(cmd, cmdnow)
+		conn.cmd = '{:s}{:s}'.format(conn.cmd, cmdnow)
+	cmd = conn.cmd
 	if len(cmd) > 0 and cmd[-1] == '\n':
-		resetcmd = True
-		if len(cmdnow) > 0:
-			logging.info('command: {:s}'.format(cmd[:-1]))
+		firsttry = len(cmdnow) > 0
+		if firsttry:
+			logging.info('command ({:s}): {:s}'.format(conn.name, cmd[:-1]))
+		commands = [c.strip() for c in cmd[:-1].split(';')]
+		if len(commands) > 1:
+			_hold_lockins()
 		try:
-			if cmd[:5].upper() == '*IDN?':
-				_pwrite(pcom, 'DigitalLockin virtual/software-based lock-in amplifier\n')
-			elif cmd[:6].upper() == 'SELECT':
-				select_lockin(int(cmd[7:-1]))
-				_pwrite(pcom, 'OK\n')
-			elif cmd[:3].upper() == 'GET':
-				gotstr = get(dl_selected, cmd[4:-1].lower())
-				if gotstr is not None:
-					_pwrite(pcom, gotstr)
-				else:
-					resetcmd = False
-			elif cmd[:3].upper() == 'SET':
-				setstr = cmd[4:-1].split(' ')
-				if len(setstr) == 2:
-					set(dl_selected, setstr[0].lower(), setstr[1])
-					_pwrite(pcom, 'OK\n')
-				else:
-					raise RuntimeError('SET: Incorrect number of arguments ({:d}): {:s}'.format(len(setstr), cmd[4:-1]))
-			elif cmd[:5].upper() == 'START':
-				start_lockin(dl_selected)
-				_pwrite(pcom, 'OK\n')
-			elif cmd[:4].upper() == 'STOP':
-				stop_lockin(_get_lockin(dl_selected))
-				_pwrite(pcom, 'OK\n')
-			elif cmd[:5].upper() == 'CLOSE':
-				if cmd[6:9].upper() == 'ALL':
-					interrupt_received = True
-					_pwrite(pcom, 'OK\n')
-				elif dl_selected != 0:
-					close_lockin(dl_selected)
-					dl_selected = 0
-					_pwrite(pcom, 'OK\n')
-			elif cmd[:9].upper() == 'PHASENULL':
-				if len(cmd) > 11:
-					phasenull(cmd[10:-1])
-				else:
-					phasenull()
-				_pwrite(pcom, 'OK\n')
-			else:
-				raise RuntimeError('Unknown command: {:s}'.format(cmd[:-1]))
-		except Exception:
-			#e.args = ('Error during command {:s}'.format(cmd.strip()),) + e.args
-			#logging.error(str(e))
-			logging.exception('Error during command {:s}:'.format(cmd.strip()))
-			_pwrite(pcom, 'ERROR\n')
+			for i in range(len(commands)):
+				try:
+					reply = execute_command(commands[i], conn, firsttry or i > 0)
+				except Exception:
+					logging.exception('Error during command {:s}:'.format(commands[i]))
+					conn.replies.append('ERROR\n')
+					break
+				if reply is None:
+					conn.cmd = '{:s}\n'.format(';'.join(commands[i:]))
+					return
+				conn.replies.append(reply)
 		finally:
-			if resetcmd:
-				cmd = ''
+			_release_lockins()
+		_pwrite(conn.port, _join_replies(conn.replies))
+		conn.replies = []
+		conn.cmd = ''
 
 def measure_loop():
 	'''
 	For each lock-in, if the measurement time has passed, retrieve the data.
-	If a full integration time has passed, process the data and store in ref_amplitude_buffer, amplitude_buffer and phase_buffer.
+	If a full integration time has passed, process the data and store it in the R/PHI buffer of the session.
 	'''
 	t = time.time() #Only function that's cross-python compatible
-	for i in range(len(dl)):
-		if dl[i].is_measuring() and t > t_lastmeas[i] + acquiretimes[i]:
+	for session in sessions.values():
+		li = session.li
+		if li.is_measuring() and t > session.t_lastmeas + session.acquiretime:
 			# Measure samples
-			t_lastmeas[i] += dl[i].retrieve_seconds(acquiretimes[i], bool(meas_in_cur_int[i]))
+			session.t_lastmeas += li.retrieve_seconds(session.acquiretime, bool(session.meas_in_cur_int))
 			
 			# Compensate for potential clock mismatch between PXI chassis and PC
-			buffer_samples = dl[i].num_measured_samples_in_instrument_buffer()
+			buffer_samples = li.num_measured_samples_in_instrument_buffer()
 			if buffer_samples > MAX_BUFFERED_SAMPLES_AFTER_READ:
-				t_lastmeas[i] -= TIME_CHANGE_IF_TOO_MANY_BUFFERED_SAMPLES
+				session.t_lastmeas -= TIME_CHANGE_IF_TOO_MANY_BUFFERED_SAMPLES
 				logging.info('Made next measurement earlier ({:d} samples left in buffer)'.format(buffer_samples))
 			elif buffer_samples < MIN_BUFFERED_SAMPLES_AFTER_READ:
-				t_lastmeas[i] += TIME_CHANGE_IF_TOO_FEW_BUFFERED_SAMPLES
+				session.t_lastmeas += TIME_CHANGE_IF_TOO_FEW_BUFFERED_SAMPLES
 				logging.info('Postponed next measurement ({:d} samples left in buffer)'.format(buffer_samples))
 			
 			# Calculate R and PHI if a full integration period has passed
-			meas_in_cur_int[i] += 1
-			if meas_in_cur_int[i] == measperint[i]:
-				meas_in_cur_int[i] = 0
-				if amplitude_num[i] == R_PHI_BUFFER_LEN_MAX:
-					logging.warning('Amplitude buffer reached capacity, discarding whole buffer')
-					amplitude_num[i] = 0
-				if phase_num[i] == R_PHI_BUFFER_LEN_MAX:
-					logging.warning('Phase buffer reached capacity, discarding whole buffer')
-					phase_num[i] = 0
-				(ref_amplitude_buffer[i][amplitude_num[i]], amplitude_buffer[i][amplitude_num[i],:dl[i].get_num_meas_ch()], phase_now) = dl[i].process_data()
-				phase_buffer[i][phase_num[i],:dl[i].get_num_meas_ch()] = phase_now - phase_offset[i]
-				amplitude_num[i] += 1
-				phase_num[i] += 1
-				dl[i].printmainresults(compactfmt=True)
+			session.meas_in_cur_int += 1
+			if session.meas_in_cur_int == session.measperint:
+				session.meas_in_cur_int = 0
+				(ref_amplitude, amplitude, phase) = li.process_data()
+				session.store_result(session.t_lastmeas - session.t_lastintegration, ref_amplitude, amplitude, phase)
+				li.printmainresults(compactfmt=True)
 
 def measure_loop_continuous():
 	'''
-	For each lock-in, retrieve the data.
+	For each lock-in, store the filter output which its acquisition thread produced at the output rate of the lock-in
+	in the R/PHI buffer of its session.
+	Retrieving and filtering samples is done by the acquisition threads, so slow commands do not delay it
+	'''
+	for session in sessions.values():
+		if session.li.is_measuring():
+			(t, ref_amplitude, amplitude, phase) = session.li.continuous_pop_output()
+			for j in range(len(t)):
+				session.store_result(t[j], ref_amplitude[j], amplitude[j], phase[j])
+
+def publish_loop():
+	'''
+	Push the results which have been stored since the last time to the connections which subscribed to them (see subscribe)
+	'''
+	for conn in connections:
+		for (session, (names, rate)) in list(conn.subscriptions.items()):
+			unread = session.unread_results('subscribe', conn.cursors)
+			if unread is None:
+				continue
+			seqs = numpy.arange(unread[0], unread[1])
+			seqs = seqs[seqs % _subscription_decimation(session.li, rate) == 0]
+			if len(seqs) == 0:
+				continue
+			nch = session.li.get_num_meas_ch()
+			results = session.results[seqs % len(session.results)]
+			r = results['amplitude'][:,:nch]
+			phi = results['phase'][:,:nch]
+			values = {'r': r, 'phi': phi, 'x': r * numpy.cos(phi), 'y': r * numpy.sin(phi)}
+			conn.push(session.id, seqs, numpy.column_stack([results['t']] + [values[v] for v in names]))
+
+def sweep_loop():
+	'''
+	For each lock-in which is sweeping, store the result at the current frequency once the filter has settled and move on to the next frequency
+	Each result is a line of frequency, excitation amplitude and detected amplitude and phase relative to excitation signal
 	'''
-	for i in range(len(dl)):
-		if dl[i].is_measuring():
-			dl[i].continuous_retrieve_and_filter()
+	t = time.time()
+	for session in sessions.values():
+		sweep = session.sweep
+		if sweep is None or sweep['done'] or t < sweep['t_next']:
+			continue
+		li = session.li
+		if not li.is_measuring():
+			logging.warning('Lock-in {:d} stopped measuring during a sweep, aborting sweep'.format(session.id))
+			_end_sweep(session)
+			continue
+		(ref_amplitude, amplitude, phase) = li.get_harmonic_results()
+		sweep['results'].append(numpy.concatenate([[li.get_f(), ref_amplitude], amplitude, phase - session.phase_offset]))
+		sweep['idx'] += 1
+		if sweep['idx'] < len(sweep['freqs']):
+			_sweep_to_point(session)
+		else:
+			_end_sweep(session)
 
 ########################
 ##### Main program #####
 ########################
 
-# Initialization
-pcom = serial.Serial(comport_to_use, timeout=comport_timeout)
+# State of the instrument, set up by initialize()
+client_input = queue.Queue() # (connection, data) from all reader threads
+connections = [] # All open connections, each has its own selected lock-in
+held_lockins = [] # Lock-ins whose results are held still while a batch of commands runs
+servers = []
 waveform_generators_used = [False] * len(available_waveform_generators)
 signal_analysers_used = [False] * len(available_signal_analysers)
-dl = [] # Digital lockin object array
-integrationtimes = []
-acquiretimes = []
-measperint = []
-t_lastmeas = []
-meas_in_cur_int = []
-t_lastintegration = []
-amplitude_buffer = []
-ref_amplitude_buffer = []
-phase_buffer = []
-amplitude_num = []
-phase_num = []
-phase_offset = []
-dl_selected = 0 # Default = none.
-cmd = ''
-logging.info('Initialization done')
-
-# Main loop
-while not interrupt_received:
-	try:
-		# Reads com port and parses to cmd, and executes chosen command.
-		if len(cmd) and cmd[-1] == '\n':
-			command_loop('')
-		else:
-			command_loop(pcom.readline())
-	except serial.SerialException as e:
-		if str(e) != 'read failed: (4, \'Interrupted system call\')':
-			logging.error('Could not read command:\n{:s}'.format(str(e)))
-	measure_loop_continuous()
-	time.sleep(0.01) # Sleep for 10 ms to allow UI interaction
-
-# Closing
-for dli in dl:
-	dli.close()
-_pwrite(pcom, 'EXIT\n')
-pcom.close()
-logging.info('Now exiting.')
+sessions = {} # Lock-in ID -> LockinSession
+
+def initialize(argv=None):
+	'''
+	Apply the command line arguments <argv> (default: those of the program) to the settings
+	and open the COM port, TCP port and Unix socket to accept commands on
+	Returns the parsed arguments
+	'''
+	global use_simulated_lockins, recording_dir, replay_recording, replay_speed
+	parser = argparse.ArgumentParser(description='Digital lock-in amplifier virtual instrument')
+	parser.add_argument('comport', nargs='?', default=comport_to_use, help='COM port on which to accept commands, NONE for no COM port')
+	parser.add_argument('--simulated', action='store_true', help='use simulated lock-ins (see use_simulated_lockins)')
+	parser.add_argument('--tcp', type=int, default=tcp_port, help='TCP port on which to accept connections')
+	parser.add_argument('--unix', default=unix_socket_path, help='path of a Unix socket on which to accept connections')
+	parser.add_argument('--record-dir', default=recording_dir, help='directory in which RECORD START creates its files')
+	parser.add_argument('--replay', default=replay_recording, help='create lock-ins which replay this recording (see RECORD) instead of measuring')
+	parser.add_argument('--replay-speed', type=float, default=replay_speed, help='speed relative to real time at which to replay, 0 for as fast as possible')
+	args = parser.parse_args(argv)
+	if args.simulated:
+		use_simulated_lockins = True
+	recording_dir = args.record_dir
+	replay_recording = args.replay
+	replay_speed = args.replay_speed
+	if args.comport is not None and args.comport.upper() != 'NONE':
+		pcom = serial.Serial(args.comport, timeout=comport_timeout)
+		connections.append(_Connection(pcom, args.comport))
+		serial_thread = threading.Thread(target=_serial_reader, args=(pcom, connections[0], client_input), name='COM port reader')
+		serial_thread.daemon = True
+		serial_thread.start()
+	if args.tcp is not None:
+		servers.append(_open_server(socket.AF_INET, (tcp_host, args.tcp), 'TCP port {:d}'.format(args.tcp), client_input))
+	if args.unix is not None:
+		if os.path.exists(args.unix) and stat.S_ISSOCK(os.stat(args.unix).st_mode):
+			os.remove(args.unix) # Left behind by an earlier run
+		servers.append(_open_server(socket.AF_UNIX, args.unix, 'Unix socket {:s}'.format(args.unix), client_input))
+	if len(connections) == 0 and len(servers) == 0:
+		raise RuntimeError('No COM port, TCP port or Unix socket to accept commands on')
+	logging.info('Initialization done')
+	return args
+
+def main_loop():
+	'''
+	Run the instrument until an interrupt or CLOSE ALL
+	Waits for input from the reader threads until the next tick, so commands are executed as soon as they arrive
+	Every MAIN_LOOP_INTERVAL the results of the acquisition threads are collected and waiting commands are retried
+	A connection with a waiting command does not get new commands executed until it has finished, other connections do
+	'''
+	t_nexttick = time.time()
+	while not interrupt_received:
+		try:
+			(conn, data) = client_input.get(True, max(0., t_nexttick - time.time()))
+			if conn not in connections:
+				connections.append(conn)
+				logging.info('New connection: {:s}'.format(conn.name))
+			if data is None:
+				connections.remove(conn)
+				conn.port.close()
+				logging.info('Connection closed: {:s}'.format(conn.name))
+			else:
+				conn.inbox.append(data)
+		except queue.Empty:
+			pass
+		if time.time() >= t_nexttick:
+			measure_loop_continuous()
+			publish_loop()
+			sweep_loop()
+			for conn in connections:
+				if conn.waiting():
+					command_loop('', conn)
+			t_nexttick = max(t_nexttick + MAIN_LOOP_INTERVAL, time.time())
+		for conn in connections:
+			while len(conn.inbox) > 0 and not conn.waiting():
+				command_loop(conn.inbox.popleft(), conn)
+
+def shutdown(args):
+	'''Close all lock-ins, connections and servers opened with the arguments <args> of initialize()'''
+	for session in sessions.values():
+		session.li.close()
+	for conn in connections:
+		_pwrite(conn.port, 'EXIT\n')
+		conn.port.close()
+	for server in servers:
+		server.close()
+	if args.unix is not None:
+		os.remove(args.unix)
+	logging.info('Now exiting.')
+
+def main():
+	signal.signal(signal.SIGINT, interrupt_handler)
+	args = initialize()
+	main_loop()
+	shutdown(args)
 
+if __name__ == '__main__':
+	main()
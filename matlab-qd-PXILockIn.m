@@ -13,6 +13,9 @@ classdef PXILockIn < qd.classes.ComInstrument
     %     Supported commands:
     % 	SELECT
     % 		Select a lock-in instrument
+    %   Commands can also address a lock-in without selecting it, e.g.
+    %   GET 2:R or SET 2:F 1000. getc uses this for channels which are
+    %   prefixed with a lock-in number, e.g. getc('2r').
     % 	SET F|FS|A|T|PHASEOFFSET|MEASCH <value>
     % 		Set the value of a variable of the selected lock-in instrument
     % 	GET RPHIBUFFER
@@ -39,10 +42,13 @@ classdef PXILockIn < qd.classes.ComInstrument
     %     * Create separate channels for each lock-in instead of requiring
     %       a manual setc('SELECT', <li>). E.g. one could make '1R', '2R',
     %       '1PHI', '2PHI' channels to specify which lock-in to take a
-    %       channel from. [DONE for GET, not needed for SET]
+    %       channel from. [DONE for GET using addressed commands (GET 2:R),
+    %       not needed for SET]
     %     * Cache PHI when only R is requested and cache R when only PHI is
     %       requested. Also do some bookkeeping on which has already been
-    %       requested and which hasn't
+    %       requested and which hasn't [Not needed anymore: the server
+    %       no longer discards PHI when R is read, GET R and GET PHI give
+    %       values of the same integration interval]
     %     * Make separate channels for each physical channel, i.e. instead
     %       of returning R and PHI as arrays make each element individually
     %       accessible as an instrument channel. One could make 'R1', 'R2',
@@ -120,21 +126,23 @@ classdef PXILockIn < qd.classes.ComInstrument
         % Get the value of a channel
         % If the channel name is prefixed with a number, get the channel
         % from the lock-in corresponding with that number
-        % Note that this selects the corresponding lock-in, and does not
-        % return to the previously selected one afterward
+        % This addresses the lock-in in the command (e.g. GET 2:R), so the
+        % selected lock-in does not change
             firstnonnumchar = 1;
             while ~isnan(str2double(channel(1:firstnonnumchar)))
                 firstnonnumchar = firstnonnumchar + 1;
             end
+            lockin = channel(1:firstnonnumchar-1);
+            address = '';
             if firstnonnumchar > 1;
-                obj.set('SELECT', str2double(channel(1:firstnonnumchar-1)));
+                address = [lockin ':'];
                 channel = channel(firstnonnumchar:end);
             end
             switch upper(channel)
                 case 'RPHIBUFFER'
                     error('DigitalLockin.GETC(RPHIBUFFER): Not yet implemented');
                 case {'RPHI', 'XY'}
-                    response = obj.query(['GET ' channel]);
+                    response = obj.query(['GET ' address channel]);
                     if length(response) > 2 && strcmp(response(1:2), 'OK')
                         val = str2num(response(4:end));
                         obj.rphixyread = ones(4, length(val));
@@ -144,7 +152,7 @@ classdef PXILockIn < qd.classes.ComInstrument
                     end
                 case {'R', 'PHI', 'X', 'Y'}
                     %warning('DigitalLockin.GETC(%s): Requesting just one output channel at a time is not recommended unless you do not wish to use any other variables', channel);
-                    response = obj.query(['GET ' channel]);
+                    response = obj.query(['GET ' address channel]);
                     if length(response) > 2 && strcmp(response(1:2), 'OK')
                         val = str2num(response(4:end));
                     else
@@ -152,7 +160,7 @@ classdef PXILockIn < qd.classes.ComInstrument
                     end
                 case {'F', 'FS', 'A', 'T', 'PHASEOFFSET'}
                     try
-                        val = obj.querym(['GET ' channel], 'OK %f');
+                        val = obj.querym(['GET ' address channel], 'OK %f');
                     catch err
                         error('DigitalLockin.GETC(%s): %s Additional info from Matlab: %s', channel, obj.GENERIC_ERROR, err.message);
                     end
@@ -171,7 +179,7 @@ classdef PXILockIn < qd.classes.ComInstrument
                                 readboolidx = 4;
                         end
                         if isempty(obj.rphixyread) || obj.rphixyread(readboolidx, ch+1)
-                            rphi = obj.getc('rphi');
+                            rphi = obj.getc([lockin 'rphi']);
                             if isempty(obj.r)
                                 obj.r = rphi(1:(end+1)/2);
                             else
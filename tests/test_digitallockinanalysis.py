@@ -0,0 +1,62 @@
+'''
+test_digitallockinanalysis.py, tests of the offline lock-in analysis in worker processes
+
+Copyright: Zeust the Unoobian <2noob2banoob@gmail.com>, 2014
+
+This file is part of DigitalLockin.
+
+DigitalLockin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+DigitalLockin is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with DigitalLockin.  If not, see <http://www.gnu.org/licenses/>.
+
+Usage: python -m unittest discover tests
+'''
+
+import os
+import sys
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import digitallockin as dlm
+import digitallockinanalysis as analysis
+
+F = 1000.
+FS = 51200.
+SAMPLES = 51200
+TIMEOUT = 60.
+
+def _record(amplitude, phase):
+	'''Raw data of a reference sine and one measurement channel at <amplitude> and <phase> relative to it'''
+	t = numpy.arange(SAMPLES) / FS
+	return numpy.vstack([numpy.sin(2 * numpy.pi * F * t), amplitude * numpy.sin(2 * numpy.pi * F * t + phase)])
+
+class TestAnalysisExecutor(unittest.TestCase):
+
+	def setUp(self):
+		self.executor = analysis.AnalysisExecutor(processes=2)
+
+	def tearDown(self):
+		self.executor.shutdown()
+
+	def test_map_moreinfo_matches_serial(self):
+		'''Every record of a map_moreinfo with more jobs than processes gets the results of its own data'''
+		records = [_record(0.5 * (i + 1), 0.2 * i) for i in range(4)]
+		jobs = self.executor.map_moreinfo(records, F, FS, fltord=2)
+		for (rawdata, job) in zip(records, jobs):
+			expected = dlm.analyse_moreinfo(rawdata, F, FS, fltord=2)
+			results = job.get(TIMEOUT)
+			for name in ['normamplitudes', 'normphases', 'normamplitudes_all', 'normphases_all']:
+				numpy.testing.assert_allclose(results[name], expected[name], err_msg=name)
+
+if __name__ == '__main__':
+	unittest.main()